@@ -2,7 +2,7 @@
 '''
     File name: Bulb.py
     Author: Maxime Bergeron
-    Date last modified: 21/07/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The Bulb common class to simplify bluepy-controlled BLE bulbs. Not a device per-se.
@@ -51,6 +51,8 @@ class Bulb(device):
     def __init__(self, devid):
         super().__init__(devid)
         self.device = self.config["ADDRESS"]
+        # All bulbs share the bluetooth adapter
+        self.poll_transport = "BLE"
 
     def disconnect(self):
         """ Disconnects the device """
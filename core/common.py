@@ -2,21 +2,25 @@
 '''
     File name: common.py
     Author: Maxime Bergeron
-    Date last modified: 07/01/2020
+    Date last modified: 19/10/2026
     Python Version: 3.5
 
     Commonly shared variables and functions
 '''
 
+import atexit
 import datetime
 import gettext
 import glob
 import os
 import pickle
+import queue
 import random
 import socket
 import struct
 import sys
+import threading
+import time
 from os.path import dirname, basename, isfile
 from core.confighandler import ConfigHandler
 
@@ -72,6 +76,8 @@ def recvall(sock, n, unpickle=False):
 
 
 def getConfigHandler(renew=False):
+    """ Config snapshot shared by the whole server. renew parses home.ini again and swaps it """
+    global HOMECONFIG
     if renew:
         HOMECONFIG = ConfigHandler()
     try:
@@ -96,26 +102,40 @@ class NewRequestException(Exception):
 
 
 class DebugLog(object):
+    # Severity order of the levels, used by the DEBUG_LEVEL filter
+    SEVERITY = {-1: 0, 0: 0, 3: 1, 1: 2, 2: 3}
+    SEVERITY_NAMES = {"debug": 0, "warning": 1, "error": 2, "fatal": 3}
+    # Max number of queued messages written in a single batch
+    BATCH_SIZE = 512
+
     def __init__(self):
-        """ Handles debug logging """
+        """ Handles debug logging. Messages are queued and written by a background thread """
         self.config = HOMECONFIG.set_section("SERVER")
         self.LEVELS = {-1: "UNKNOWN", 0: "DEBUG", 1: "ERROR", 2: "FATAL", 3: "WARNING"}
         self.COLOR_LEVELS = {-1: "", 0: "\033[93m", 1: "\033[91m", 2: "\033[41m", 3:"\033[43m"}
         self.device_colors = {}
         self.debug_enabled = self.config.get_value("ENABLE_DEBUG", bool)
         self.journaling_enabled = self.config.get_value('JOURNALING', bool)
+        self.min_severity = 0
+        if self.config.dev_has_option("DEBUG_LEVEL"):
+            self.min_severity = self.SEVERITY_NAMES.get(self.config["DEBUG_LEVEL"].lower(), 0)
+        self.max_file_size = 5 * 1024 * 1024
+        if self.config.dev_has_option("MAX_DEBUG_FILE_SIZE"):
+            self.max_file_size = self.config.get_value("MAX_DEBUG_FILE_SIZE", int) * 1024 * 1024
         self._lock_socket = None
+        self.queue = queue.SimpleQueue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        atexit.register(self.flush)
 
     def enable_debug(self):
         if self.get_set_lock(True) and self.debug_enabled and self.journaling_enabled:
-            # Server not yet initialized. Create log files
-            for n in reversed(range(0, self.config.get_value("MAX_DEBUG_FILES", int))):
-                if os.path.isfile(get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n) + ".log"):
-                    os.remove(
-                        get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n) + ".log")
-                if os.path.isfile(get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n - 1) + ".log"):
-                    os.rename(get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n - 1) + ".log",
-                              get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n) + ".log")
+            if not os.path.isdir(get_path_from_config(self.config['JOURNAL_DIR'])):
+                print("* Directory {} does not exist. Running configuration tool...".format(
+                    get_path_from_config(self.config['JOURNAL_DIR'])))
+                self.config.configure_prompt()
+                quit()
+            # Logs are appended to the actual journal, rotation is size-based
             self.write("Starting debug logger", 0)
 
     def get_set_lock(self, get=False):
@@ -132,36 +152,116 @@ class DebugLog(object):
                 print("Server is already running. Shutting down.")
                 sys.exit()
 
-    def write(self, msg, level=-1, devicetype=None, prefix=""):
-        if self.debug_enabled:
-            if devicetype is not None:
-                if devicetype in self.device_colors.keys():
-                    _dcolor = self.device_colors[devicetype]
-                else:
-                    _dcolor = "\033[38;5;" + \
-                        str(random.randint(100, 230)) + "m"
-                    self.device_colors[devicetype] = _dcolor
-
-                _cdebugtext = "({}) - [{}{}\033[0m] {}{}[{}] {}\033[0m".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                                                               self.COLOR_LEVELS[level], self.LEVELS[level], prefix, _dcolor, devicetype, msg)
-                _debugtext = "({}) - [{}] {}[{}] {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                                            self.LEVELS[level], prefix, devicetype, msg)
+    def write(self, msg, level=-1, devicetype=None, prefix="", args=None):
+        """ Queues a message. msg may be a callable, or a format string of args. Both are only """
+        """ evaluated by the writer thread, if the message is written, so mutable args must be copies """
+        if not self.debug_enabled or self.SEVERITY.get(level, 0) < self.min_severity:
+            return
+        if self.writer is None:
+            self._start_writer()
+        self.queue.put((time.time(), level, devicetype, prefix, msg, args))
+        if level == 2:
+            # Fatal messages usually precede an exit
+            self.flush()
+
+    def flush(self, timeout=2):
+        """ Waits until all the queued messages are written """
+        if self.writer is None or not self.writer.is_alive():
+            return
+        _done = threading.Event()
+        self.queue.put(_done)
+        _done.wait(timeout)
+
+    def _start_writer(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="DebugLog")
+                self.writer.daemon = True
+                self.writer.start()
+
+    def _format(self, item, timestamps):
+        _time, level, devicetype, prefix, msg, args = item
+        if callable(msg):
+            msg = msg()
+        if args is not None:
+            msg = msg.format(*args)
+        _minute = int(_time // 60)
+        if _minute not in timestamps:
+            timestamps.clear()
+            timestamps[_minute] = datetime.datetime.fromtimestamp(_time).strftime("%Y-%m-%d %H:%M")
+        _stamp = timestamps[_minute]
+        if devicetype is not None:
+            if devicetype in self.device_colors.keys():
+                _dcolor = self.device_colors[devicetype]
             else:
-                _cdebugtext = "({}) - [{}{}\033[0m] {}{}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                                                 self.COLOR_LEVELS[level], self.LEVELS[level], prefix, msg)
-                _debugtext = "({}) - [{}] {}{}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
-                                                       self.LEVELS[level], prefix, msg)
-            if not DEBUG_LOCK:
-                print(_cdebugtext)
-            if self.journaling_enabled:
+                _dcolor = "\033[38;5;" + \
+                    str(random.randint(100, 230)) + "m"
+                self.device_colors[devicetype] = _dcolor
+
+            _cdebugtext = "({}) - [{}{}\033[0m] {}{}[{}] {}\033[0m".format(_stamp,
+                                                                           self.COLOR_LEVELS[level], self.LEVELS[level], prefix, _dcolor, devicetype, msg)
+            _debugtext = "({}) - [{}] {}[{}] {}".format(_stamp,
+                                                        self.LEVELS[level], prefix, devicetype, msg)
+        else:
+            _cdebugtext = "({}) - [{}{}\033[0m] {}{}".format(_stamp,
+                                                             self.COLOR_LEVELS[level], self.LEVELS[level], prefix, msg)
+            _debugtext = "({}) - [{}] {}{}".format(_stamp,
+                                                   self.LEVELS[level], prefix, msg)
+        return _cdebugtext, _debugtext
+
+    def _write_loop(self):
+        _journal = None
+        _timestamps = {}
+        while True:
+            _batch = [self.queue.get()]
+            try:
+                while len(_batch) < self.BATCH_SIZE:
+                    _batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            _console = []
+            _lines = []
+            _flushes = []
+            for _item in _batch:
+                if isinstance(_item, threading.Event):
+                    _flushes.append(_item)
+                    continue
+                try:
+                    _cdebugtext, _debugtext = self._format(_item, _timestamps)
+                except Exception as ex:
+                    _cdebugtext = _debugtext = "Failed to format debug message: {}".format(ex)
+                _console.append(_cdebugtext)
+                _lines.append(_debugtext + "\n")
+            if _console and not DEBUG_LOCK:
+                print("\n".join(_console))
+            if _lines and self.journaling_enabled:
                 try:
-                    with open(get_path_from_config(self.config['JOURNAL_DIR']) + "/home.0.log", "a+") as jfile:
-                        jfile.write(_debugtext + "\n")
-                except IOError:
-                    print("* Directory {} does not exist. Running configuration tool...".format(
-                        get_path_from_config(self.config['JOURNAL_DIR'])))
-                    self.config.configure_prompt()
-                    quit()
+                    if _journal is None:
+                        _journal = open(self.get_journal_file(0), "a")
+                    _journal.write("".join(_lines))
+                    _journal.flush()
+                    if _journal.tell() >= self.max_file_size:
+                        _journal.close()
+                        _journal = None
+                        self.rotate()
+                except (IOError, OSError) as ex:
+                    print("* Cannot write to journal {} ({}). Journaling disabled.".format(
+                        self.get_journal_file(0), ex))
+                    self.journaling_enabled = False
+                    _journal = None
+            for _done in _flushes:
+                _done.set()
+
+    def get_journal_file(self, n):
+        return get_path_from_config(self.config['JOURNAL_DIR']) + "/home." + str(n) + ".log"
+
+    def rotate(self):
+        """ Shifts the journal files (home.0.log becomes home.1.log...) """
+        for n in reversed(range(0, self.config.get_value("MAX_DEBUG_FILES", int))):
+            if os.path.isfile(self.get_journal_file(n)):
+                os.remove(self.get_journal_file(n))
+            if n > 0 and os.path.isfile(self.get_journal_file(n - 1)):
+                os.rename(self.get_journal_file(n - 1), self.get_journal_file(n))
 
 
 class LanguageHandler(object):
@@ -193,22 +293,63 @@ language = LanguageHandler()
 _ = language.installLanguage()
 
 
+class PluginRegistry(object):
+    """ Device and module plugins, discovered once. Classes are imported on first use """
+    # StateRequestObject keys, on top of the lowercase device types
+    REQUEST_KEYS = ['hexvalues', 'off', 'on', 'restart', 'toggle', 'group',
+                    'client', 'notime', 'delay', 'preset', 'manual_mode',
+                    'reset_location_data', 'force_auto_mode', 'auto_mode',
+                    'reset_mode', 'skip_time', 'set_mode_for_devid',
+                    'history_origin']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """ Scans the devices and modules directories """
+        _devices = glob.glob(dirname(__file__) + "/../devices/*.py")
+        self.devices = [basename(f)[:-3] for f in _devices if isfile(f)
+                        and not f.endswith('__init__.py')]
+        self.devices_lower = [x.lower() for x in self.devices]
+        # Lowercase device type aliases, as used by requests and CLI arguments
+        self.device_aliases = dict(zip(self.devices_lower, self.devices))
+        _modules = glob.glob(dirname(__file__) + "/../modules/*.py")
+        self.modules = [basename(f)[:-3] for f in _modules if isfile(f)]
+        self.request_keys = frozenset(self.REQUEST_KEYS + self.devices_lower)
+        self.classes = {}
+
+    def _get_class(self, package, name):
+        with self.lock:
+            if (package, name) not in self.classes:
+                _module = __import__(package + "." + name)
+                # TODO Needed twice ? looks unpythonic
+                _class = getattr(_module, name)
+                self.classes[(package, name)] = getattr(_class, name)
+            return self.classes[(package, name)]
+
+    def get_device_class(self, name):
+        return self._get_class("devices", name)
+
+    def get_module_class(self, name):
+        return self._get_class("modules", name)
+
+
 def getDevices(to_lower=False):
     """ Getter for available device modules, same as __init__ """
-    modules = glob.glob(dirname(__file__) + "/../devices/*.py")
-    devices = [basename(f)[:-3] for f in modules if isfile(f)
-               and not f.endswith('__init__.py')]
     if to_lower:
-        return [x.lower() for x in devices]
+        return list(plugins.devices_lower)
     else:
-        return devices
+        return list(plugins.devices)
 
 
 def getModules():
     """ Getter for available server modules, same as __init__ """
-    modules = glob.glob(dirname(__file__) + "/../modules/*.py")
-    devices = [basename(f)[:-3] for f in modules if isfile(f)]
-    return devices
+    return list(plugins.modules)
+
+
+plugins = PluginRegistry()
+
 
 def get_path_from_config(path):
     return path.replace("BASEDIR", CORE_DIR + "/..")
\ No newline at end of file
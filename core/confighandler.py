@@ -2,7 +2,7 @@
 '''
     File name: confighandler.py
     Author: Maxime Bergeron
-    Date last modified: 29/01/2021
+    Date last modified: 19/10/2026
     Python Version: 3.8
 
     The configuration file handler. Adds functions that do not
@@ -23,11 +23,22 @@ CORE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class ConfigHandler(ConfigParser):
+    """ Config snapshot parsed once from home.ini. Sections are views sharing the parsed data, """
+    """ with their typed values converted on first access. getConfigHandler(renew=True) swaps the snapshot """
     has_imported_config = False
+    # configurables.xml does not change while running, it is parsed once
+    configurables_tree = None
+    # Number of configurables.xml and home.ini parses, for benchmarking
+    parse_count = 0
 
     def __init__(self, subsection=None, *args, **kwargs):
         self.subsection = subsection
         self.configurables = None
+        # Shared by the section views: views per section and generation of the typed values
+        self.views = {}
+        self.snapshot = {"generation": 0}
+        self.values = {}
+        self.values_generation = 0
         try:
             super().__init__(*args, **kwargs)
         except TypeError:
@@ -47,21 +58,59 @@ class ConfigHandler(ConfigParser):
         except TypeError:
             return super(ConfigHandler, self).__getitem__(element)
 
-    @classmethod
-    def set_section(cls, subsection=None, device=None):
-        """ Returns another instance of class """
-        """ that points directly to the subsection subsection """
+    def __getstate__(self):
+        # Section views are not sent along with the config
+        _state = self.__dict__.copy()
+        _state["views"] = {}
+        return _state
+
+    def set_section(self, subsection=None, device=None):
+        """ Returns a view of the config that points directly to the subsection subsection. """
+        """ Views share the parsed data and are cached per section """
         if device is not None:
             subsection = "DEVICE" + str(device)
-        return cls(subsection)
+        if subsection not in self.views:
+            _view = self.__class__.__new__(self.__class__)
+            _view.__dict__.update(self.__dict__)
+            _view.subsection = subsection
+            _view.values = {}
+            _view.values_generation = self.snapshot["generation"]
+            self.views[subsection] = _view
+        return self.views[subsection]
+
+    def set(self, section, option, value=None):
+        super().set(section, option, value)
+        # Typed values of all the views are converted again
+        self.snapshot["generation"] += 1
+
+    def remove_option(self, section, option):
+        self.snapshot["generation"] += 1
+        return super().remove_option(section, option)
+
+    def remove_section(self, section):
+        self.snapshot["generation"] += 1
+        return super().remove_section(section)
 
     def get_value(self, element, a_type=str, parent=None):
         """ Gets a a_type type value from the config for element value. """
         """ Parent allows going back to another section (reverses the set """
-        """ _section() function) """
+        """ _section() function). Values are cached per view until the config changes """
+        if element is None:
+            return self
+        if self.values_generation != self.snapshot["generation"]:
+            self.values = {}
+            self.values_generation = self.snapshot["generation"]
+        _key = (element, a_type, parent)
+        if _key not in self.values:
+            _value = self._get_typed_value(element, a_type, parent)
+            if _value is None:
+                # Missing value handled by the configuration tool, not cached
+                return _value
+            self.values[_key] = _value
+        return self.values[_key]
+
+    def _get_typed_value(self, element, a_type=str, parent=None):
         try:
-            if element is None:
-                return self
             if a_type == str:
                 if parent is not None:
                     return self.get(section=parent, option=element)
@@ -84,6 +133,18 @@ class ConfigHandler(ConfigParser):
         except NoOptionError as ex:
             return self.get_configure_prompt(exception=ex)
 
+    def get_changes(self, other):
+        """ Options added, removed or changed since another config, per section """
+        _changes = {}
+        for _section in set(self.sections()) | set(other.sections()):
+            _items = dict(self.items(_section, raw=True)) if self.has_section(_section) else {}
+            _other_items = dict(other.items(_section, raw=True)) if other.has_section(_section) else {}
+            _changed = {_option for _option in set(_items) | set(_other_items)
+                        if _items.get(_option) != _other_items.get(_option)}
+            if _changed:
+                _changes[_section] = _changed
+        return _changes
+
     def dev_has_option(self, element):
         return self.has_option(self.subsection, element)
 
@@ -91,13 +152,17 @@ class ConfigHandler(ConfigParser):
         return self["DEVICE" + str(devid)][element]
 
     def load_config(self):
+        if ConfigHandler.configurables_tree is None:
+            ConfigHandler.configurables_tree = ET.parse(os.path.join(
+                CORE_DIR, 'configurables.xml')).getroot()
+            ConfigHandler.parse_count += 1
+        self.configurables = ConfigHandler.configurables_tree
         # TODO Is there a more elegant way to handle this arg sooner, before any
         # call to the config files?
-        self.configurables = ET.parse(os.path.join(
-                CORE_DIR, 'configurables.xml')).getroot()
         if "--init-from" in sys.argv and not ConfigHandler.has_imported_config:
             self.import_config_from_server()
         try:
+            ConfigHandler.parse_count += 1
             ds = self.read(os.path.join(CORE_DIR, '../home.ini'))
         except MissingSectionHeaderError as ex:
             return self.get_configure_prompt(exception=ex)
@@ -173,8 +238,8 @@ class ConfigHandler(ConfigParser):
                                     help=_help)
 
         if not _ignore_devices:
-            from core.common import getDevices
-            for _dev in getDevices(True):
+            from core.common import plugins
+            for _dev in plugins.devices_lower:
                 parser.add_argument('--' + _dev, type=str, nargs="*",
                                     help='Change {} states only'.format(_dev))
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+    File name: configpersister.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.8
+
+    Debounced and atomic home.ini writer for the config edits made while running. Not a module per-se
+'''
+
+import shutil
+from configparser import ConfigParser
+from core.common import *
+from core.confighandler import CORE_DIR
+from threading import Thread, Lock, Event
+
+CONFIG_PATH = os.path.join(CORE_DIR, '../home.ini')
+CONFIG_BACKUP_PATH = os.path.join(CORE_DIR, '../home.old')
+# Delay before writing again the edits of a failed save
+SAVE_RETRY_SEC = 30
+
+
+class ConfigPersister(Thread):
+    """ Queues config edits and writes them to home.ini in the background. Edits made within the """
+    """ save delay are written together """
+
+    def __init__(self, delay=1.0, generations=5, config_lock=None):
+        Thread.__init__(self, name="ConfigPersister")
+        self.daemon = True
+        self.delay = delay
+        self.generations = generations
+        # Held by the config edits and reloads while they change the config snapshot
+        self.config_lock = config_lock or Lock()
+        self.lock = Lock()
+        self.pending = []
+        self.changed = Event()
+        self.saved = Event()
+        self.saved.set()
+        atexit.register(self.flush)
+
+    def update(self, section, option, value):
+        """ Queues a config edit. Returns immediately """
+        self.update_many([(section, option, value)])
+
+    def update_many(self, edits):
+        with self.lock:
+            self.pending.extend(edits)
+            self.saved.clear()
+        self.changed.set()
+
+    def flush(self, timeout=10):
+        """ Waits until the queued edits are written """
+        if self.is_alive():
+            self.changed.set()
+            self.saved.wait(timeout)
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            # Edits arriving within the save delay are written together, up to 10 delays
+            _deadline = time.monotonic() + self.delay * 10
+            while self.changed.is_set() and time.monotonic() < _deadline:
+                self.changed.clear()
+                time.sleep(self.delay)
+            self.changed.clear()
+            with self.lock:
+                _edits = self.pending
+                self.pending = []
+            if _edits:
+                try:
+                    self.save(_edits)
+                except Exception as ex:
+                    debug.write("Could not save {} config changes: {}. Retrying in {}s".format(
+                        len(_edits), ex, SAVE_RETRY_SEC), 1)
+                    with self.lock:
+                        # Before the edits queued since, which are more recent
+                        self.pending[:0] = _edits
+                    self.changed.wait(SAVE_RETRY_SEC)
+                    self.changed.set()
+                    continue
+            with self.lock:
+                if not self.pending:
+                    self.saved.set()
+
+    def save(self, edits):
+        """ Writes the current config with the edits to a temporary file then swaps it with home.ini. """
+        """ The previous files are kept as home.old, home.old.1 and so on """
+        _config = ConfigParser(interpolation=None)
+        with self.config_lock:
+            _snapshot = getConfigHandler()
+            _config.read_dict({_section: dict(_snapshot.items(_section, raw=True)) for _section in _snapshot.sections()})
+        for _section, _option, _value in edits:
+            if not _config.has_section(_section):
+                _config.add_section(_section)
+            _config.set(_section, _option, _value)
+        _temp = CONFIG_PATH + ".tmp"
+        with open(_temp, 'w') as _f:
+            _config.write(_f)
+            _f.flush()
+            os.fsync(_f.fileno())
+        self.rotate()
+        os.replace(_temp, CONFIG_PATH)
+        _dir = os.open(os.path.dirname(CONFIG_PATH), os.O_RDONLY)
+        try:
+            os.fsync(_dir)
+        finally:
+            os.close(_dir)
+        debug.write("Saved {} config changes to home.ini".format(len(edits)), 0)
+
+    def rotate(self):
+        """ Shifts the home.old generations and copies the current home.ini to home.old """
+        if self.generations <= 0 or not os.path.isfile(CONFIG_PATH):
+            return
+        for _generation in reversed(range(1, self.generations)):
+            _older = "{}.{}".format(CONFIG_BACKUP_PATH, _generation)
+            _newer = CONFIG_BACKUP_PATH if _generation == 1 else "{}.{}".format(CONFIG_BACKUP_PATH, _generation - 1)
+            if os.path.isfile(_newer):
+                os.replace(_newer, _older)
+        shutil.copy2(CONFIG_PATH, CONFIG_BACKUP_PATH)
+
+
+def get_config_persister(config_lock=None):
+    """ Builds the config persister from the SERVER settings """
+    _config = getConfigHandler().set_section("SERVER")
+    _delay = 1.0
+    _generations = 5
+    if _config.dev_has_option("CONFIG_SAVE_DELAY_SEC"):
+        _delay = max(0, float(_config["CONFIG_SAVE_DELAY_SEC"]))
+    if _config.dev_has_option("CONFIG_GENERATIONS"):
+        _generations = _config.get_value("CONFIG_GENERATIONS", int)
+    return ConfigPersister(_delay, _generations, config_lock)
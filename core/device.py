@@ -2,7 +2,7 @@
 '''
     File name: device.py
     Author: Maxime Bergeron
-    Date last modified: 19/06/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     Main wrapper object for all Homeserver devices. Not a device per-se.
@@ -19,6 +19,8 @@ from threading import Lock
 class device(object):
     def __init__(self, devid):
         self.devid = devid
+        # Called with the devid on any actual state change. Set by the devicemanager
+        self.state_listener = None
         self.description = "N/A"
         self.dryrun = False
         self.success = False
@@ -46,11 +48,28 @@ class device(object):
         self.ignore_global_group = False
         self.retry_delay_on_failure = 0
         self.history_origin = "Unknown"
+        # Recent events, used for the failure checks. Set by the devicemanager
         self.history = deque(maxlen=10)
+        self.history_store = None
+        # Devices sharing a transport are polled with limited concurrency. Defaults to the pseudodevice or type
+        self.poll_transport = None
+        # EnergySeries of the devices reporting their electricity readings
+        self.energy = None
         self.interrupt = Lock()
         self.mandatory_voice_group = None
         self.init_from_config()
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        _changed = getattr(self, "_state", None) != state
+        self._state = state
+        if _changed and self.state_listener is not None:
+            self.state_listener(self.devid)
+
     def init_from_config(self):
         self.config = getConfigHandler().set_section(device=self.devid)
         if self.config.dev_has_option("DESCRIPTION"):
@@ -76,7 +95,7 @@ class device(object):
         if self.config.dev_has_option("STATE_GETTER_MODE"):
             self.state_getter_mode = self.config["STATE_GETTER_MODE"]
         if self.config.dev_has_option("IGNORE_GLOBAL_GROUP"):
-            self.ignore_global_group = self.config["IGNORE_GLOBAL_GROUP"]
+            self.ignore_global_group = self.config.get_value("IGNORE_GLOBAL_GROUP", bool)
         if self.config.dev_has_option("RETRY_DELAY_ON_FAILURE"):
             self.retry_delay_on_failure = self.config.get_value(
                 "RETRY_DELAY_ON_FAILURE", int)
@@ -118,14 +137,12 @@ class device(object):
                     debug.write("Device '{}' set to MANUAL mode."
                                 .format(self.name), 0, self.device_type)
                     self.auto_mode = False
-                    self.history.append(
-                        history("Mode", "Auto => Manual", self.history_origin))
+                    self.add_history("Mode", "Auto => Manual", self.history_origin)
                 if self.reset_mode:
                     if not self.auto_mode:
                         debug.write("Device '{}' set back to AUTO mode."
                                     .format(self.name), 0, self.device_type)
-                        self.history.append(
-                            history("Mode", "Manual => Auto", self.history_origin))
+                        self.add_history("Mode", "Manual => Auto", self.history_origin)
                     self.auto_mode = True
             else:
                 debug.write("Skipping mode evaluation for device '{}'."
@@ -145,8 +162,8 @@ class device(object):
             if self.action_delay != 0:
                 self.last_action_timestamp = time.time()
             if not self.check_last_history_item("State", "{} => {}".format(self.state, self.convert(color))):
-                self.history.append(history("State", "{} => {}".format(
-                    self.state, self.convert(color)), self.history_origin))
+                self.add_history("State", "{} => {}".format(
+                    self.state, self.convert(color)), self.history_origin, self.convert(color))
             if self.dryrun:
                 self.success = True
                 if self.action_delay != 0:
@@ -191,17 +208,16 @@ class device(object):
         return self.state
 
     def get_inferred_group_state(self, dm):
-        _states = []
-        for _cnt, dev in enumerate(dm):
-            if _cnt != self.devid and self.state_inference_group in dm[_cnt].group:
-                _states.append(str(dm[_cnt].state))
-        if all(x == DEVICE_ON for x in _states):
+        _states = [str(dm[_cnt].state) for _cnt in dm.inference_members.get(self.state_inference_group, [])
+                   if _cnt != self.devid]
+        # Inferred members count, for chained inferences
+        if all(x in [DEVICE_ON, DEVICE_INFERRED_ON] for x in _states):
             if self.state not in [DEVICE_ON, DEVICE_INFERRED_ON]:
                 debug.write("Device '{}' actual state inferred as ON from its group state".format(
                     self.name), 0, self.device_type)
                 self.state = DEVICE_INFERRED_ON
                 return DEVICE_INFERRED_ON
-        elif all(x == DEVICE_OFF for x in _states):
+        elif all(x in [DEVICE_OFF, DEVICE_INFERRED_OFF] for x in _states):
             if self.state not in [DEVICE_OFF, DEVICE_INFERRED_OFF]:
                 debug.write("Device '{}' actual state inferred as OFF from its group state".format(
                     self.name), 0, self.device_type)
@@ -211,8 +227,7 @@ class device(object):
 
     def set_state(self, state):
         """ Setter for the actual state """
-        self.history.append(
-            history("State", "{} => {}".format(self.state, state), "Manual"))
+        self.add_history("State", "{} => {}".format(self.state, state), "Manual", state)
         if state in ["0", 0]:
             self.state = DEVICE_OFF
         elif state in ["1", 1]:
@@ -223,8 +238,7 @@ class device(object):
             self.device_type, self.device, self.state), 0, self.device_type)
 
     def lock_unlock_requests(self, is_locked):
-        self.history.append(
-            history("Locked", bool(is_locked), self.history_origin))
+        self.add_history("Locked", bool(is_locked), self.history_origin)
         debug.write("Device '{}' is set to locked = {}."
                     .format(self.name, bool(is_locked)), 0, self.device_type)
         self.request_locked = bool(is_locked)
@@ -260,7 +274,15 @@ class device(object):
                 "'{}' request aborted, falling back to old state.".format(self.name))
         return _f()
 
-    def get_history(self):
+    def add_history(self, element, change, origin, state=None):
+        """ Records an event. state is the new device state for 'State' events """
+        self.history.append(history(element, change, origin))
+        if self.history_store is not None:
+            self.history_store.add(self.devid, element, change, origin, state)
+
+    def get_history(self, count=10):
+        if self.history_store is not None:
+            return self.history_store.get_last(self.devid, count)
         return [str(h) for h in self.history]
 
     def check_last_history_item(self, element, change):
@@ -272,7 +294,7 @@ class device(object):
         return False
 
     def set_failed_history(self):
-        self.history.append(history("Failure", "", self.history_origin))
+        self.add_history("Failure", "", self.history_origin)
 
     def check_for_repeating_failures(self):
         try:
@@ -2,12 +2,13 @@
 '''
     File name: devicemanager.py
     Author: Maxime Bergeron
-    Date last modified: 29/03/2021
+    Date last modified: 19/10/2026
     Python Version: 3.8
 
     The device and modules manager for the homeserver. Not a module per-se
 '''
 import ast
+import copy
 import re
 import time
 import unidecode
@@ -16,15 +17,24 @@ try:
 except ImportError:
     import Queue as queue
 from core.common import *
+from core.configpersister import get_config_persister
 from core.convert import convert_to_web_rgb, convert_color
+from core.history import get_history_store
+from core.statepoller import get_state_poller
+from core.voiceresolver import VoiceResolver
 try:
     from concurrent.futures import ThreadPoolExecutor, TimeoutError
 except ImportError:
     pass
-from threading import Thread, Timer, Lock
+from collections import deque
+from threading import Thread, Timer, Lock, Event, local, current_thread
 
 lock = Lock()
 state_lock = Lock()
+# Devices constructed concurrently at startup
+STARTUP_WORKERS = 8
+# Time given to a module thread to stop before it is restarted
+MODULE_STOP_TIMEOUT = 10
 request_queue = queue.Queue()
 
 
@@ -46,7 +56,7 @@ class ExecutionState():
 class DeviceManager(object):
     """ Methods for instanciating and managing devices """
 
-    def __init__(self, threaded=False, dryrun=False):
+    def __init__(self, threaded=False, dryrun=False, load_modules=True):
         debug.get_set_lock()
         debug.enable_debug()
         self.running = False
@@ -54,6 +64,22 @@ class DeviceManager(object):
         self.config = getConfigHandler()
         self.devices = []
         self.pseudodevices = {}
+        self.pseudodevice_locks = {}
+        self._request_template = None
+        self.voice_resolvers = {}
+        # MODULES list the modules were last loaded from
+        self.module_names = []
+        self.startup_profile = {}
+        _startup = time.monotonic()
+        self.state_listeners = []
+        # Inference groups members and, per device, the devices inferring their state from it
+        self.inference_members = {}
+        self.inference_dependents = {}
+        self.inference_local = local()
+        self.history_store = get_history_store()
+        self.config_lock = Lock()
+        self.config_persister = get_config_persister(self.config_lock)
+        self.config_persister.start()
         debug.write(
             "***********************************************************", 0)
         debug.write(
@@ -67,8 +93,12 @@ class DeviceManager(object):
             "***********************************************************", 0)
         debug.write("", 0)
         self.all_groups = None
+        _start = time.monotonic()
         self.get_devices_list()
-        self.get_modules_list()
+        self.startup_profile["devices"] = time.monotonic() - _start
+        _start = time.monotonic()
+        debug.write("Compiled {} presets".format(len(self.presets)), 0)
+        self.startup_profile["presets"] = time.monotonic() - _start
         self.lastupdate = None
         self.queue = queue.Queue()
         self.scheduled_changes = []
@@ -80,6 +110,12 @@ class DeviceManager(object):
         self.skip_time = False
         self.state_threads = [None] * len(self)
         self.state_pool = None
+        # The modules start while the initial states are fetched. State getters wait for them
+        self.poller = None
+        self.states = [None] * len(self)
+        self.status = {}
+        self.initial_states_ready = Event()
+        _initial_states = None
         if self.dryrun:
             self.states = [DEVICE_OFF] * len(self)
             self.threaded = False
@@ -89,10 +125,39 @@ class DeviceManager(object):
             debug.write("****************************************************************", 0)
             debug.write("", 0)
         else:
-            self.states = self.get_state(_initial_call=True)
+            # Initial states are fetched while the modules start
+            _initial_states = Thread(target=self._fetch_initial_states, name="InitialStates")
+            _initial_states.start()
+        _start = time.monotonic()
+        if load_modules:
+            self.get_modules_list()
+        else:
+            self.modules = []
+        self.startup_profile["modules"] = time.monotonic() - _start
+        if _initial_states is not None:
+            _initial_states.join()
+        if not self.dryrun:
+            self.poller = get_state_poller(self)
+            if self.poller is not None:
+                self.poller.start()
+        self.initial_states_ready.set()
         self.status = self()
         self.running = True
         debug.write("Got initial device states {}".format(self.states), 0)
+        self.startup_profile["total"] = time.monotonic() - _startup
+        self.report_startup_profile()
+
+    def _fetch_initial_states(self):
+        _start = time.monotonic()
+        self.states = self.get_state(_initial_call=True)
+        self.startup_profile["initial states"] = time.monotonic() - _start
+
+    def report_startup_profile(self):
+        _slowest = sorted(self.startup_profile.get("device", {}).items(), key=lambda _item: -_item[1])[:3]
+        debug.write("Startup profile: {} (slowest devices: {})".format(
+            ", ".join("{} {:.2f}s".format(_step, _time) for _step, _time in self.startup_profile.items()
+                      if _step != "device"),
+            ", ".join("{} {:.2f}s".format(self[_devid].name or self[_devid].device, _time) for _devid, _time in _slowest) or "none"), 0)
 
     def __len__(self):
         return len(self.devices)
@@ -149,7 +214,7 @@ class DeviceManager(object):
                 dm_status["roomgroups"] = self.config["WEBSERVER"]["ROOM_GROUPS"]
             dm_status["deviceroom"] = self.room_groups
             dm_status["version"] = VERSION
-            dm_status["history"] = self.history
+            dm_status["failed"] = self.failures
         self.status = dm_status
         return dm_status
 
@@ -302,37 +367,107 @@ class DeviceManager(object):
         return states
 
     @property
-    def history(self):
-        historylist = []
-        for obj in self:
-            historylist.append(obj.get_history())
-        return historylist
+    def request_template(self):
+        """ Initialization data shared by the state requests: length, config, types, groups and presets """
+        if self._request_template is None:
+            _template = (len(self.devices), self.config,
+                         tuple(x.device_type for x in self.devices),
+                         tuple(x.group for x in self.devices))
+            # Presets are compiled with requests initialized from the template without presets
+            self._request_template = _template + (PresetCache(_template + (None,)),)
+        return self._request_template
+
+    @property
+    def presets(self):
+        return self.request_template[4]
+
+    def get_voice_resolver(self, section):
+        """ Voice command resolver of the device groups with the voice settings of a module section """
+        if section not in self.voice_resolvers:
+            self.voice_resolvers[section] = VoiceResolver.from_config(self, section)
+        return self.voice_resolvers[section]
+
+    @property
+    def failures(self):
+        """ Whether the last recorded event of each device is a failure """
+        return [len(obj.history) > 0 and obj.history[-1].element == "Failure" for obj in self]
+
+    def get_device_history(self, devid, count=50, days=7):
+        """ Recent events and daily on-time summary of a device, read from the history store """
+        return {"events": self[devid].get_history(count),
+                "ontime": self.history_store.get_daily_on_time(devid, days)}
+
+    def get_energy(self, devid=None):
+        """ Electricity readings and kWh rollups of the devices reporting them, by devid """
+        _energy = {}
+        for _cnt, _dev in enumerate(self):
+            if _dev.energy is not None and devid in [None, _cnt]:
+                _energy[_cnt] = _dev.energy.summary()
+        return _energy
 
     def get_devices_list(self):
+        """ Instanciates the configured devices, concurrently as their constructors may block on I/O """
+        _classes = []
         i = 0
         while True:
             try:
                 _devtype = self.config.get_device(i, "TYPE")
-                if _devtype in getDevices():
-                    _module = __import__(
-                        "devices." + _devtype)
-                    # TODO Needed twice ? looks unpythonic
-                    _class = getattr(
-                        _module, _devtype)
-                    _class = getattr(
-                        _class, _devtype)
-                    self[i] = _class(i)
-                    if self.dryrun:
-                        self[i].dryrun = True
-                    else:
-                        self.get_and_link_pseudodevice(i)
+                if _devtype in plugins.devices:
+                    # Only the configured drivers get imported
+                    _classes.append((i, plugins.get_device_class(_devtype)))
                 else:
                     debug.write('Unsupported device type {}'
                                 .format(_devtype), 1)
             except KeyError:
-                debug.write('Loaded {} devices'.format(i), 0)
                 break
             i = i + 1
+        self.startup_profile["device"] = {}
+        if len(_classes) > 0:
+            with ThreadPoolExecutor(max_workers=min(STARTUP_WORKERS, len(_classes)),
+                                    thread_name_prefix="DeviceStartup") as _pool:
+                _futures = [_pool.submit(self._create_device, _devid, _class) for _devid, _class in _classes]
+                for (_devid, _), _future in zip(_classes, _futures):
+                    self[_devid] = _future.result()
+        debug.write('Loaded {} devices'.format(i), 0)
+        self.build_inference_graph()
+
+    def build_inference_graph(self):
+        """ Maps the state_inference_group devices to the devices they depend on """
+        self.inference_members = {}
+        self.inference_dependents = {}
+        for _cnt, _dev in enumerate(self):
+            if _dev.state_inference_group is None:
+                continue
+            _group = _dev.state_inference_group
+            if _group not in self.inference_members:
+                self.inference_members[_group] = [_member for _member, _mdev in enumerate(self)
+                                                  if _group in _mdev.group]
+            for _member in self.inference_members[_group]:
+                if _member != _cnt:
+                    self.inference_dependents.setdefault(_member, []).append(_cnt)
+
+    def update_inferred_states(self, devid=None):
+        """ Recomputes the inferred states depending on a device, or all of them. Inferred state changes """
+        """ go through the state listeners, so chained inferences are handled breadth-first from here """
+        if devid is None:
+            _dependents = [_cnt for _cnt, _dev in enumerate(self) if _dev.state_inference_group is not None]
+        else:
+            _dependents = self.inference_dependents.get(devid, [])
+        if getattr(self.inference_local, "pending", None) is not None:
+            # Nested change from an inferred state, handled by the running update
+            self.inference_local.pending.extend(_dependents)
+            return
+        self.inference_local.pending = deque(_dependents)
+        _visited = set()
+        try:
+            while self.inference_local.pending:
+                _dependent = self.inference_local.pending.popleft()
+                if _dependent in _visited:
+                    continue
+                _visited.add(_dependent)
+                self[_dependent].get_inferred_group_state(self)
+        finally:
+            self.inference_local.pending = None
 
     def get_modules_list(self, load_single_module=None):
         _config = getConfigHandler()
@@ -347,23 +482,18 @@ class DeviceManager(object):
 
         if load_single_module is None:
             self.modules = []
+            self.module_names = loaded_modules
             for _cnt, _mod in enumerate(loaded_modules):
-                if _mod in getModules():
-                    _module = __import__("modules." + _mod)
-                    # TODO Needed twice ? looks unpythonic
-                    _class = getattr(_module, _mod)
-                    _class = getattr(_class, _mod)
+                if _mod in plugins.modules:
+                    _class = plugins.get_module_class(_mod)
                     self.modules.append(_class(self))
                     self.modules[_cnt].start()
                 else:
                     debug.write('Unsupported module {}'
                                 .format(_mod), 1)
         else:
-            if load_single_module in getModules():
-                _module = __import__("modules." + load_single_module)
-                # TODO Needed twice ? looks unpythonic
-                _class = getattr(_module, load_single_module)
-                _class = getattr(_class, load_single_module)
+            if load_single_module in plugins.modules:
+                _class = plugins.get_module_class(load_single_module)
                 self.modules.append(_class(self))
                 self.modules[-1].start()
 
@@ -429,14 +559,126 @@ class DeviceManager(object):
         return oplist
 
     def reload_configs(self):
-        self.config = getConfigHandler(renew=True)
+        """ Reloads home.ini and applies the changed sections only """
+        # Edits not written yet would be lost
+        self.config_persister.flush()
+        with self.config_lock:
+            _old_config = self.config
+            self.config = getConfigHandler(renew=True)
+            _changes = self.config.get_changes(_old_config)
+            if not _changes:
+                debug.write("No configuration changes to apply", 0)
+                return
+            self.apply_config_changes(_changes)
+
+    def update_config(self, edits):
+        """ Applies (section, option, value) config edits to the running config right away. """
+        """ home.ini is written in the background """
+        _changes = {}
+        with self.config_lock:
+            for _section, _option, _value in edits:
+                if not self.config.has_section(_section):
+                    self.config.add_section(_section)
+                if not self.config.has_option(_section, _option) or self.config.get(
+                        _section, _option, raw=True) != _value:
+                    self.config.set(_section, _option, _value)
+                    _changes.setdefault(_section, set()).add(_option.lower())
+            if _changes:
+                self.apply_config_changes(_changes)
+        self.config_persister.update_many(edits)
+
+    def apply_config_changes(self, changes):
+        """ Devices and modules reading the changed options are initialized again, the others keep running """
+        debug.write("Applying configuration changes in {}".format(", ".join(sorted(changes))), 0)
+        _devices_changed = False
+        _sections = {"DEVICE" + str(_cnt) for _cnt in range(len(self))}
+        for _section in changes:
+            if _section.startswith("DEVICE") and (_section not in _sections or not self.config.has_section(_section)):
+                debug.write("Device section {} added or removed. Restart the server to apply it.".format(
+                    _section), 3)
         for _dev in self:
+            _section = "DEVICE" + str(_dev.devid)
+            if _section not in changes or not self.config.has_section(_section):
+                continue
+            if "type" in changes[_section]:
+                debug.write("Device type of {} changed. Restart the server to apply it.".format(_section), 3)
+                continue
+            _devices_changed = True
             try:
                 _dev.init_from_config()
             except NameError:
                 pass
-        self.shutdown_modules()
-        self.get_modules_list()
+        if _devices_changed:
+            self.all_groups = None
+            self.build_inference_graph()
+            self.update_inferred_states()
+        if _devices_changed or "voice_aliases" in changes.get("SERVER", set()):
+            self.voice_resolvers = {}
+        else:
+            for _section in changes:
+                self.voice_resolvers.pop(_section, None)
+        if _devices_changed or "PRESETS" in changes or "TCP-PRESETS" in changes:
+            # Requests already built keep the presets they were initialized with
+            self._request_template = None
+            debug.write("Compiled {} presets".format(len(self.presets)), 0)
+        self.reload_modules(changes)
+
+    def reload_modules(self, changes):
+        """ Starts and stops the modules added to or removed from the MODULES list. Modules reading changed """
+        """ options are restarted, or initialized again when all of them are in their LIVE_CONFIG """
+        _names = self.config['SERVER']['MODULES'].split(",")
+        # Voice aliases are applied by dropping the cached voice resolvers
+        _server_options = set(changes.get("SERVER", set())) - {"modules", "voice_aliases"}
+        for _mod in list(self.modules):
+            _name = _mod.__class__.__name__
+            if _name not in _names:
+                debug.write("Stopping module {}".format(_name), 0)
+                _mod.stop()
+                self.modules.remove(_mod)
+                continue
+            # Config options read by the module per section, None for the whole section
+            _config_sections = getattr(_mod, "CONFIG_SECTIONS", {_name.upper(): None, "SERVER": None})
+            _live_config = getattr(_mod, "LIVE_CONFIG", {})
+            _affected = False
+            _restart = False
+            for _section, _options in changes.items():
+                if _section not in _config_sections:
+                    continue
+                if _config_sections[_section] is not None:
+                    _options = _options & {_option.lower() for _option in _config_sections[_section]}
+                if _section == "SERVER":
+                    _options = _options - {"modules"}
+                    _server_options -= _options
+                if not _options:
+                    continue
+                _affected = True
+                _live = _live_config.get(_section, ())
+                if _live is not None and not _options.issubset({_option.lower() for _option in _live}):
+                    _restart = True
+            if _restart:
+                debug.write("Restarting module {}".format(_name), 0)
+                self.restart_module(_mod)
+            elif _affected:
+                debug.write("Applying configuration changes to module {}".format(_name), 0)
+                _mod.init_from_config()
+        # Modules stopped by timesched outside of their RUN_TIME are not listed as running
+        _running = [_mod.__class__.__name__ for _mod in self.modules]
+        for _name in _names:
+            if _name not in self.module_names and _name not in _running:
+                debug.write("Starting module {}".format(_name), 0)
+                self.get_modules_list(load_single_module=_name)
+        self.module_names = _names
+        if _server_options:
+            debug.write("SERVER options {} apply on the next server restart".format(
+                ", ".join(sorted(_server_options)).upper()), 3)
+
+    def restart_module(self, module):
+        _index = self.modules.index(module)
+        module.stop()
+        if module is not current_thread():
+            module.join(MODULE_STOP_TIMEOUT)
+        self.modules[_index] = module.__class__(self)
+        self.modules[_index].start()
 
     def shutdown_modules(self, remove_single_module=None):
         if remove_single_module is None:
@@ -458,6 +700,8 @@ class DeviceManager(object):
     def get_state(self, devid=None, is_async=False, webcolors=False, 
                   _for_state_change=False, _initial_call=False):
         """ Getter for configured devices actual colors """
+        if not _initial_call:
+            self.initial_states_ready.wait()
         if state_lock.locked() and devid is None:
             # There's most likely another SYNC state getter running
             is_async = True
@@ -468,19 +712,22 @@ class DeviceManager(object):
         with state_lock:
             old_states = [None] * len(self)
             states = [None] * len(self)
-            if self.threaded:
-                max_workers = len(self)
+            # The initial fetch is always concurrent
+            _pooled = (self.threaded or _initial_call) and devid is None
+            if _pooled:
+                max_workers = max(1, len(self))
                 self.state_pool = ThreadPoolExecutor(max_workers=max_workers)
             for _cnt, dev in enumerate(self):
                 if devid is not None and devid != _cnt:
                     continue
-                if is_async and dev.state_getter_mode != "always" and dev.state != DEVICE_STANDBY:
+                # The background poller keeps the cached states fresh
+                if is_async and (dev.state_getter_mode != "always" or self.poller is not None) and dev.state != DEVICE_STANDBY:
                     states[_cnt] = dev.state
                 else:
                     old_states[_cnt] = dev.state
 
                     if dev.state_getter_mode in ["always","normal"] or (dev.state_getter_mode == "init" and _initial_call):
-                        if self.threaded and devid is None:
+                        if _pooled:
                             self.state_threads[_cnt] = self.state_pool.submit(dev.get_state_pre)
                         else:
                             states[_cnt] = dev.get_state_pre()
@@ -490,24 +737,24 @@ class DeviceManager(object):
             for _cnt, dev in enumerate(self):
                 if devid is not None and devid != _cnt:
                     continue
-                if (not is_async or dev.state_getter_mode == "always") or not self.dryrun:
+                if old_states[_cnt] is not None and ((not is_async or dev.state_getter_mode == "always") or not self.dryrun):
                     if dev.state_getter_mode in ["always","normal"] or (dev.state_getter_mode == "init" and _initial_call):
-                        if self.threaded:
+                        if _pooled:
                             states[_cnt] = self.state_threads[_cnt].result()
-                        if old_states[_cnt] is not None and states[_cnt] is not None:
-                            if dev.convert(old_states[_cnt]) != dev.convert(states[_cnt]) and DEVICE_STANDBY not in [old_states[_cnt], states[_cnt]] and not _initial_call and DEVICE_DISABLED not in [old_states[_cnt], states[_cnt]]:
-                                debug.write("Device {} state changed ({} -> {}) without involvement of the Homeserver. Consider as a MANUAL change".format(dev.name, old_states[_cnt], states[_cnt]), 0)
-                                dev.auto_mode = False
+                        if not _initial_call:
+                            self.check_external_change(dev, old_states[_cnt], states[_cnt])
 
                 if webcolors:
                     states[_cnt] = convert_to_web_rgb(states[_cnt], dev.color_type, dev.color_brightness)
 
+            if _initial_call:
+                self.update_inferred_states()
             for _cnt, dev in enumerate(self):
-                # Has to be called after device states all updated ? Only relevant on non-async requests ?
-                if self[_cnt].state_inference_group is not None:
-                    states[_cnt] = self[_cnt].get_inferred_group_state(self)
+                if dev.state_inference_group is not None:
+                    # Kept up to date by update_inferred_states on every member state change
+                    states[_cnt] = dev.state
 
-        if self.threaded and not self.dryrun:
+        if _pooled:
             self.state_pool.shutdown()
 
         if _for_state_change:
@@ -518,15 +765,68 @@ class DeviceManager(object):
 
         return states
 
+    @staticmethod
+    def check_external_change(dev, old_state, new_state):
+        """ Sets the device in MANUAL mode if its state changed outside of the Homeserver """
+        if old_state is None or new_state is None or DEVICE_STANDBY in [old_state, new_state] or \
+                DEVICE_DISABLED in [old_state, new_state]:
+            return False
+        if dev.convert(old_state) != dev.convert(new_state):
+            debug.write("Device {} state changed ({} -> {}) without involvement of the Homeserver. Consider as a MANUAL change",
+                        0, args=(dev.name, old_state, new_state))
+            dev.auto_mode = False
+            return True
+        return False
+
+    def poll_state(self, devid):
+        """ Refreshes a device state for the background poller. Returns True on an external change, None when skipped """
+        if lock.locked():
+            # A state change is running
+            return None
+        dev = self[devid]
+        _old_state = dev.state
+        _state = dev.get_state_pre()
+        if lock.locked():
+            return None
+        return self.check_external_change(dev, _old_state, _state)
+
     def get_intensity(self):
         intensity = [None] * len(self)
         for _cnt, dev in enumerate(self):
-            if self[_cnt].color_type in ["argb", "rgb", "255"]:
-                intensity[_cnt] = convert_color(dev.state, "100")
-            else:
-                intensity[_cnt] = "null"
+            intensity[_cnt] = self.get_device_intensity(dev)
         return intensity
 
+    @staticmethod
+    def get_device_intensity(dev):
+        if dev.color_type in ["argb", "rgb", "255"]:
+            return convert_color(dev.state, "100")
+        return "null"
+
+    def get_web_state(self, devid):
+        """ Cached web state of a single device, without running its state getter """
+        dev = self[devid]
+        return {"state": convert_to_web_rgb(dev.state, dev.color_type, dev.color_brightness),
+                "intensity": self.get_device_intensity(dev)}
+
+    def add_state_listener(self, callback):
+        """ Registers a callback(devid) called on every device state change """
+        if callback not in self.state_listeners:
+            self.state_listeners.append(callback)
+
+    def remove_state_listener(self, callback):
+        if callback in self.state_listeners:
+            self.state_listeners.remove(callback)
+
+    def _notify_state_change(self, devid):
+        if devid is None or devid in self.inference_dependents:
+            self.update_inferred_states(devid)
+        for _callback in list(self.state_listeners):
+            try:
+                _callback(devid)
+            except Exception as ex:
+                debug.write("State listener failed for device {}: {}".format(
+                    devid, ex), 1)
+
 
     def clean_delayed_changes(self):
         for _sched in self.scheduled_changes:
@@ -552,15 +852,31 @@ class DeviceManager(object):
             self[i].post_run()
             i += 1
 
-    def get_and_link_pseudodevice(self, devid):
+    def _create_device(self, devid, device_class):
+        _start = time.monotonic()
+        _dev = device_class(devid)
+        _dev.state_listener = self._notify_state_change
+        _dev.history_store = self.history_store
+        if self.dryrun:
+            _dev.dryrun = True
+        else:
+            self.get_and_link_pseudodevice(devid, _dev)
+        self.startup_profile["device"][devid] = time.monotonic() - _start
+        return _dev
+
+    def get_and_link_pseudodevice(self, devid, dev=None):
         if self.dryrun:
             return
-        _pseudodev = self.devices[devid].has_pseudodevice
+        if dev is None:
+            dev = self[devid]
+        _pseudodev = dev.has_pseudodevice
         if _pseudodev is not None:
-            if _pseudodev not in self.pseudodevices:
-                self.pseudodevices[_pseudodev] = self[devid].create_pseudodevice(
-                )
-            self[devid].get_pseudodevice(
+            # Devices sharing a pseudodevice wait for the first one to create it
+            with self.pseudodevice_locks.setdefault(_pseudodev, Lock()):
+                if _pseudodev not in self.pseudodevices:
+                    self.pseudodevices[_pseudodev] = dev.create_pseudodevice(
+                    )
+            dev.get_pseudodevice(
                 self.pseudodevices[_pseudodev])
 
     def disconnect_devices(self):
@@ -656,12 +972,8 @@ class DeviceManager(object):
                             self.states[i] = self.get_state(
                                 devid=i, _for_state_change=True)
                             if _color != self.states[i] or _color == DEVICE_OFF:
-                                debug.write(("Device '{}', change {} => "
-                                             "{} (Automatic mode: {})")
-                                            .format(self[i].name,
-                                                    self.states[i], _color,
-                                                    self[i].auto_mode),
-                                            0)
+                                debug.write("Device '{}', change {} => {} (Automatic mode: {})", 0,
+                                            args=(self[i].name, self.states[i], _color, self[i].auto_mode))
                                 if self.threaded:
                                     if not self.queue.empty():
                                         break
@@ -736,7 +1048,7 @@ class DeviceManager(object):
             pass
 
         finally:
-            debug.write("State getters: {}".format(scheduled_getters), 1)
+            debug.write("State getters: {}", 1, args=(dict(scheduled_getters),))
             debug.write("Clearing up device change queues", 0)
             if colors:
                 self.queue.task_done()
@@ -775,7 +1087,7 @@ class DeviceManager(object):
         delayed_req.set(history_origin="Scheduler")
         delayed_req.from_request(old_request)
         delayed_req.set_colors(colors)
-        debug.write("Scheduling device state change ({}) after {} seconds".format(colors, delay), 0)
+        debug.write("Scheduling device state change ({}) after {} seconds", 0, args=(list(colors), delay))
         _sched = Timer(int(delay), delayed_req.run, ())
         _sched.start()
         self.scheduled_changes.append(_sched)
@@ -783,6 +1095,18 @@ class DeviceManager(object):
 
 class StateRequestObject(object):
     """ Methods for properly handling devicemanager state change requests """
+    __slots__ = ('hexvalues', 'group', 'off', 'on', 'restart', 'toggle', 'notime', 'delay', 'preset',
+                 'manual_mode', 'set_mode_for_devid', 'reset_location_data', 'history_origin',
+                 'changed_vars', 'client', 'length', 'config', 'device_types', 'device_groups',
+                 'device_args', 'colors', 'skip_time', 'device_type', 'device_type_args', 'auto_mode',
+                 'reset_mode', 'force_auto_mode', 'debug_wait', 'presets')
+    # Options copied by from_request. State values, presets and initialization data are not
+    OPTION_KEYS = ('group', 'off', 'on', 'restart', 'toggle', 'client', 'notime', 'delay',
+                   'manual_mode', 'reset_location_data', 'force_auto_mode', 'auto_mode',
+                   'reset_mode', 'skip_time', 'set_mode_for_devid', 'history_origin')
+    # Values a preset can change, stored in the compiled presets
+    PRESET_KEYS = tuple(_key for _key in OPTION_KEYS if _key != 'client') + \
+        ('hexvalues', 'device_args', 'device_type', 'device_type_args')
 
     def __init__(self, **kwargs):
         self.hexvalues = []
@@ -799,12 +1123,18 @@ class StateRequestObject(object):
         self.reset_location_data = False
         self.history_origin = "Unknown"
         self.changed_vars = {}
+        # Set by command-line clients, which are initialized from the config file
+        self.client = None
 
         """ Initialization data """
         self.length = 0
         self.config = None
         self.device_types = []
         self.device_groups = []
+        # Requested states per lowercase device type
+        self.device_args = {}
+        # Compiled presets of the devicemanager
+        self.presets = None
 
         """ Vars for the completed request, used by the devicemanager directly """
         self.colors = None
@@ -815,7 +1145,8 @@ class StateRequestObject(object):
         self.reset_mode = False
         self.force_auto_mode = False
         self.debug_wait = []
-        self.set(**kwargs)
+        if kwargs:
+            self.set(**kwargs)
 
     def __call__(self):
         self.run()
@@ -849,33 +1180,47 @@ class StateRequestObject(object):
             raise ValueError
         self.colors[position] = color
 
-    def __setattr__(self, name, value):
-        ''' Checks for collisions or undefined behaviour in variable settings '''
-        if value not in [None, 0, [], {}, "Unknown"] and name not in ['dm', 'length', 'config'] and self.check_for_initialization():
-            if name == "hexvalues" and len(value) != self.length:
-                debug.write("Got {} color hexvalues, {} expected. Use '{} -h' for help. Skipping".format(
-                    len(value), self.length, sys.argv[0]), 2)
-                return
-            if name == "preset" and not dm.config.has_option("PRESETS", value):
-                debug.write(
-                    "Preset '{}' not found in home.ini. Skipping.".format(value), 3)
-                return
-            if name == "set_mode_for_devid" and value > self.length:
-                debug.write(
-                    "Devid {} does not exist. Skipping".format(value), 3)
-                return
+    def __getstate__(self):
+        return {_slot: getattr(self, _slot) for _slot in self.__slots__}
 
-        super().__setattr__(name, value)
+    def __setstate__(self, state):
+        for _slot, _value in state.items():
+            setattr(self, _slot, _value)
+
+    def validate(self):
+        """ Checks the request consistency before its execution """
+        if not self.check_for_initialization():
+            return False
+        if self.colors is None or len(self.colors) != self.length:
+            debug.write("Got {} states, {} expected. Skipping request".format(
+                len(self.colors or []), self.length), 1)
+            return False
+        if self.set_mode_for_devid is not None and not 0 <= int(self.set_mode_for_devid) < self.length:
+            debug.write(
+                "Devid {} does not exist. Skipping request".format(self.set_mode_for_devid), 3)
+            return False
+        if self.preset is not None and not self.config.has_option("PRESETS", self.preset):
+            debug.write(
+                "Preset '{}' not found in home.ini. Skipping request.".format(self.preset), 3)
+            return False
+        return True
+
+    def clone(self):
+        """ Copy of the request. Only the per-device containers are copied """
+        _copy = StateRequestObject.__new__(StateRequestObject)
+        for _slot in self.__slots__:
+            setattr(_copy, _slot, getattr(self, _slot))
+        if self.colors is not None:
+            _copy.colors = list(self.colors)
+        _copy.hexvalues = list(self.hexvalues)
+        _copy.changed_vars = dict(self.changed_vars)
+        _copy.device_args = dict(self.device_args)
+        _copy.debug_wait = list(self.debug_wait)
+        return _copy
 
     def set(self, **kwargs):
-        allowed_keys = ['hexvalues', 'off', 'on', 'restart', 'toggle', 'group',
-                        'client', 'notime', 'delay', 'preset', 'manual_mode',
-                        'reset_location_data', 'force_auto_mode', 'auto_mode',
-                        'reset_mode', 'skip_time', 'set_mode_for_devid',
-                        'history_origin']
+        allowed_keys = plugins.request_keys
         ignored_keys = ['nowait', 'update', 'init_from', 'configure']
-        for _dev in getDevices(True):
-            allowed_keys.append(_dev)
         for k, v in kwargs.items():
             k = k.replace("-", "_")
             if k in ignored_keys:
@@ -920,17 +1265,16 @@ class StateRequestObject(object):
                     if _color != DEVICE_SKIP:
                         self.colors[_pos] = DEVICE_TOGGLE
 
-            for _dev in getDevices(True):
-                if k == _dev and v is not None:
-                    self.debug_wait.append("Received {} change request".format(_dev.capitalize()))
-                    self.set_typed_colors(_dev.capitalize(), v, self)
+            if k in plugins.device_aliases and v is not None:
+                self.debug_wait.append("Received {} change request".format(plugins.device_aliases[k]))
+                self.set_typed_colors(plugins.device_aliases[k], v, self)
 
             if k == "group" and v is not None:
                 self.get_group(v)
             if k == "preset" and v is not None:
                 self.get_preset(v)
             if k not in ['client', 'history_origin']:
-                if k in getDevices(True):
+                if k in plugins.device_aliases:
                     if v is not None:
                         self.changed_vars[k] = v
                         continue
@@ -938,8 +1282,11 @@ class StateRequestObject(object):
                     self.changed_vars[k] = v
                     continue
 
-        self.__dict__.update((k, v)
-                             for k, v in kwargs.items() if k in allowed_keys)
+        for k, v in kwargs.items():
+            if k in plugins.device_aliases:
+                self.device_args[k] = v
+            elif k in allowed_keys:
+                setattr(self, k, v)
         return True
 
     def from_request(self, request):
@@ -948,12 +1295,11 @@ class StateRequestObject(object):
         options and parameters not related to requested state
         values
         '''
-        ignore_vars = ['devices', 'changed_vars', 'dm', 'hexvalues',
-                       'length', 'devices', 'colors', 'preset', 
-                       'init_from']
-        for k, v in request.__dict__.items():
-            if k not in ignore_vars and k not in getDevices(True):
-                self.set(**{k: v})
+        for k in self.OPTION_KEYS:
+            v = getattr(request, k)
+            if k not in ['client', 'history_origin'] and getattr(self, k) != v:
+                self.changed_vars[k] = v
+            setattr(self, k, v)
 
     def from_string(self, json_str):
         if json_str is None or json_str == "":
@@ -984,19 +1330,17 @@ class StateRequestObject(object):
             if _arg not in first_run and _arg not in second_run:
                 if getattr(self, _arg, False) != vars(args)[_arg]:
                     self.set(**{ k:v for k,v in vars(args).items() if _arg in k })
-        for _dev in getDevices(True):
-            if type(getattr(self, _dev, None)) == "str":
+        for _dev, _args in self.device_args.items():
+            if type(_args) == "str":
                 debug.write(
                     'Converting values to lists for {}'.format(_dev), 0)
-                setattr(self, _dev, str(
-                    getattr(self, _dev, None).replace("'", "").split(',')))
+                self.device_args[_dev] = str(_args.replace("'", "").split(','))
 
-    def initialize(self, dm=None, config=None):
+    def initialize(self, dm=None, config=None, template=None):
         if dm is not None:
-            self.length = len(dm.devices)
-            self.config = dm.config
-            self.device_types = [x.device_type for x in dm.devices]
-            self.device_groups = [x.group for x in dm.devices]
+            template = dm.request_template
+        if template is not None:
+            self.length, self.config, self.device_types, self.device_groups, self.presets = template
             if self.colors is None:
                 self.colors = [DEVICE_SKIP] * int(self.length)
             return True
@@ -1070,7 +1414,7 @@ class StateRequestObject(object):
         return True
 
     def check_for_initialization(self):
-        if (self.length is None or self.config is None) and not hasattr(self, 'client'):
+        if (self.length is None or self.config is None) and self.client is None:
             debug.write(
                 "ERROR - You need to initialize the request using initialize() or initialize_dm() first", 2)
             return False
@@ -1099,11 +1443,28 @@ class StateRequestObject(object):
         if self.check_for_initialization():
             self.debug_wait.append(
                 "Received change to preset [{}] request".format(preset))
-            if not self.from_string(self.config["PRESETS"][preset]):
+            if not self.apply_preset(preset):
                 debug.write("Preset does not exist. Ignoring", 1)
                 return False
             self.auto_mode = self.config["PRESETS"].getboolean("AUTOMATIC_MODE")
 
+    def apply_preset(self, preset, section="PRESETS"):
+        """ Applies a preset from the compiled presets, or by evaluating its string when it is not compiled """
+        _compiled = None
+        if self.presets is not None:
+            _compiled = self.presets.get(preset, section)
+        if _compiled is None or any(_color != DEVICE_SKIP for _color in self.colors):
+            # States already requested, the preset applies over them
+            if not self.config.has_section(section):
+                return False
+            return self.from_string(self.config[section].get(preset))
+        self.colors = list(_compiled.colors)
+        for _key, _value in _compiled.options:
+            setattr(self, _key, copy.copy(_value))
+        self.changed_vars.update(_compiled.changed_vars)
+        self.debug_wait.extend(_compiled.debug_wait)
+        return True
+
     def _initialize_from_config(self):
         i = 0
         while True:
@@ -1113,7 +1474,7 @@ class StateRequestObject(object):
                     _devgroup = self.config.get_device(i, "GROUP")
                 except KeyError:
                     _devgroup = None
-                if _devtype in getDevices():
+                if _devtype in plugins.devices:
                     self.device_types.append(_devtype)
                     try:
                         self.device_groups.append(_devgroup.split(","))
@@ -1128,6 +1489,56 @@ class StateRequestObject(object):
             i = i + 1
 
 
+class CompiledPreset(object):
+    """ Preset evaluated once: its device states, request options and description """
+    __slots__ = ('name', 'source', 'colors', 'options', 'changed_vars', 'debug_wait', 'description')
+
+    def __init__(self, name, source, request):
+        self.name = name
+        self.source = source
+        self.colors = tuple(request.colors)
+        _default = StateRequestObject()
+        self.options = tuple((_key, getattr(request, _key)) for _key in StateRequestObject.PRESET_KEYS
+                             if getattr(request, _key) != getattr(_default, _key))
+        self.changed_vars = tuple(request.changed_vars.items())
+        self.debug_wait = tuple(request.debug_wait)
+        self.description = str(request)
+
+
+class PresetCache(object):
+    """ Compiled presets of the config file, per section. Built again on config reloads """
+    SECTIONS = ("PRESETS", "TCP-PRESETS")
+
+    def __init__(self, template):
+        """ template is the devicemanager request template, without presets """
+        _config = template[1]
+        self.presets = {}
+        for _section in self.SECTIONS:
+            self.presets[_section] = {}
+            if not _config.has_section(_section):
+                continue
+            for _name, _source in _config[_section].items():
+                if _name == "automatic_mode":
+                    continue
+                _req = StateRequestObject()
+                _req.initialize(template=template)
+                if _req.from_string(_source):
+                    self.presets[_section][_name] = CompiledPreset(_name, _source, _req)
+                else:
+                    debug.write("Could not compile {} preset '{}'".format(_section, _name), 1)
+
+    def __len__(self):
+        return sum(len(_presets) for _presets in self.presets.values())
+
+    def get(self, preset, section="PRESETS"):
+        """ Compiled preset, None if it is not configured or could not be compiled """
+        return self.presets.get(section, {}).get(str(preset).lower())
+
+    def items(self, section="PRESETS"):
+        """ Compiled presets of a section, in the config file order """
+        return list(self.presets.get(section, {}).values())
+
+
 class RequestExecutor(object):
     """ This will connect all threads with the DM on the main thread """
 
@@ -1150,6 +1561,9 @@ class RequestExecutor(object):
             dm.scheduled_disconnect = None
         if not request.check_for_initialization():
             request.initialize_dm(dm)
+        if not request.validate():
+            ExecutionState().set(False)
+            return
         dm.clean_delayed_changes()
         dm.set_history_origin(request.history_origin)
 
@@ -1158,12 +1572,11 @@ class RequestExecutor(object):
         dm.skip_time = request.skip_time
 
         if request.set_mode_for_devid is not None:
-            debug.write("Received mode change request for devid {}".format(
-                request.set_mode_for_devid), 0)
+            debug.write("Received mode change request for devid {}", 0, args=(request.set_mode_for_devid,))
 
         if request.reset_location_data:
-            # TODO eventually add training data cleanup
-            os.remove("../dnn/train.log")
+            from dnn.roomclassifier import get_room_locator
+            get_room_locator().reset()
             debug.write("Purged location and RTT data", 0)
 
         dm.set_mode(request)
@@ -1174,14 +1587,13 @@ class RequestExecutor(object):
 
         if request.delay is not 0:
             delay = request.delay
-            debug.write(
-                "Delaying request for {} seconds".format(delay), 0)
+            debug.write("Delaying request for {} seconds", 0, args=(delay,))
             request.set(delay=0, preset=None)
             _sched = Timer(int(delay), self.execute, (request, dm,))
             _sched.start()
             dm.scheduled_changes.append(_sched)
             return
-        debug.write("Locked status: {}".format(lock.locked()), 0)
+        debug.write("Locked status: {}", 0, args=(lock.locked(),))
         dm.queue.put(request)
         if not lock.locked():
             Thread(target=dm._set_lights).start()
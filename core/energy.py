@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+'''
+    File name: energy.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Power readings time series with incremental energy rollups. Not a module per-se
+'''
+
+from collections import deque
+from core.common import *
+from threading import Lock
+
+# Bucket length in seconds and number of buckets kept, per rollup
+ENERGY_ROLLUPS = {"minute": (60, 180), "hour": (3600, 72), "day": (86400, 60)}
+# Number of raw readings kept
+ENERGY_SAMPLES = 240
+
+
+class EnergySeries(object):
+    """ Ring buffer of power readings of a device. Energy (Wh) is accumulated in the rollups as readings come in """
+
+    def __init__(self, max_gap=300):
+        # Longest time between two readings still integrated as energy
+        self.max_gap = max_gap
+        self.lock = Lock()
+        self.samples = deque(maxlen=ENERGY_SAMPLES)
+        self.rollups = {_name: deque(maxlen=_count) for _name, (_, _count) in ENERGY_ROLLUPS.items()}
+
+    def add(self, timestamp, power, current):
+        """ Adds a reading, power in W and current in mA """
+        with self.lock:
+            if self.samples:
+                _last_time, _last_power, _ = self.samples[-1]
+                if 0 < timestamp - _last_time <= self.max_gap:
+                    # Trapezoidal integration, split on the bucket boundaries
+                    self._accumulate(_last_time, timestamp, (_last_power + power) / 2)
+            self.samples.append((timestamp, power, current))
+
+    def _accumulate(self, start, end, power):
+        for _name, (_length, _) in ENERGY_ROLLUPS.items():
+            _buckets = self.rollups[_name]
+            _position = start
+            while _position < end:
+                _bucket = _position - _position % _length
+                if _length == 86400:
+                    # Days follow the local time
+                    _bucket = datetime.datetime.combine(
+                        datetime.date.fromtimestamp(_position), datetime.time()).timestamp()
+                _bucket_end = min(end, _bucket + _length)
+                if not _buckets or _buckets[-1][0] != _bucket:
+                    _buckets.append([_bucket, 0.0])
+                _buckets[-1][1] += power * (_bucket_end - _position) / 3600
+                _position = _bucket_end
+
+    def get_last(self, newer_than=0):
+        """ Last (timestamp, power, current) reading, None if there is none newer than a timestamp """
+        with self.lock:
+            if self.samples and self.samples[-1][0] > newer_than:
+                return self.samples[-1]
+        return None
+
+    def summary(self):
+        with self.lock:
+            _summary = {"samples": [list(_sample) for _sample in self.samples]}
+            for _name, _buckets in self.rollups.items():
+                _summary[_name] = [[_start, round(_wh / 1000, 5)] for _start, _wh in _buckets]
+        _summary["unit"] = {"samples": ["s", "W", "mA"], "rollups": ["s", "kWh"]}
+        return _summary
+
+
+def get_energy_sample_interval():
+    """ Seconds between two electricity readings, 0 when sampling is disabled """
+    _config = getConfigHandler().set_section("SERVER")
+    if _config.dev_has_option("ENERGY_SAMPLE_SEC"):
+        return max(0, _config.get_value("ENERGY_SAMPLE_SEC", int))
+    return 60
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+'''
+    File name: history.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Persistent time-series store of the devices state, mode, lock and failure events. Not a module per-se
+'''
+
+import sqlite3
+from core.common import *
+from threading import Thread, Lock, Event
+
+# States counted as OFF for the on-time summaries
+HISTORY_OFF_STATES = [DEVICE_OFF, DEVICE_INFERRED_OFF, "000000", "00000000", "0", "False"]
+# States that say nothing about the device being on or off
+HISTORY_UNKNOWN_STATES = [DEVICE_STANDBY, DEVICE_SKIP, DEVICE_DISABLED, DEVICE_TOGGLE, "None"]
+
+
+class HistoryStore(object):
+    """ SQLite-backed event store. Events are queued and written in batches by a background thread """
+    # Max number of queued events written in a single transaction
+    BATCH_SIZE = 256
+    # Time between two retention purges
+    PURGE_INTERVAL_SEC = 3600
+
+    def __init__(self, path=":memory:", retention_days=90):
+        self.path = path
+        self.retention_days = retention_days
+        self.queue = queue.SimpleQueue()
+        self.db_lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db_lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS events (
+                ts REAL NOT NULL,
+                devid INTEGER NOT NULL,
+                element TEXT NOT NULL,
+                change TEXT,
+                origin TEXT,
+                is_on INTEGER)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS events_devid_ts ON events (devid, ts)")
+            self.db.commit()
+        self.last_purge = 0
+        self.writer = Thread(target=self._write_loop, name="HistoryStore")
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def get_is_on(state):
+        """ 1 if the state means ON, 0 if OFF, None if unknown """
+        state = str(state)
+        if state in HISTORY_UNKNOWN_STATES:
+            return None
+        if state in HISTORY_OFF_STATES:
+            return 0
+        return 1
+
+    def add(self, devid, element, change, origin, state=None, timestamp=None):
+        """ Queues an event. state is the new device state for 'State' events """
+        _is_on = None
+        if state is not None:
+            _is_on = self.get_is_on(state)
+        self.queue.put((timestamp or time.time(), devid, element, str(change), origin, _is_on))
+
+    def flush(self, timeout=2):
+        """ Waits until all the queued events are written """
+        if not self.writer.is_alive():
+            return
+        _done = Event()
+        self.queue.put(_done)
+        _done.wait(timeout)
+
+    def _write_loop(self):
+        while True:
+            _batch = [self.queue.get()]
+            try:
+                while len(_batch) < self.BATCH_SIZE:
+                    _batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            _events = [_item for _item in _batch if not isinstance(_item, Event)]
+            if _events:
+                try:
+                    with self.db_lock:
+                        self.db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", _events)
+                        self.db.commit()
+                except sqlite3.Error as ex:
+                    debug.write("Could not write {} history events: {}".format(
+                        len(_events), ex), 1, "HISTORY")
+            if time.monotonic() - self.last_purge > self.PURGE_INTERVAL_SEC:
+                self.purge()
+            for _item in _batch:
+                if isinstance(_item, Event):
+                    _item.set()
+
+    def purge(self):
+        """ Deletes the events older than the retention period """
+        self.last_purge = time.monotonic()
+        if self.retention_days <= 0:
+            return
+        try:
+            with self.db_lock:
+                _deleted = self.db.execute("DELETE FROM events WHERE ts < ?",
+                                           (time.time() - self.retention_days * 86400,)).rowcount
+                self.db.commit()
+        except sqlite3.Error as ex:
+            debug.write("Could not purge the history events: {}".format(ex), 1, "HISTORY")
+            return
+        if _deleted:
+            debug.write("Purged {} history events older than {} days".format(
+                _deleted, self.retention_days), 0, "HISTORY")
+
+    def get_range(self, devid, start=None, end=None, limit=100):
+        """ Events of a device between two timestamps, newest first """
+        _query = "SELECT ts, element, change, origin FROM events WHERE devid = ? AND ts >= ? AND ts <= ? ORDER BY ts DESC LIMIT ?"
+        with self.db_lock:
+            _rows = self.db.execute(_query, (devid, start or 0, end or time.time(), limit)).fetchall()
+        return [{"time": _ts, "element": _element, "change": _change, "origin": _origin}
+                for _ts, _element, _change, _origin in _rows]
+
+    def get_last(self, devid, count=10):
+        """ Most recent events of a device formatted as strings, oldest first """
+        return [self.format_event(_event) for _event in reversed(self.get_range(devid, limit=count))]
+
+    @staticmethod
+    def format_event(event):
+        return "({}) [{}] {} (Origin: {})".format(
+            datetime.datetime.fromtimestamp(event["time"]).strftime("%Y-%m-%d %H:%M"),
+            event["element"], event["change"], event["origin"])
+
+    def get_daily_on_time(self, devid, days=7):
+        """ Seconds spent ON per local day for the last days, oldest first """
+        _now = time.time()
+        _today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        _days = [_today - datetime.timedelta(days=_day) for _day in reversed(range(days))]
+        _start = _days[0].timestamp()
+        with self.db_lock:
+            # Last known state before the window
+            _initial = self.db.execute(
+                "SELECT is_on FROM events WHERE devid = ? AND ts < ? AND is_on IS NOT NULL ORDER BY ts DESC LIMIT 1",
+                (devid, _start)).fetchone()
+            _changes = self.db.execute(
+                "SELECT ts, is_on FROM events WHERE devid = ? AND ts >= ? AND is_on IS NOT NULL ORDER BY ts",
+                (devid, _start)).fetchall()
+        _bounds = [_day.timestamp() for _day in _days] + [_now]
+        _summary = []
+        _is_on = bool(_initial and _initial[0])
+        _changes = iter(_changes + [(_now, None)])
+        _ts, _next_on = next(_changes)
+        for _cnt, _day in enumerate(_days):
+            _on_time = 0.0
+            _position = _bounds[_cnt]
+            _day_end = _bounds[_cnt + 1]
+            while _ts < _day_end:
+                if _is_on:
+                    _on_time += _ts - _position
+                _position = _ts
+                _is_on = bool(_next_on)
+                _ts, _next_on = next(_changes, (float("inf"), None))
+            if _is_on:
+                _on_time += _day_end - _position
+            _summary.append({"day": _day.strftime("%Y-%m-%d"), "on_seconds": int(_on_time)})
+        return _summary
+
+
+def get_history_store():
+    """ Builds the history store in the journal directory, or in memory when it is not available """
+    _config = getConfigHandler().set_section("SERVER")
+    _retention = 90
+    if _config.dev_has_option("HISTORY_RETENTION_DAYS"):
+        _retention = _config.get_value("HISTORY_RETENTION_DAYS", int)
+    _path = ":memory:"
+    if _config.dev_has_option("JOURNAL_DIR") and os.path.isdir(get_path_from_config(_config["JOURNAL_DIR"])):
+        _path = get_path_from_config(_config["JOURNAL_DIR"]) + "/history.db"
+    else:
+        debug.write("Journal directory not available, device history will not persist", 3, "HISTORY")
+    try:
+        return HistoryStore(_path, _retention)
+    except sqlite3.Error as ex:
+        debug.write("Could not open history database {} ({}). Using memory storage.".format(
+            _path, ex), 1, "HISTORY")
+        return HistoryStore(":memory:", _retention)
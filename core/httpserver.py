@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''
+    File name: httpserver.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Shared HTTP serving layer for the homeserver modules. Not a module per-se
+'''
+
+import socket
+import ssl
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from core.common import *
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Lock, BoundedSemaphore
+
+
+class RequestMetrics(object):
+    """ Thread-safe request time metrics of an HTTP server """
+
+    def __init__(self, window=200):
+        self.lock = Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.active = 0
+        self.recent = deque(maxlen=window)
+
+    def record(self, duration):
+        with self.lock:
+            self.count += 1
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+            self.recent.append(duration)
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self):
+        """ Returns the metrics as a dict, times in milliseconds """
+        with self.lock:
+            _recent = sorted(self.recent)
+            _summary = {
+                "requests": self.count,
+                "errors": self.errors,
+                "active_connections": self.active,
+                "avg_ms": 0.0,
+                "p95_ms": 0.0,
+                "max_ms": round(self.max_time * 1000, 1)
+            }
+            if self.count:
+                _summary["avg_ms"] = round(self.total_time / self.count * 1000, 1)
+            if _recent:
+                _summary["p95_ms"] = round(_recent[int(0.95 * (len(_recent) - 1))] * 1000, 1)
+            return _summary
+
+    def __str__(self):
+        return "{requests} requests ({errors} errors), avg {avg_ms}ms, p95 {p95_ms}ms, max {max_ms}ms".format(
+            **self.summary())
+
+
+class HomeRequestHandler(BaseHTTPRequestHandler):
+    """ Base request handler. Speaks HTTP/1.1 with keep-alive and records request times. """
+    """ Every response must then send a Content-Length header. """
+    protocol_version = "HTTP/1.1"
+
+    def handle_one_request(self):
+        _start = time.monotonic()
+        super().handle_one_request()
+        if self.raw_requestline:
+            self.server.metrics.record(time.monotonic() - _start)
+
+    def send_empty_response(self, code=200):
+        self.send_response(code)
+        self.send_header('Content-type', 'x-www-form-urlencoded')
+        self.send_header('Content-length', 0)
+        self.end_headers()
+
+    def send_bytes(self, content, content_type='x-www-form-urlencoded', code=200):
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class HomeHTTPServer(HTTPServer):
+    """ HTTP(S) server handing connections to a bounded pool of worker threads. """
+    """ TLS handshakes happen in the workers, so a slow client never blocks the accept loop. """
+    allow_reuse_address = True
+
+    def __init__(self, port, handler, name, max_workers=8, keepalive_timeout=5, keyfile=None, certfile=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.keepalive_timeout = keepalive_timeout
+        self.metrics = RequestMetrics()
+        self.state_lock = Lock()
+        self.serving = False
+        self.stopped = False
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        # Accepted connections waiting for a worker are bounded as well
+        self.slots = BoundedSemaphore(max_workers * 2)
+        super().__init__(('', port), handler)
+        if certfile is not None:
+            _context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            _context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            self.socket = _context.wrap_socket(
+                self.socket, server_side=True, do_handshake_on_connect=False)
+
+    def serve_forever(self, poll_interval=0.5):
+        with self.state_lock:
+            if self.stopped:
+                return
+            self.serving = True
+        super().serve_forever(poll_interval)
+
+    def stop(self):
+        """ Stops serve_forever from another thread, even if it was not started yet """
+        with self.state_lock:
+            self.stopped = True
+            if not self.serving:
+                return
+        self.shutdown()
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            # Pool already shut down
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        with self.metrics.lock:
+            self.metrics.active += 1
+        try:
+            request.settimeout(self.keepalive_timeout)
+            if isinstance(request, ssl.SSLSocket):
+                request.do_handshake()
+            self.finish_request(request, client_address)
+        except (socket.timeout, ssl.SSLError, ConnectionError) as ex:
+            debug.write("Dropped connection from {}: {}".format(
+                client_address[0], ex), 0, self.name)
+        except Exception:
+            self.metrics.record_error()
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.metrics.lock:
+                self.metrics.active -= 1
+            self.slots.release()
+
+    def handle_error(self, request, client_address):
+        debug.write("Error while handling request from {}".format(
+            client_address[0]), 1, self.name)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+        debug.write("Served {}".format(self.metrics), 0, self.name)
+
+
+def get_http_server(port, handler, name, keyfile=None, certfile=None):
+    """ Builds a HomeHTTPServer using the SERVER section pool settings """
+    _config = getConfigHandler().set_section("SERVER")
+    _workers = 8
+    if _config.dev_has_option("HTTP_WORKERS"):
+        _workers = max(1, _config.get_value("HTTP_WORKERS", int))
+    _keepalive = 5
+    if _config.dev_has_option("HTTP_KEEPALIVE_SEC"):
+        _keepalive = max(1, _config.get_value("HTTP_KEEPALIVE_SEC", int))
+    return HomeHTTPServer(port, handler, name, max_workers=_workers, keepalive_timeout=_keepalive,
+                          keyfile=keyfile, certfile=certfile)
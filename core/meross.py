@@ -2,19 +2,20 @@
 '''
     File name: Meross.py
     Author: Maxime Bergeron
-    Date last modified: 25/05/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The Meross device handler. Allows connections to Meross Cloud. Not a device per-se.
 '''
 
 from core.common import *
+from core.energy import EnergySeries, get_energy_sample_interval
 from meross_iot.manager import MerossManager
 from meross_iot.api import UnauthorizedException
 from meross_iot.api import TooManyTokensException
 from meross_iot.cloud.exceptions.OfflineDeviceException import OfflineDeviceException
 from meross_iot.cloud.exceptions.CommandTimeoutException import CommandTimeoutException
-from threading import Lock
+from threading import Lock, Thread, Event
 
 
 class Meross(object):
@@ -27,6 +28,12 @@ class Meross(object):
         self.manager = False
         self.disabled = False
         self.connected = False
+        # Electricity-capable devices of this account, sampled in a single cycle
+        self.energy_devices = {}
+        self.energy_lock = Lock()
+        self.energy_interval = get_energy_sample_interval()
+        self.energy_sampler = None
+        self.energy_stop = Event()
         debug.write(
             "Created pseudo-device Meross with account {}.".format(self.email), 0)
 
@@ -69,7 +76,51 @@ class Meross(object):
                     self.email), 1)
                 pass
 
+    def add_energy_device(self, address, meross_dev):
+        """ Registers a device for the background electricity sampling. Returns its EnergySeries """
+        if self.energy_interval == 0:
+            return None
+        with self.energy_lock:
+            if address not in self.energy_devices:
+                self.energy_devices[address] = [meross_dev, EnergySeries(max_gap=self.energy_interval * 3)]
+            else:
+                self.energy_devices[address][0] = meross_dev
+            if self.energy_sampler is None:
+                self.energy_sampler = Thread(target=self._sample_loop, name="MerossEnergy")
+                self.energy_sampler.daemon = True
+                self.energy_sampler.start()
+            return self.energy_devices[address][1]
+
+    def _sample_loop(self):
+        debug.write("Sampling electricity readings of account {} every {} seconds".format(
+            self.email, self.energy_interval), 0, "MEROSS")
+        while not self.energy_stop.wait(self.energy_interval):
+            self.sample_energy()
+
+    def sample_energy(self):
+        """ Reads the electricity of all the registered devices in one cycle """
+        if self.disabled or not self.connected:
+            return
+        with self.energy_lock:
+            _devices = list(self.energy_devices.items())
+        _failed = []
+        for _address, (_dev, _series) in _devices:
+            try:
+                _reading = _dev.get_electricity()
+                _series.add(time.time(), int(_reading['power']) / 1000, int(_reading['current']))
+            except (OfflineDeviceException, CommandTimeoutException, ConnectionError, AttributeError, KeyError, TypeError):
+                _failed.append(_address)
+        if _failed:
+            debug.write("Could not read electricity of {}", 0, "MEROSS", args=(", ".join(_failed),))
+
+    def get_energy(self, address):
+        with self.energy_lock:
+            if address in self.energy_devices:
+                return self.energy_devices[address][1]
+        return None
+
     def disconnect(self):
+        self.energy_stop.set()
         # Still does not play well with disconnects. Use only on server shutdown
         with Meross.meross_lock:
             try:
@@ -2,7 +2,7 @@
 '''
     File name: server.py
     Author: Maxime Bergeron
-    Date last modified: 23/06/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The homeserver request server
@@ -14,6 +14,7 @@ import time
 import traceback
 from core.common import *
 from core.devicemanager import StateRequestObject, ExecutionState
+from dnn.roomclassifier import get_room_locator
 from threading import Thread, Event
 
 
@@ -122,6 +123,11 @@ class HomeServer(Thread):
             send_msg(client, json.dumps(self.dm()))
             return True
 
+        if data == "getenergy":
+            debug.write('Sending electricity readings', 0, "SERVER")
+            send_msg(client, json.dumps(self.dm.get_energy()))
+            return True
+
         if data == "getconfig":
             debug.write("Sending config file to client", 0, "SERVER")
             send_msg(client, self.base_config)
@@ -158,7 +164,7 @@ class HomeServer(Thread):
                 req.set(history_origin="Server (TCP)")
                 if self.config.get_value("AUTOMATIC_MODE", bool, parent="TCP-PRESETS"):
                     req.set(auto_mode=True)
-                if req.from_string(self.config.get_value(data[3:], str, parent="TCP-PRESETS")):
+                if req.apply_preset(data[3:], "TCP-PRESETS"):
                     req.run()
             else:
                 debug.write("TCP preset {} is not configured".format(
@@ -170,20 +176,17 @@ class HomeServer(Thread):
                 client.recv(1024).decode("UTF-8"))
             debug.write('Recording a training location for room: {}'.format(
                 locationData["room"]), 0, "SERVER")
-            with open(self.config['JOURNAL_DIR'] + "/dnn/train.log", "a") as jfile:
-                jfile.write("{},{},{},{},{},{},{}\n".format(locationData["room"], locationData["r1_mean"],
-                                                            locationData["r1_rssi"], locationData["r2_mean"], locationData["r2_rssi"], locationData["r3_mean"], locationData["r3_rssi"]))
+            get_room_locator().add_sample(locationData)
             return True
 
         if data == "getloc":
             ld = json.loads(client.recv(1024).decode("UTF-8"))
             debug.write(
-                '[WIFI-RTT] Evaluating location from:', 0, "SERVER")
-            tf_str = '{},{},{},{},{},{}'.format(
-                ld["r1_mean"], ld["r1_rssi"], ld["r2_mean"], ld["r2_rssi"], ld["r3_mean"], ld["r3_rssi"])
-            debug.write('[WIFI-RTT] {}'.format(tf_str), 0, "SERVER")
-            res = run_tensorflow(
-                TfPredict=True, PredictList=tf_str)
+                '[WIFI-RTT] Evaluating location from: {}'.format(ld), 0, "SERVER")
+            res = get_room_locator().predict(ld)
+            if res is None:
+                debug.write("[WIFI-RTT] No location training data. Send locations first.", 1, "SERVER")
+                res = ""
             debug.write(
                 "[WIFI-RTT] Device found to be in room: {}".format(res), 0, "SERVER")
             client.send(res.encode("UTF-8"))
@@ -216,6 +219,9 @@ class HomeServer(Thread):
         """ Shuts down server and cleans resources """
         debug.write("Closing down server and lights.", 0, "SERVER")
         self.dm.stop_delayed_changes()
+        if self.dm.poller is not None:
+            self.dm.poller.stop()
+        self.dm.config_persister.flush()
         debug.write("Closing remaining connections", 0, "SERVER")
         for _thr in self.conn_sockets:
             if _thr is not None:
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+'''
+    File name: statepoller.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Background device state poller with per-device adaptive intervals. Not a module per-se
+'''
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from core.common import *
+from threading import Thread, Lock, Event, BoundedSemaphore
+
+# Polling interval bounds in seconds, per state_getter_mode. "init" devices are never polled
+POLL_INTERVALS = {"always": (5, 60), "normal": (30, 900)}
+# Concurrent state getters allowed per transport
+TRANSPORT_LIMITS = {"BLE": 1}
+DEFAULT_TRANSPORT_LIMIT = 2
+
+
+class TokenBucket(object):
+    """ Rate limiter allowing rate actions per second, with bursts up to capacity """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def wait_time(self):
+        """ Takes a token. Returns 0 on success, or the time to wait before retrying """
+        with self.lock:
+            _now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (_now - self.last) * self.rate)
+            self.last = _now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class StatePoller(Thread):
+    """ Refreshes the device states in the background. Each device is polled at its own interval, """
+    """ shortened when its state changes outside of the Homeserver and lengthened while it stays stable. """
+
+    def __init__(self, dm, rate=1, workers=4):
+        Thread.__init__(self, name="StatePoller")
+        self.daemon = True
+        self.dm = dm
+        self.bucket = TokenBucket(rate)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="StatePoller")
+        self.stopevent = Event()
+        self.wakeup = Event()
+        self.heap_lock = Lock()
+        self.heap = []
+        self.intervals = {}
+        self.polling = set()
+        self.transports = {}
+        for _cnt, _dev in enumerate(dm):
+            if _dev.state_getter_mode in POLL_INTERVALS:
+                self.intervals[_cnt] = POLL_INTERVALS[_dev.state_getter_mode][0]
+                self.schedule(_cnt, self.intervals[_cnt])
+
+    @staticmethod
+    def get_transport(dev):
+        return dev.poll_transport or dev.has_pseudodevice or dev.device_type
+
+    def get_semaphore(self, dev):
+        _transport = self.get_transport(dev)
+        if _transport not in self.transports:
+            self.transports[_transport] = BoundedSemaphore(
+                TRANSPORT_LIMITS.get(_transport, DEFAULT_TRANSPORT_LIMIT))
+        return self.transports[_transport]
+
+    def schedule(self, devid, delay):
+        with self.heap_lock:
+            heapq.heappush(self.heap, (time.monotonic() + delay, devid))
+        self.wakeup.set()
+
+    def run(self):
+        debug.write("Polling {} device states in the background".format(len(self.intervals)), 0, "STATEPOLLER")
+        while not self.stopevent.is_set():
+            self.wakeup.clear()
+            with self.heap_lock:
+                _delay = self.heap[0][0] - time.monotonic() if self.heap else None
+            if _delay is None or _delay > 0:
+                self.wakeup.wait(_delay)
+                continue
+            _wait = self.bucket.wait_time()
+            if _wait > 0:
+                self.stopevent.wait(_wait)
+                continue
+            with self.heap_lock:
+                _, _devid = heapq.heappop(self.heap)
+            self.submit(_devid)
+
+    def submit(self, devid):
+        _semaphore = self.get_semaphore(self.dm[devid])
+        if devid in self.polling or not _semaphore.acquire(blocking=False):
+            # Transport busy, retry shortly
+            self.schedule(devid, 1)
+            return
+        self.polling.add(devid)
+        try:
+            self.pool.submit(self.poll, devid, _semaphore)
+        except RuntimeError:
+            # Pool already shut down
+            self.polling.discard(devid)
+            _semaphore.release()
+
+    def poll(self, devid, semaphore):
+        if self.dm[devid].state_getter_mode not in POLL_INTERVALS:
+            # Polling disabled by a config reload
+            semaphore.release()
+            self.polling.discard(devid)
+            return
+        _min, _max = POLL_INTERVALS[self.dm[devid].state_getter_mode]
+        try:
+            _changed = self.dm.poll_state(devid)
+        except Exception as ex:
+            debug.write("State polling failed for device {}: {}", 1, "STATEPOLLER", args=(devid, ex))
+            _changed = None
+        finally:
+            semaphore.release()
+            self.polling.discard(devid)
+        if _changed is None:
+            # Busy or failed, keep the interval
+            pass
+        elif _changed:
+            self.intervals[devid] = _min
+        else:
+            self.intervals[devid] = min(_max, self.intervals[devid] * 1.5)
+        if not self.stopevent.is_set():
+            self.schedule(devid, self.intervals[devid])
+
+    def stop(self):
+        self.stopevent.set()
+        self.wakeup.set()
+        self.pool.shutdown(wait=False)
+
+
+def get_state_poller(dm):
+    """ Builds the state poller from the SERVER settings, None when disabled """
+    _config = getConfigHandler().set_section("SERVER")
+    _rate = 1.0
+    if _config.dev_has_option("STATE_POLL_RATE"):
+        _rate = float(_config["STATE_POLL_RATE"])
+    if _rate <= 0:
+        return None
+    return StatePoller(dm, rate=_rate)
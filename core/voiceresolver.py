@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''
+    File name: voiceresolver.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Voice command group resolver shared by the IFTTT and Dialogflow modules. Not a module per-se
+'''
+
+import re
+import unidecode
+from core.common import *
+
+
+class VoiceResolution(object):
+    """ Groups named in a voice command, and whether a priority or the global group was named """
+    __slots__ = ('groups', 'priority', 'is_global')
+
+    def __init__(self):
+        self.groups = []
+        self.priority = False
+        self.is_global = False
+
+
+class VoiceResolver(object):
+    """ Index of the normalized words (without accents, lowercase, singular and plural) naming the """
+    """ device groups, their aliases and the global group. Built once per config load so a command """
+    """ is resolved in one lookup per word """
+
+    def __init__(self, groups, priority_groups=(), global_group=None, aliases=None,
+                 mandatory_groups=None, ignore_global=()):
+        # Words tuple -> [group or None, priority, global]
+        self.index = {}
+        self.max_length = 1
+        self.mandatory_groups = {_devid: self.normalize(_group) for _devid, _group in (mandatory_groups or {}).items()}
+        self.ignore_global = set(ignore_global)
+        _priority = {_variant for _group in priority_groups for _variant in self.get_variants(_group)}
+        _global = set(self.get_variants(global_group)) if global_group else set()
+        _groups = [self.normalize(_group) for _group in groups]
+        # Names to index: name, group named and whether it is the global group
+        _names = [(_group, _group, bool(_global.intersection(self.get_variants(_group)))) for _group in _groups]
+        if global_group and self.normalize(global_group) not in _groups:
+            _names.append((self.normalize(global_group), None, True))
+        for _alias, _target in (aliases or {}).items():
+            _target = self.normalize(_target)
+            _is_global = bool(_global.intersection(self.get_variants(_target)))
+            if _target in _groups or _is_global:
+                _names.append((self.normalize(_alias), _target if _target in _groups else None, _is_global))
+            else:
+                debug.write("Voice alias '{}' names an unknown group '{}'. Ignoring".format(_alias, _target), 1)
+        # Exact names are indexed before the singular/plural variants, which never replace them
+        for _exact in [True, False]:
+            for _name, _group, _is_global in _names:
+                _variants = self.get_variants(_name)
+                for _variant in _variants[:1] if _exact else _variants[1:]:
+                    if _variant in self.index:
+                        continue
+                    _named = [_variant] + (self.get_variants(_group) if _group is not None else [])
+                    self.index[_variant] = [_group, bool(_priority.intersection(_named)), _is_global]
+                    self.max_length = max(self.max_length, len(_variant))
+
+    @staticmethod
+    def normalize(name):
+        return unidecode.unidecode(name).lower().strip()
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"[a-z0-9]+", unidecode.unidecode(text).lower())
+
+    @classmethod
+    def get_variants(cls, name):
+        """ Words of a name, then with the last word in plural or singular form """
+        _words = tuple(cls.tokenize(name))
+        if not _words:
+            return []
+        _last = _words[-1]
+        if _last.endswith("s") and len(_last) > 1:
+            return [_words, _words[:-1] + (_last[:-1],)]
+        return [_words, _words[:-1] + (_last + "s",)]
+
+    @classmethod
+    def from_config(cls, dm, section):
+        """ Resolver of the device groups with the voice settings of a module section """
+        _config = getConfigHandler().set_section(section)
+        _priority = []
+        _global = None
+        _aliases = {}
+        if _config.dev_has_option("PRIORITY_GROUPS") and _config["PRIORITY_GROUPS"] != "":
+            _priority = _config["PRIORITY_GROUPS"].split(",")
+        if _config.dev_has_option("GLOBAL_GROUP") and _config["GLOBAL_GROUP"] != "":
+            _global = _config["GLOBAL_GROUP"]
+        if _config.has_option("SERVER", "VOICE_ALIASES"):
+            for _alias in _config.get_value("VOICE_ALIASES", parent="SERVER").split(","):
+                if ":" in _alias:
+                    _name, _group = _alias.split(":", 1)
+                    _aliases[_name] = _group
+        return cls(dm.all_groups, _priority, _global, _aliases,
+                   {_dev.devid: _dev.mandatory_voice_group for _dev in dm if _dev.mandatory_voice_group},
+                   [_dev.devid for _dev in dm if _dev.ignore_global_group])
+
+    def resolve(self, text):
+        """ Groups named in text, longest names first """
+        _resolution = VoiceResolution()
+        _words = self.tokenize(text)
+        _pos = 0
+        while _pos < len(_words):
+            for _length in range(min(self.max_length, len(_words) - _pos), 0, -1):
+                _entry = self.index.get(tuple(_words[_pos:_pos + _length]))
+                if _entry is not None:
+                    _group, _priority, _global = _entry
+                    if _group is not None and _group not in _resolution.groups:
+                        _resolution.groups.append(_group)
+                    _resolution.priority = _resolution.priority or _priority
+                    _resolution.is_global = _resolution.is_global or _global
+                    _pos += _length
+                    break
+            else:
+                _pos += 1
+        return _resolution
+
+    def apply(self, req, resolution, dm, tag):
+        """ Restricts a state request to the resolved groups. Returns False when no device is named """
+        if resolution.is_global:
+            debug.write("Got global group. Running request on all devices.", 0, tag)
+            for _devid in self.ignore_global:
+                debug.write("Skipping device {} as it ignores global group requests".format(
+                    dm[_devid].name), 0, tag)
+                req.set_color_for_devid(DEVICE_SKIP, _devid)
+            return True
+        if not resolution.groups:
+            return False
+        req.set(group=list(resolution.groups))
+        for _devid, _group in self.mandatory_groups.items():
+            if _group not in resolution.groups and req[_devid] != DEVICE_SKIP:
+                debug.write("Skipping device {} as it requires the mandatory group {}".format(
+                    dm[_devid].name, _group), 0, tag)
+                req.set_color_for_devid(DEVICE_SKIP, _devid)
+        return True
@@ -2,7 +2,7 @@
 '''
     File name: MerossSwitch.py
     Author: Maxime Bergeron
-    Date last modified: 26/05/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The MerossSwitch for Meross Switches handler class
@@ -36,21 +36,19 @@ class MerossSwitch(device):
         """ Checks the request and trigger a light change if needed """
         if not self.meross.disabled and self.state != DEVICE_DISABLED:
             if color == DEVICE_OFF:
-                debug.write(
-                    "Turning device '{}' OFF.".format(self.name), 0, self.device_type)
+                debug.write("Turning device '{}' OFF.", 0, self.device_type, args=(self.name,))
                 self.interruptible(lambda: self.meross_dev.turn_off())
                 self.state = DEVICE_OFF
                 self.success = True
                 return True
             elif color == DEVICE_ON:
-                debug.write(
-                    "Turning device '{}' ON.".format(self.name), 0, self.device_type)
+                debug.write("Turning device '{}' ON.", 0, self.device_type, args=(self.name,))
                 self.interruptible(lambda: self.meross_dev.turn_on())
                 self.state = DEVICE_ON
                 self.success = True
                 return True
-            debug.write("Unknown state {} for device '{}', falling back to OFF."
-                        .format(color, self.name), 0, self.device_type)
+            debug.write("Unknown state {} for device '{}', falling back to OFF.", 0, self.device_type,
+                        args=(color, self.name))
             self.interruptible(lambda: self.meross_dev.turn_off())
             self.state = DEVICE_OFF
         self.expected_state = self.state
@@ -61,8 +59,19 @@ class MerossSwitch(device):
         if not self.meross.disabled:
             try:
                 if self.meross_dev.supports_electricity_reading():
+                    # Background reading taken after the last action, if any. Older readings than two
+                    # sampling cycles mean the sampling failed, the live reading reports offline devices
+                    _reading = None
+                    if self.energy is not None:
+                        _reading = self.energy.get_last(max(self.last_action_timestamp + self.action_delay,
+                                                            time.time() - 2 * self.meross.energy_interval))
+                    if _reading is None:
+                        _electricity = self.meross_dev.get_electricity()
+                        _reading = (time.time(), int(_electricity['power']) / 1000, int(_electricity['current']))
+                        if self.energy is not None:
+                            self.energy.add(*_reading)
                     # TODO Is this the proper limit for ON/OFF ?
-                    if int(self.meross_dev.get_electricity()['current']) > 100:
+                    if _reading[2] > 100:
                         self.state = DEVICE_ON
                     else:
                         self.state = DEVICE_OFF
@@ -113,6 +122,15 @@ class MerossSwitch(device):
         self.meross_dev = self.meross.get_meross_device(self.device)
         if not self.meross_dev:
             self.state = DEVICE_DISABLED
+        else:
+            self.link_energy()
+
+    def link_energy(self):
+        try:
+            if self.meross_dev.supports_electricity_reading():
+                self.energy = self.meross.add_energy_device(self.device, self.meross_dev)
+        except (OfflineDeviceException, CommandTimeoutException):
+            pass
 
     def disconnect(self):
         # Does not work properly - generates too many tokens
@@ -127,3 +145,5 @@ class MerossSwitch(device):
             self.name), 0, self.device_type)
         self.meross.connect()
         self.meross_dev = self.meross.get_meross_device(self.device)
+        if self.meross_dev:
+            self.link_energy()
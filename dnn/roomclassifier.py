@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+'''
+    File name: roomclassifier.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.8
+
+    In-process WiFi-RTT room classifier (k nearest neighbours). The location samples are buffered
+    in a binary sample store and the classifier is retrained in the background. Uses numpy when
+    it is installed
+'''
+
+import heapq
+import json
+import math
+import struct
+import zlib
+from array import array
+from collections import deque
+from core.common import *
+from threading import Thread, Lock, Event
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FEATURES = ['r1_mean', 'r1_rssi', 'r2_mean', 'r2_rssi', 'r3_mean', 'r3_rssi']
+# Newest samples kept per room
+ROOM_SAMPLES = 500
+# Samples kept per room in the sample store
+STORE_SAMPLES = 4 * ROOM_SAMPLES
+MODEL_VERSION = 1
+SAMPLE_STORE_MAGIC = b"HRTTSMP1"
+# One sample out of HOLDOUT_PARTS is kept for the holdout evaluation
+HOLDOUT_PARTS = 5
+
+
+class RoomClassifier(object):
+    """ Distance-weighted k-NN over the standardized RTT and RSSI features """
+
+    def __init__(self, k=5, use_numpy=True):
+        self.k = k
+        self.use_numpy = use_numpy and np is not None
+        self.lock = Lock()
+        self.samples = {}
+        self.dirty = True
+        self.rooms = []
+        self.labels = []
+        self.matrix = []
+        self.mean = [0.0] * len(FEATURES)
+        self.scale = [1.0] * len(FEATURES)
+
+    def __len__(self):
+        return sum(len(_samples) for _samples in self.samples.values())
+
+    @staticmethod
+    def get_features(data):
+        """ Feature vector from a location dict, a CSV string or a sequence """
+        if isinstance(data, dict):
+            return [float(data[_feature]) for _feature in FEATURES]
+        if isinstance(data, str):
+            data = data.split(",")
+        _features = [float(_value) for _value in data]
+        if len(_features) != len(FEATURES):
+            raise ValueError("Expected {} features, got {}".format(len(FEATURES), len(_features)))
+        return _features
+
+    def add_sample(self, room, data):
+        """ Trains the classifier with a sample taken in room """
+        _features = self.get_features(data)
+        with self.lock:
+            if room not in self.samples:
+                self.samples[room] = deque(maxlen=ROOM_SAMPLES)
+            self.samples[room].append(_features)
+            self.dirty = True
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.dirty = True
+
+    def _rebuild(self):
+        """ Standardizes the samples. Runs on the first prediction after new samples """
+        _rows = []
+        self.rooms = list(self.samples)
+        self.labels = []
+        for _index, _room in enumerate(self.rooms):
+            _rows.extend(self.samples[_room])
+            self.labels.extend([_index] * len(self.samples[_room]))
+        if _rows:
+            _count = len(_rows)
+            self.mean = [sum(_column) / _count for _column in zip(*_rows)]
+            self.scale = [(sum((_value - _mean) ** 2 for _value in _column) / _count) ** 0.5 or 1.0
+                          for _column, _mean in zip(zip(*_rows), self.mean)]
+        if self.use_numpy:
+            self.labels = np.array(self.labels, dtype=np.intp)
+            self.matrix = (np.array(_rows, dtype=np.float64).reshape(-1, len(FEATURES)) - self.mean) / self.scale
+        else:
+            self.matrix = [[(_value - _mean) / _scale for _value, _mean, _scale in zip(_row, self.mean, self.scale)]
+                           for _row in _rows]
+        self.dirty = False
+
+    def predict(self, data):
+        """ Most likely room for a location, None when there is no training data """
+        _features = self.get_features(data)
+        with self.lock:
+            if self.dirty:
+                self._rebuild()
+            if len(self.labels) == 0:
+                return None
+            _k = min(self.k, len(self.labels))
+            _votes = [0.0] * len(self.rooms)
+            if self.use_numpy:
+                _distances = np.sqrt(((self.matrix - (np.array(_features) - self.mean) / self.scale) ** 2).sum(axis=1))
+                _nearest = np.argpartition(_distances, _k - 1)[:_k]
+                for _index in _nearest:
+                    _votes[self.labels[_index]] += 1 / (_distances[_index] + 1e-6)
+            else:
+                _point = [(_value - _mean) / _scale for _value, _mean, _scale in zip(_features, self.mean, self.scale)]
+                _nearest = heapq.nsmallest(_k, ((math.dist(_row, _point), _index)
+                                                 for _index, _row in enumerate(self.matrix)))
+                for _distance, _index in _nearest:
+                    _votes[self.labels[_index]] += 1 / (_distance + 1e-6)
+            return self.rooms[_votes.index(max(_votes))]
+
+    def evaluate(self, samples):
+        """ Accuracy report on labelled (room, features) samples, with the rooms mistaken for each room """
+        _report = {"samples": len(samples), "correct": 0, "rooms": {}}
+        for _room, _features in samples:
+            _predicted = self.predict(_features)
+            _stats = _report["rooms"].setdefault(_room, {"samples": 0, "correct": 0, "mistaken_for": {}})
+            _stats["samples"] += 1
+            if _predicted == _room:
+                _stats["correct"] += 1
+                _report["correct"] += 1
+            else:
+                _stats["mistaken_for"][str(_predicted)] = _stats["mistaken_for"].get(str(_predicted), 0) + 1
+        for _stats in [_report] + list(_report["rooms"].values()):
+            _stats["accuracy"] = round(_stats["correct"] / _stats["samples"], 4) if _stats["samples"] else None
+        return _report
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({"version": MODEL_VERSION, "k": self.k, "features": FEATURES,
+                               "samples": {_room: list(_samples) for _room, _samples in self.samples.items()}})
+
+    def save(self, path):
+        """ Writes the model file, replaced atomically """
+        _json = self.to_json()
+        with open(path + ".tmp", "w") as _f:
+            _f.write(_json)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path):
+        """ Loads a model file. Returns False if it is missing or unreadable """
+        try:
+            with open(path, "r") as _f:
+                _model = json.load(_f)
+            if _model.get("version") != MODEL_VERSION or _model.get("features") != FEATURES:
+                debug.write("Unsupported room classifier model {}. Ignoring".format(path), 1, "RTT")
+                return False
+        except (IOError, ValueError) as ex:
+            if os.path.isfile(path):
+                debug.write("Could not load room classifier model {}: {}".format(path, ex), 1, "RTT")
+            return False
+        with self.lock:
+            self.k = _model.get("k", self.k)
+            self.samples = {_room: deque(_samples, maxlen=ROOM_SAMPLES) for _room, _samples in _model["samples"].items()}
+            self.dirty = True
+        return True
+
+
+class SampleStore(object):
+    """ Deduplicated location samples as compact arrays (room index and float32 features), """
+    """ saved to a binary file """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def clear(self):
+        with self.lock:
+            self.rooms = []
+            self.labels = array('H')
+            self.values = array('f')
+            self.keys = set()
+            self.pending = 0
+
+    def add(self, room, features):
+        """ Buffers a sample. Returns False for a duplicate """
+        _values = array('f', features)
+        with self.lock:
+            if room not in self.rooms:
+                self.rooms.append(room)
+            _label = self.rooms.index(room)
+            _key = (_label, _values.tobytes())
+            if _key in self.keys:
+                return False
+            self.keys.add(_key)
+            self.labels.append(_label)
+            self.values.extend(_values)
+            self.pending += 1
+        return True
+
+    def take_samples(self):
+        """ All the (room, features) samples, oldest first. Resets the pending samples count """
+        with self.lock:
+            self.compact()
+            self.pending = 0
+            _count = len(FEATURES)
+            return [(self.rooms[_label], self.values[_index * _count:(_index + 1) * _count].tolist())
+                    for _index, _label in enumerate(self.labels)]
+
+    @staticmethod
+    def is_holdout(room, features):
+        """ Stable split: a sample always stays in the same set across retrains """
+        return zlib.crc32(room.encode("UTF-8") + array('f', features).tobytes()) % HOLDOUT_PARTS == 0
+
+    def compact(self):
+        """ Drops the oldest samples of the rooms over STORE_SAMPLES """
+        _counts = [0] * len(self.rooms)
+        for _label in self.labels:
+            _counts[_label] += 1
+        if max(_counts, default=0) <= STORE_SAMPLES:
+            return
+        _count = len(FEATURES)
+        _labels = array('H')
+        _values = array('f')
+        for _index, _label in enumerate(self.labels):
+            _counts[_label] -= 1
+            if _counts[_label] < STORE_SAMPLES:
+                _labels.append(_label)
+                _values.extend(self.values[_index * _count:(_index + 1) * _count])
+        self.labels = _labels
+        self.values = _values
+        self.keys = {(_label, self.values[_index * _count:(_index + 1) * _count].tobytes())
+                     for _index, _label in enumerate(self.labels)}
+
+    def save(self):
+        """ Writes the store file, replaced atomically """
+        with self.lock:
+            with open(self.path + ".tmp", "wb") as _f:
+                _f.write(SAMPLE_STORE_MAGIC)
+                _f.write(struct.pack("<HII", len(FEATURES), len(self.rooms), len(self.labels)))
+                for _room in self.rooms:
+                    _name = _room.encode("UTF-8")
+                    _f.write(struct.pack("<H", len(_name)) + _name)
+                self.labels.tofile(_f)
+                self.values.tofile(_f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def load(self):
+        """ Loads the store file. Returns False if it is missing or unreadable """
+        try:
+            with open(self.path, "rb") as _f:
+                if _f.read(len(SAMPLE_STORE_MAGIC)) != SAMPLE_STORE_MAGIC:
+                    raise ValueError("not a sample store")
+                _features, _rooms, _count = struct.unpack("<HII", _f.read(10))
+                if _features != len(FEATURES):
+                    raise ValueError("{} features per sample".format(_features))
+                _names = []
+                for _ in range(_rooms):
+                    _names.append(_f.read(struct.unpack("<H", _f.read(2))[0]).decode("UTF-8"))
+                _labels = array('H')
+                _labels.fromfile(_f, _count)
+                _values = array('f')
+                _values.fromfile(_f, _count * _features)
+        except (IOError, EOFError, ValueError, struct.error, UnicodeDecodeError) as ex:
+            if os.path.isfile(self.path):
+                debug.write("Could not load location samples {}: {}".format(self.path, ex), 1, "RTT")
+            return False
+        with self.lock:
+            self.rooms = _names
+            self.labels = _labels
+            self.values = _values
+            self.keys = {(_label, _values[_index * _features:(_index + 1) * _features].tobytes())
+                         for _index, _label in enumerate(_labels)}
+            self.pending = len(_labels)
+        return True
+
+    def load_training_log(self, path):
+        """ Imports a 'room,r1_mean,r1_rssi,r2_mean,r2_rssi,r3_mean,r3_rssi' log. Returns the samples count """
+        _count = 0
+        try:
+            with open(path, "r") as _f:
+                for _line in _f:
+                    _values = _line.strip().split(",")
+                    try:
+                        _count += self.add(_values[0], RoomClassifier.get_features(_values[1:]))
+                    except (ValueError, IndexError):
+                        debug.write("Skipping malformed training line: {}".format(_line.strip()), 1, "RTT")
+        except IOError:
+            pass
+        return _count
+
+
+class RoomLocator(Thread):
+    """ Room classifier of the server. The location samples are buffered in the sample store and a """
+    """ new classifier is trained in the background after retrain_samples new samples or after """
+    """ retrain_interval seconds, evaluated on the holdout samples then swapped with the active one """
+
+    def __init__(self, folder, retrain_samples=20, retrain_interval=600):
+        Thread.__init__(self, name="RoomLocator")
+        self.daemon = True
+        self.folder = folder
+        self.model_path = os.path.join(folder, "model.json")
+        self.report_path = os.path.join(folder, "report.json")
+        self.log_path = os.path.join(folder, "train.log")
+        self.retrain_samples = max(1, retrain_samples)
+        self.retrain_interval = retrain_interval
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.report = None
+        self.store = SampleStore(os.path.join(folder, "samples.bin"))
+        if not self.store.load():
+            _count = self.store.load_training_log(self.log_path)
+            if _count:
+                debug.write("Imported {} logged location samples".format(_count), 0, "RTT")
+        # The last model answers until the background retrain is done
+        self.classifier = RoomClassifier()
+        self.classifier.load(self.model_path)
+        if len(self.store):
+            self.wakeup.set()
+        atexit.register(self.flush)
+
+    def add_sample(self, location):
+        """ Buffers a location dict holding the room and the features. Returns immediately """
+        if not self.store.add(location["room"], RoomClassifier.get_features(location)):
+            debug.write("Ignoring a duplicate location sample for room: {}".format(location["room"]), 0, "RTT")
+        elif self.store.pending >= self.retrain_samples:
+            self.wakeup.set()
+
+    def predict(self, location):
+        return self.classifier.predict(location)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.retrain_interval or None)
+            self.wakeup.clear()
+            if self.store.pending:
+                self.retrain()
+
+    def retrain(self):
+        """ Trains a classifier on the stored samples and swaps it with the active one """
+        with self.lock:
+            _start = time.monotonic()
+            _samples = self.store.take_samples()
+            if not _samples:
+                return
+            _training = RoomClassifier(k=self.classifier.k)
+            _holdout = []
+            for _room, _features in _samples:
+                if self.store.is_holdout(_room, _features):
+                    _holdout.append((_room, _features))
+                else:
+                    _training.add_sample(_room, _features)
+            _report = _training.evaluate(_holdout)
+            _report["training_samples"] = len(_samples) - len(_holdout)
+            _report["date"] = datetime.datetime.now().isoformat(timespec="seconds")
+            # The active classifier also learns from the holdout samples
+            _classifier = RoomClassifier(k=self.classifier.k)
+            for _room, _features in _samples:
+                _classifier.add_sample(_room, _features)
+            _classifier.predict(_samples[0][1])
+            self.classifier = _classifier
+            self.report = _report
+            debug.write("Retrained room classifier on {} samples in {:.0f}ms. Holdout accuracy: {}".format(
+                len(_samples), (time.monotonic() - _start) * 1000,
+                "n/a" if _report["accuracy"] is None else "{:.1%} on {} samples".format(
+                    _report["accuracy"], _report["samples"])), 0, "RTT")
+            try:
+                self.store.save()
+                _classifier.save(self.model_path)
+                with open(self.report_path + ".tmp", "w") as _f:
+                    json.dump(_report, _f, indent=2)
+                os.replace(self.report_path + ".tmp", self.report_path)
+            except IOError as ex:
+                debug.write("Could not save the room classifier: {}".format(ex), 1, "RTT")
+
+    def flush(self):
+        """ Saves the buffered samples """
+        if self.store.pending:
+            try:
+                self.store.save()
+            except IOError as ex:
+                debug.write("Could not save location samples: {}".format(ex), 1, "RTT")
+
+    def reset(self):
+        """ Purges the training data """
+        with self.lock:
+            self.store.clear()
+            self.classifier = RoomClassifier(k=self.classifier.k)
+            self.report = None
+            for _path in [self.model_path, self.report_path, self.store.path, self.log_path]:
+                if os.path.isfile(_path):
+                    os.remove(_path)
+
+
+ROOM_LOCATOR = None
+ROOM_LOCATOR_LOCK = Lock()
+
+
+def get_room_locator():
+    """ Shared room locator, in the dnn folder of the journal directory """
+    global ROOM_LOCATOR
+    with ROOM_LOCATOR_LOCK:
+        if ROOM_LOCATOR is None:
+            _config = getConfigHandler().set_section("SERVER")
+            _folder = get_path_from_config(_config['JOURNAL_DIR']) + "/dnn"
+            os.makedirs(_folder, exist_ok=True)
+            _samples = 20
+            _interval = 600
+            if _config.dev_has_option("LOCATION_RETRAIN_SAMPLES"):
+                _samples = _config.get_value("LOCATION_RETRAIN_SAMPLES", int)
+            if _config.dev_has_option("LOCATION_RETRAIN_SEC"):
+                _interval = max(0, float(_config["LOCATION_RETRAIN_SEC"]))
+            ROOM_LOCATOR = RoomLocator(_folder, _samples, _interval)
+            ROOM_LOCATOR.start()
+    return ROOM_LOCATOR
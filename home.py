@@ -2,7 +2,7 @@
 '''
     File name: home.py
     Author: Maxime Bergeron
-    Date last modified: 21/01/2021
+    Date last modified: 19/10/2026
     Python Version: 3.8
 
     A python home control server/client
@@ -71,7 +71,9 @@ if __name__ == "__main__":
         dm = DeviceManager(threaded=args.threaded, dryrun=args.dry_run)
 
         if HOMECONFIG['SERVER'].getboolean('ENABLE_WIFI_RTT'):
-            from dnn.dnn import run_tensorflow
+            # Loads or trains the room classifier before the first location request
+            from dnn.roomclassifier import get_room_locator
+            get_room_locator()
         if args.notime:
             if dm.has_module("timesched") is not False:
                 dm.get_module("timesched").set_serverwide_skiptime()
@@ -2,35 +2,409 @@
 '''
     File name: backup.py
     Author: Maxime Bergeron
-    Date last modified: 31/01/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     A backup manager/rsync wrapper module for the homeserver
 '''
 
+import json
 import os
 import queue
+import re
 import shlex
+import shutil
 import signal
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
 from core.common import *
 from core.devicemanager import StateRequestObject
 from configparser import NoOptionError
 from datetime import datetime, timedelta
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+
+# rsync exit codes of a complete backup. 24: source files vanished during the transfer
+RSYNC_DONE_CODES = (0, 24)
+# --info=progress2 line: "  1,234,567  45%   1.23MB/s    0:00:12 (xfr#3, to-chk=10/20)"
+RSYNC_PROGRESS = re.compile(rb"^\s*([\d,.]+)\s+(\d+)%\s+(\S+/s)")
+RSYNC_SIZE = re.compile(rb"^Total file size: ([\d,.]+) bytes")
+RSYNC_STATS = re.compile(rb"^(Number of|Total|Literal data|Matched data|File list|sent |total size)")
+UNFINISHED_STATUSES = ("queued", "waking", "running", "interrupted")
+SNAPSHOT_NAME = "%Y-%m-%d_%H%M%S"
+# Snapshots of the same period share a key. The newest snapshot of the latest periods are kept
+RETENTION_PERIODS = {"hourly": "%Y%m%d%H", "daily": "%Y%m%d", "weekly": "%G%V"}
+
+
+def run_on_destination(host, command):
+    """ Runs a command on the backup destination, through ssh when host (user@ip) is set """
+    if host is not None:
+        command = ["/usr/bin/ssh", "-T", host, " ".join(shlex.quote(_arg) for _arg in command)]
+    try:
+        _result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, timeout=600)
+    except (OSError, subprocess.TimeoutExpired) as ex:
+        debug.write("Could not run {}: {}".format(" ".join(command), ex), 1, "BACKUP")
+        return False
+    if _result.returncode != 0:
+        debug.write("{} failed: {}".format(" ".join(command), _result.stderr.decode("UTF-8", errors="replace").strip()),
+                    1, "BACKUP")
+    return _result.returncode == 0
+
+
+def get_retention(policy):
+    """ {period: snapshots count} from a 'hourly:24,daily:7,weekly:4' policy """
+    _retention = {}
+    for _entry in policy.split(","):
+        if not _entry.strip():
+            continue
+        try:
+            _period, _count = _entry.split(":")
+            if _period.strip() not in RETENTION_PERIODS:
+                raise ValueError
+            _retention[_period.strip()] = int(_count)
+        except ValueError:
+            debug.write("Invalid snapshot retention: {}. Expected hourly:#, daily:# or weekly:#".format(_entry),
+                        1, "BACKUP")
+    return _retention
+
+
+class BackupJob(object):
+    """ rsync run of one client folder to its destination """
+
+    def __init__(self, client, folder, destination, delete=False, source_host=None, ssh_host=None):
+        self.client = client
+        self.folder = folder
+        self.destination = destination
+        # Destination of the folder mirror, holding the snapshots folder in snapshot mode
+        self.base_destination = destination
+        self.delete = delete
+        # user@ip the folder is pulled from, None for a local folder
+        self.source_host = source_host
+        # user@ip of the client running rsync to push its folder, None to run rsync here
+        self.ssh_host = ssh_host
+        # Snapshot name and folder on the destination host, with the previous complete snapshot folder
+        self.snapshot = None
+        self.snapshot_dir = None
+        self.link_dest = None
+        self.status = "queued"
+        self.bytes = 0
+        self.size = None
+        self.percent = 0
+        self.speed = ""
+        self.started = None
+        self.ended = None
+        self.duration = None
+        self.message = ""
+        self.process = None
+
+    def get_command(self, rsync, bwlimit=0):
+        # --partial keeps the partly transferred files, resumed by the next run
+        _options = ["-az", "--partial", "--info=progress2", "--stats"]
+        if self.delete:
+            _options.append("--delete")
+        if self.link_dest is not None:
+            # Unchanged files are hard links to the previous snapshot
+            _options.append("--link-dest={}".format(self.link_dest))
+        if bwlimit:
+            _options.append("--bwlimit={}".format(bwlimit))
+        if self.ssh_host is not None:
+            return ["/usr/bin/ssh", "-T", self.ssh_host, " ".join(shlex.quote(_arg) for _arg in
+                                                                  ["/usr/bin/rsync"] + _options + [self.folder, self.destination])]
+        if self.source_host is not None:
+            return [rsync] + _options + ["{}:{}".format(self.source_host, self.folder), self.destination]
+        return [rsync] + _options + [self.folder, self.destination]
+
+    def parse_output(self, line):
+        _progress = RSYNC_PROGRESS.match(line)
+        if _progress:
+            self.bytes = int(re.sub(rb"[,.]", b"", _progress.group(1)))
+            self.percent = int(_progress.group(2))
+            self.speed = _progress.group(3).decode("UTF-8")
+            return
+        _size = RSYNC_SIZE.match(line)
+        if _size:
+            self.size = int(re.sub(rb"[,.]", b"", _size.group(1)))
+        elif line.strip() and not RSYNC_STATS.match(line):
+            self.message = line.strip().decode("UTF-8", errors="replace")
+
+    def get_destination_host(self):
+        """ user@ip of the destination, None when it is on the Homeserver """
+        if re.match(r"^[^/:]+@[^/:]+:", self.destination):
+            return self.destination.split(":", 1)[0]
+        return self.ssh_host
+
+    def set_snapshot(self, name, link_dest=None):
+        """ Backs up to the name snapshot of the folder instead of mirroring it in the destination """
+        _prefix, _path = "", self.base_destination
+        if re.match(r"^[^/:]+@[^/:]+:", self.base_destination):
+            _prefix, _path = self.base_destination.split(":", 1)
+            _prefix += ":"
+        self.snapshot = name
+        self.snapshot_dir = self.get_snapshots_dir(_path, self.folder) + "/" + name
+        self.link_dest = link_dest
+        self.destination = _prefix + self.snapshot_dir
+
+    @staticmethod
+    def get_snapshots_dir(destination, folder):
+        return "{}/{}.snapshots".format(destination.rstrip("/"), os.path.basename(folder.rstrip("/")))
+
+    def to_dict(self):
+        return {"client": self.client, "folder": self.folder, "status": self.status, "bytes": self.bytes,
+                "size": self.size, "duration": self.duration, "ended": self.ended, "snapshot": self.snapshot}
+
+
+class BackupClient(object):
+    """ Backup jobs of a client, with the optional power-on and power-off callables """
+    """ wake() returns whether the client was off and is now on, None if it could not be powered on """
+
+    def __init__(self, index, name, jobs, wake=None, sleep=None):
+        self.index = index
+        self.name = name
+        self.jobs = jobs
+        self.wake = wake
+        self.sleep = sleep
+
+
+class BackupScheduler(object):
+    """ Runs the rsync jobs of several clients concurrently. Clients are powered on in parallel and """
+    """ at most concurrency jobs run at once, sharing the bwlimit (KB/s, 0 for no limit) """
+
+    def __init__(self, concurrency=2, bwlimit=0, on_change=None, on_done=None):
+        self.concurrency = max(1, concurrency)
+        self.bwlimit = bwlimit
+        self.on_change = on_change
+        self.on_done = on_done
+        self.rsync = shutil.which("rsync") or "/usr/bin/rsync"
+        self.stopevent = Event()
+        self.lock = Lock()
+        self.running_jobs = set()
+
+    def run(self, clients):
+        """ Runs the jobs of the clients. Returns once they are all done, failed or interrupted """
+        if not clients:
+            return
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="BackupJob") as _jobs, \
+                ThreadPoolExecutor(max_workers=len(clients), thread_name_prefix="BackupClient") as _clients:
+            wait([_clients.submit(self.run_client, _client, _jobs) for _client in clients])
+
+    def run_client(self, client, pool):
+        _was_off = False
+        if client.wake is not None:
+            for _job in client.jobs:
+                _job.status = "waking"
+            self.changed()
+            _was_off = client.wake()
+            if _was_off is None:
+                debug.write("Skipping {}, device is offline.".format(client.name), 0, "BACKUP")
+                for _job in client.jobs:
+                    _job.status = "interrupted" if self.stopevent.is_set() else "skipped"
+                self.changed()
+                return
+        debug.write("Backing up client: {}".format(client.name), 0, "BACKUP")
+        wait([pool.submit(self.run_job, _job) for _job in client.jobs])
+        if _was_off and client.sleep is not None:
+            debug.write("Turning back OFF {}".format(client.name), 0, "BACKUP")
+            client.sleep()
+
+    def run_job(self, job):
+        if self.stopevent.is_set():
+            job.status = "interrupted"
+            self.changed()
+            return
+        _bwlimit = max(1, self.bwlimit // self.concurrency) if self.bwlimit else 0
+        _command = job.get_command(self.rsync, _bwlimit)
+        debug.write("Backing up folder {}".format(job.folder), 0, "BACKUP")
+        debug.write("Running rsync command: {}".format(" ".join(_command)), 0, "BACKUP")
+        job.status = "running"
+        job.bytes = 0
+        job.percent = 0
+        job.size = None
+        job.duration = None
+        job.message = ""
+        job.started = time.monotonic()
+        self.changed()
+        if job.snapshot_dir is not None and not run_on_destination(job.get_destination_host(),
+                                                                   ["mkdir", "-p", job.snapshot_dir]):
+            job.status = "failed"
+            job.message = "Could not create {}".format(job.snapshot_dir)
+            self.done(job)
+            return
+        try:
+            job.process = subprocess.Popen(_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           stdin=subprocess.DEVNULL, preexec_fn=os.setsid)
+        except OSError as ex:
+            job.status = "failed"
+            job.message = str(ex)
+            debug.write("Could not run rsync for {}: {}".format(job.folder, ex), 1, "BACKUP")
+            self.done(job)
+            return
+        with self.lock:
+            self.running_jobs.add(job)
+        if self.stopevent.is_set():
+            self.kill(job)
+        # Progress lines are separated by carriage returns
+        _buffer = b""
+        for _data in iter(lambda: job.process.stdout.read1(4096), b""):
+            _lines = re.split(rb"[\r\n]", _buffer + _data)
+            _buffer = _lines.pop()
+            for _line in _lines:
+                job.parse_output(_line)
+        job.parse_output(_buffer)
+        _code = job.process.wait()
+        with self.lock:
+            self.running_jobs.discard(job)
+        job.process.stdout.close()
+        job.process = None
+        job.duration = round(time.monotonic() - job.started, 1)
+        job.ended = datetime.now().isoformat(timespec="seconds")
+        if _code in RSYNC_DONE_CODES:
+            job.status = "done"
+            job.percent = 100
+            debug.write("Backed up folder {} in {}s ({} bytes)".format(job.folder, job.duration, job.bytes),
+                        0, "BACKUP")
+        elif self.stopevent.is_set():
+            job.status = "interrupted"
+        else:
+            job.status = "failed"
+            debug.write("Backup of folder {} failed (rsync exit code {}): {}".format(
+                job.folder, _code, job.message), 1, "BACKUP")
+        self.done(job)
+
+    def done(self, job):
+        if job.duration is None and job.started is not None:
+            job.duration = round(time.monotonic() - job.started, 1)
+            job.ended = datetime.now().isoformat(timespec="seconds")
+        if self.on_done is not None:
+            self.on_done(job)
+        self.changed()
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    @staticmethod
+    def kill(job):
+        try:
+            os.killpg(os.getpgid(job.process.pid), signal.SIGTERM)
+        except (ProcessLookupError, AttributeError):
+            pass
+
+    def stop(self):
+        self.stopevent.set()
+        with self.lock:
+            _jobs = list(self.running_jobs)
+        if _jobs:
+            debug.write("Killing remaining backups.", 0, "BACKUP")
+        for _job in _jobs:
+            self.kill(_job)
+
+
+class BackupIndex(object):
+    """ Snapshots of each client folder, saved to a JSON index so they are listed without scanning """
+    """ the destinations, and the run log: one JSON line per backup job run """
+
+    def __init__(self, path, runlog_path):
+        self.path = path
+        self.runlog_path = runlog_path
+        self.lock = Lock()
+        self.snapshots = {}
+        try:
+            with open(self.path, "r") as _f:
+                for _snapshot in json.load(_f):
+                    self.snapshots.setdefault((_snapshot["client"], _snapshot["folder"]), []).append(_snapshot)
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def get(self, client, folder):
+        """ Snapshots of a client folder, oldest first """
+        with self.lock:
+            return list(self.snapshots.get((client, folder), []))
+
+    def prepare(self, job):
+        """ Sets the snapshot of a job. An unfinished latest snapshot is completed rather than restarted """
+        _snapshots = self.get(job.client, job.folder)
+        _complete = [_snapshot for _snapshot in _snapshots if _snapshot["status"] == "done"]
+        _link_dest = _complete[-1]["path"] if _complete else None
+        if _snapshots and _snapshots[-1]["status"] != "done":
+            _name = _snapshots[-1]["name"]
+        else:
+            _name = datetime.now().strftime(SNAPSHOT_NAME)
+        job.set_snapshot(_name, _link_dest)
+
+    def record(self, job):
+        """ Logs a job run and indexes its snapshot """
+        _run = job.to_dict()
+        with self.lock:
+            if job.snapshot is not None:
+                _snapshot = dict(_run, name=job.snapshot, path=job.snapshot_dir, host=job.get_destination_host())
+                _snapshots = self.snapshots.setdefault((job.client, job.folder), [])
+                if _snapshots and _snapshots[-1]["name"] == job.snapshot:
+                    _snapshots[-1] = _snapshot
+                else:
+                    _snapshots.append(_snapshot)
+            try:
+                with open(self.runlog_path, "a") as _f:
+                    _f.write(json.dumps(_run) + "\n")
+            except IOError as ex:
+                debug.write("Could not log the backup run: {}".format(ex), 1, "BACKUP")
+        self.save()
+
+    def expire(self, client, folder, retention):
+        """ Deletes the snapshots outside of the retention policy, keeping the latest complete one """
+        _snapshots = self.get(client, folder)
+        _complete = [_snapshot for _snapshot in _snapshots if _snapshot["status"] == "done"]
+        if not _complete:
+            return
+        _keep = {_complete[-1]["name"]}
+        for _period, _count in retention.items():
+            _periods = set()
+            for _snapshot in reversed(_complete):
+                _key = datetime.strptime(_snapshot["name"], SNAPSHOT_NAME).strftime(RETENTION_PERIODS[_period])
+                if _key in _periods:
+                    continue
+                if len(_periods) >= _count:
+                    break
+                _periods.add(_key)
+                _keep.add(_snapshot["name"])
+        _expired = [_snapshot for _snapshot in _snapshots if _snapshot["name"] not in _keep]
+        for _snapshot in _expired:
+            debug.write("Deleting expired snapshot {}".format(_snapshot["path"]), 0, "BACKUP")
+            if run_on_destination(_snapshot["host"], ["rm", "-rf", _snapshot["path"]]):
+                with self.lock:
+                    self.snapshots[(client, folder)].remove(_snapshot)
+        if _expired:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            _snapshots = [_snapshot for _list in self.snapshots.values() for _snapshot in _list]
+            try:
+                with open(self.path + ".tmp", "w") as _f:
+                    json.dump(_snapshots, _f)
+                os.replace(self.path + ".tmp", self.path)
+            except IOError as ex:
+                debug.write("Could not save the snapshots index: {}".format(ex), 1, "BACKUP")
 
 
 class backup(Thread):
+    CONFIG_SECTIONS = {"BACKUP": None, "SERVER": ("JOURNAL_DIR",)}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.init_from_config()
         self.dm = dm
         self.stopevent = Event()
-        self.last_backup = 0
+        self.state_lock = Lock()
+        _journal_dir = get_path_from_config(getConfigHandler()['SERVER']['JOURNAL_DIR'])
+        self.state_path = _journal_dir + "/backup.json"
+        self.index = BackupIndex(_journal_dir + "/backup_index.json", _journal_dir + "/backup_runs.log")
+        self.last_backup = None
+        self.jobs = {}
         self.running = True
-        self.rsync = None
+        self.scheduler = None
         self.web = "backup.ejs"
         self.backup_queue = queue.Queue()
+        self.load_state()
 
     def run(self):
         debug.write("Starting backup manager", 0, "BACKUP")
@@ -46,28 +420,88 @@ class backup(Thread):
                 self.stop()
                 return
 
-        self.run_backup()
-        _next_run = self.last_backup + timedelta(hours=self.backup_interval)
-        debug.write("Will do another backup at: {}".format(_next_run.strftime('%d %B, %H:%M')),
-                    0, "BACKUP")
-        while not self.stopevent.is_set():
-            if _next_run > datetime.now():
-                if not self.backup_queue.empty():
-                    needs_backup = self.backup_queue.get()
-                    self.run_backup(needs_backup)
-                    self.backup_queue.task_done()
-                self.stopevent.wait(60)
-                continue
+        _unfinished = [_key for _key, _job in self.jobs.items() if _job["status"] in UNFINISHED_STATUSES]
+        if _unfinished:
+            debug.write("Resuming {} interrupted backup jobs".format(len(_unfinished)), 0, "BACKUP")
+            self.run_backup(folders=_unfinished)
+        if self.last_backup is None or self.get_next_run() <= datetime.now():
             self.run_backup()
-            _next_run = self.last_backup + \
-                timedelta(hours=self.backup_interval)
+        while not self.stopevent.is_set():
+            _next_run = self.get_next_run()
             debug.write("Will do another backup at: {}".format(_next_run.strftime('%d %B, %H:%M')),
                         0, "BACKUP")
+            while _next_run > datetime.now() and not self.stopevent.is_set():
+                try:
+                    needs_backup = self.backup_queue.get(timeout=60)
+                except queue.Empty:
+                    continue
+                if needs_backup is not None:
+                    self.run_backup(needs_backup)
+                self.backup_queue.task_done()
+            if not self.stopevent.is_set():
+                self.run_backup()
         debug.write("Stopped.", 0, "BACKUP")
         return
 
-    def run_backup(self, clientid=None):
-        self.last_backup = datetime.now()
+    def get_next_run(self):
+        return self.last_backup + timedelta(hours=self.backup_interval)
+
+    def get_client_ids(self):
+        i = 0
+        while self.config.has_option("BACKUP", "CLIENT" + str(i)):
+            yield i
+            i = i + 1
+
+    def get_clients(self, backup_server, clientid=None, folders=None):
+        """ Backup clients and their jobs. folders restricts the jobs to these (clientid, folder) """
+        _clients = []
+        for i in self.get_client_ids():
+            if clientid is not None and clientid != i:
+                continue
+            _client_cfg = "CLIENT" + str(i)
+            client = "local"
+            _source_host = None
+            _ssh_host = None
+            if self.config[_client_cfg] != "local":
+                client = self.dm[self.config.get_value(_client_cfg, int)]
+            if self.backup_server != "local" and self.backup_server != self.config[_client_cfg]:
+                destination = "{}@{}:{}".format(
+                    backup_server.user, backup_server.ip, self.config[_client_cfg + "_DESTINATION"])
+            else:
+                destination = self.config[_client_cfg + "_DESTINATION"]
+            if client != "local":
+                if self.backup_server != "local":
+                    _ssh_host = "{}@{}".format(client.user, client.ip)
+                else:
+                    _source_host = "{}@{}".format(client.user, client.ip)
+            _jobs = []
+            for _folder in self.config[_client_cfg + "_FOLDERS"].split(","):
+                if folders is None or (i, _folder) in folders:
+                    _jobs.append(BackupJob(i, _folder, destination, self.config.get_value(_client_cfg + "_DELETE", bool),
+                                           _source_host, _ssh_host))
+                    if self.retention:
+                        self.index.prepare(_jobs[-1])
+            if not _jobs:
+                continue
+            _wake = None
+            _sleep = None
+            if client != "local" and str(client.get_state()) != DEVICE_ON:
+                if not self.config.get_value(_client_cfg + "_FORCE_ON", bool):
+                    debug.write("Skipping {}, device is offline.".format(_client_cfg), 0, "BACKUP")
+                    for _job in _jobs:
+                        _job.status = "skipped"
+                        self.jobs[(i, _job.folder)] = _job
+                    continue
+                _devid = self.config.get_value(_client_cfg, int)
+                _wake = lambda _devid=_devid: self.wake(_devid)
+                _sleep = lambda _devid=_devid: self.change_state_for_device(_devid, DEVICE_OFF)
+            _clients.append(BackupClient(i, _client_cfg if client == "local" else client.name,
+                                         _jobs, _wake, _sleep))
+        return _clients
+
+    def run_backup(self, clientid=None, folders=None):
+        if clientid is None and folders is None:
+            self.last_backup = datetime.now()
         debug.write("Starting backups", 0, "BACKUP")
         backup_server = None
         server_was_off = False
@@ -75,114 +509,55 @@ class backup(Thread):
             backup_server = self.dm[int(self.backup_server)]
             if str(backup_server.get_state()) != DEVICE_ON:
                 if self.config.get_value("BACKUP_SERVER_FORCE_ON", bool):
-                    server_was_off = True
                     debug.write("Turning on backup server", 0, "BACKUP")
-                    self.change_state_for_device(self.backup_server, DEVICE_ON)
-
-                    while str(backup_server.get_state()) != DEVICE_ON:
-                        debug.write(
-                            "Waiting for backup server...", 0, "BACKUP")
-                        self.stopevent.wait(5)
+                    server_was_off = self.wake(int(self.backup_server))
+                    if server_was_off is None:
+                        debug.write("Backup server did not power on. Reporting backups.", 1, "BACKUP")
+                        return
                 else:
                     debug.write(
                         "Backup server is offline and no FORCE_ON. Reporting backups.", 0, "BACKUP")
                     return
 
-        i = 0
-        while self.running:
-            if clientid is not None and clientid != i:
-                if i > clientid:
-                    break
-                continue
-            try:
-                destination = ""
-                if not self.config.has_option("BACKUP", "CLIENT" + str(i)):
-                    break
-                if self.config["CLIENT" + str(i)] != "local":
-                    client = self.dm[self.config.get_value(
-                        "CLIENT" + str(i), int)]
-                    client_was_off = False
-                    if str(client.get_state()) != DEVICE_ON:
-                        if self.config.get_value("CLIENT" + str(i) + "_FORCE_ON", bool):
-                            client_was_off = True
-                            debug.write(
-                                "Turning ON CLIENT{}".format(i), 0, "BACKUP")
-                            self.change_state_for_device(
-                                self.config.get_value("CLIENT" + str(i), int), DEVICE_ON)
-
-                            while str(client.get_state()) != DEVICE_ON:
-                                debug.write(
-                                    "Waiting for client...", 0, "BACKUP")
-                                self.stopevent.wait(5)
-                        else:
-                            debug.write(
-                                "Skipping CLIENT{}, device is offline.".format(i), 0, "BACKUP")
-                            i = i + 1
-                            continue
-
-                debug.write('Backing up client: {}'.format(
-                    client.name), 0, "BACKUP")
-                if self.backup_server != "local" and self.backup_server != self.config["CLIENT" + str(i)]:
-                    destination = "{}@{}:{}".format(
-                        backup_server.user, backup_server.ip, self.config["CLIENT" + str(i) + "_DESTINATION"])
-                else:
-                    destination = self.config["CLIENT" +
-                                              str(i) + "_DESTINATION"]
-
-                folders = []
-                folders = self.config["CLIENT" +
-                                      str(i) + "_FOLDERS"].split(",")
-                for _folder in folders:
-                    command = ""
-                    if self.config.get_value("CLIENT" + str(i) + "_DELETE", bool):
-                        command = "/usr/bin/rsync -az --delete"
-                    else:
-                        command = "/usr/bin/rsync -az"
-                    if client == "local":
-                        command = "{} {} {}".format(
-                            command, _folder, destination)
-                    else:
-                        if self.backup_server != "local":
-                            command = "/usr/bin/ssh -T {}@{} '{} {} {}'".format(
-                                client.user, client.ip, command, _folder, destination)
-                        else:
-                            command = "{} {}@{}:{} {}".format(
-                                command, client.user, client.ip, _folder, destination)
-
-                    debug.write('Backing up folder {}'.format(
-                        _folder), 0, "BACKUP")
-                    debug.write('Running rsync command: {}'.format(
-                        command), 0, "BACKUP")
-
-                    # TODO handle keyboardinterrupts properly ?
-                    self.rsync = subprocess.Popen(shlex.split(command), stdout=None,
-                                                  preexec_fn=os.setsid, stdin=None)
-                    self.rsync.wait()
-                    self.rsync = None
-                    if not self.running:
-                        return
-
-                if client_was_off:
-                    debug.write(
-                        "Turning back OFF CLIENT{}".format(i), 0, "BACKUP")
-                    self.change_state_for_device(self.config.get_value(
-                        "CLIENT" + str(i), int), DEVICE_OFF)
-
-            except KeyError:
-                debug.write('Backups are done', 0, "BACKUP")
-                break
-
-            i = i + 1
-
-        if clientid is not None:
-            debug.write('Backups are done', 0, "BACKUP")
+        _clients = self.get_clients(backup_server, clientid, folders)
+        for _client in _clients:
+            for _job in _client.jobs:
+                self.jobs[(_client.index, _job.folder)] = _job
+        self.save_state()
+        self.scheduler = BackupScheduler(self.concurrency, self.bwlimit, self.save_state, self.job_done)
+        if self.running:
+            self.scheduler.run(_clients)
+        else:
+            for _client in _clients:
+                for _job in _client.jobs:
+                    _job.status = "interrupted"
+        self.save_state()
+        debug.write('Backups are done', 0, "BACKUP")
 
         if server_was_off:
             debug.write(
-                "Turning back OFF backup server".format(i), 0, "BACKUP")
+                "Turning back OFF backup server", 0, "BACKUP")
             self.change_state_for_device(self.backup_server, DEVICE_OFF)
         return
 
+    def job_done(self, job):
+        self.index.record(job)
+        if job.status == "done" and job.snapshot is not None:
+            self.index.expire(job.client, job.folder, self.retention)
+
+    def wake(self, devid):
+        """ Powers on a device. Returns True once it is on, None if it did not power on in time """
+        self.change_state_for_device(devid, DEVICE_ON)
+        _deadline = time.monotonic() + self.wake_timeout
+        _delay = 1
+        while str(self.dm[devid].get_state()) != DEVICE_ON:
+            if self.stopevent.is_set() or time.monotonic() > _deadline:
+                return None
+            debug.write("Waiting for {}...".format(self.dm[devid].name), 0, "BACKUP")
+            self.stopevent.wait(_delay)
+            _delay = min(_delay * 2, 15)
+        return True
+
     def change_state_for_device(self, devid, state):
         req = StateRequestObject()
         req.initialize_dm(self.dm)
@@ -192,6 +567,28 @@ class backup(Thread):
         req.set(skip_time=True, auto_mode=False, history_origin="Backup")
         req()
 
+    def load_state(self):
+        """ Last backup time and jobs of the previous runs """
+        try:
+            with open(self.state_path, "r") as _f:
+                _state = json.load(_f)
+            if _state.get("last_backup"):
+                self.last_backup = datetime.fromisoformat(_state["last_backup"])
+            self.jobs = {(_job["client"], _job["folder"]): _job for _job in _state.get("jobs", [])}
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def save_state(self):
+        with self.state_lock:
+            _state = {"last_backup": self.last_backup.isoformat(timespec="seconds") if self.last_backup else None,
+                      "jobs": [_job.to_dict() if isinstance(_job, BackupJob) else _job for _job in self.jobs.values()]}
+            try:
+                with open(self.state_path + ".tmp", "w") as _f:
+                    json.dump(_state, _f)
+                os.replace(self.state_path + ".tmp", self.state_path)
+            except IOError as ex:
+                debug.write("Could not save the backup state: {}".format(ex), 1, "BACKUP")
+
     def init_from_config(self):
         self.config = getConfigHandler().set_section("BACKUP")
         self.backup_interval = self.config.get_value(
@@ -199,16 +596,39 @@ class backup(Thread):
         self.backup_server = self.config["BACKUP_SERVER"]
         self.backup_server_forceon = self.config.get_value(
             "BACKUP_SERVER_FORCE_ON", bool)
+        self.concurrency = 2
+        if self.config.dev_has_option("MAX_PARALLEL_BACKUPS"):
+            self.concurrency = max(1, self.config.get_value("MAX_PARALLEL_BACKUPS", int))
+        self.bwlimit = 0
+        if self.config.dev_has_option("BWLIMIT_KBPS"):
+            self.bwlimit = self.config.get_value("BWLIMIT_KBPS", int)
+        self.wake_timeout = 300
+        if self.config.dev_has_option("WAKE_TIMEOUT_SEC"):
+            self.wake_timeout = self.config.get_value("WAKE_TIMEOUT_SEC", int)
+        self.retention = {}
+        if self.config.dev_has_option("SNAPSHOT_RETENTION"):
+            self.retention = get_retention(self.config["SNAPSHOT_RETENTION"])
 
     def stop(self):
         debug.write("Stopping.", 0, "BACKUP")
         self.running = False
-        if self.rsync is not None:
-            debug.write("Killing remaining backup.", 0, "BACKUP")
-            os.killpg(os.getpgid(self.rsync.pid), signal.SIGTERM)
         self.stopevent.set()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.backup_queue.put(None)
         return
 
+    @staticmethod
+    def get_job_status(job):
+        if isinstance(job, BackupJob):
+            job = {"status": job.status, "bytes": job.bytes, "duration": job.duration,
+                   "percent": job.percent, "speed": job.speed}
+        if job["status"] == "running":
+            return "{}% ({:.1f} MB, {})".format(job["percent"], job["bytes"] / 1000000, job["speed"])
+        if job["status"] == "done":
+            return "done in {}s ({:.1f} MB)".format(job["duration"], job["bytes"] / 1000000)
+        return job["status"]
+
     def get_web(self):
         web = """
 <table class="table table-dark table-striped table-bordered">
@@ -221,24 +641,32 @@ class backup(Thread):
     </tr>
   </thead>
   <tbody> """
-        i = 0
         has_devices = False
-        while True:
+        for i in self.get_client_ids():
             try:
-                if not self.config.has_option("BACKUP", "CLIENT" + str(i)):
-                    break
-                client = self.dm.devices[self.config.get_value(
-                    "CLIENT" + str(i), int)]
+                if self.config["CLIENT" + str(i)] == "local":
+                    _name = "local"
+                else:
+                    _name = self.dm.devices[self.config.get_value(
+                        "CLIENT" + str(i), int)].name
+                _folders = []
+                for _folder in self.config["CLIENT" + str(i) + "_FOLDERS"].split(","):
+                    _job = self.jobs.get((i, _folder))
+                    _folders.append(_folder if _job is None else "{}: {}".format(_folder, self.get_job_status(_job)))
+                    _snapshots = [_snapshot for _snapshot in self.index.get(i, _folder) if _snapshot["status"] == "done"]
+                    if _snapshots:
+                        _folders.append("&nbsp;&nbsp;{} snapshots: {}".format(len(_snapshots), ", ".join(
+                            "{} ({:.1f} MB)".format(_snapshot["name"], (_snapshot["size"] or 0) / 1000000)
+                            for _snapshot in reversed(_snapshots[-5:]))))
                 web += '<tr><th scope="row">{}</th>'.format(i + 1)
-                web += '<td>{}</td>'.format(client.name)
+                web += '<td>{}</td>'.format(_name)
                 web += '<td class="d-none d-md-table-cell" style="font-size:x-small;">{}</td>'.format(
-                    self.config["CLIENT" + str(i) + "_FOLDERS"].replace(',', ', '))
+                    '<br>'.join(_folders))
                 web += '<td><center><button id="backupbtn{}" type="button" class="btn btn-warning" onclick="doBackup({})">Backup</button></center></td></tr>'.format(
                     i, i)
                 has_devices = True
             except NoOptionError:
                 break
-            i = i + 1
         if not has_devices:
             web += '<tr><th rowspan="3">No backup devices configured</th></tr>'
         web += "</tbody></table>"
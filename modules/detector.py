@@ -2,20 +2,259 @@
 '''
     File name: detector.py
     Author: Maxime Bergeron
-    Date last modified: 31/01/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The device-pinging detector module for the homeserver
 '''
 
+import asyncio
 import datetime
 import os
+import shutil
+import time
 from core.common import *
 from core.devicemanager import StateRequestObject
 from threading import Thread, Event
 
 
+class PresenceSource(object):
+    """ Base presence source. check() returns True/False, or None when it has no opinion """
+    # Active sources generate network traffic, passive sources only observe it
+    active = False
+    # Seconds a sign of life from a passive source stays valid
+    freshness = 0
+
+    def __init__(self, detector):
+        self.detector = detector
+
+    async def run(self):
+        """ Background task of the source, if any """
+        return
+
+    async def check(self, ip):
+        return None
+
+
+class PingSource(PresenceSource):
+    """ Active ICMP probe """
+    active = True
+
+    async def check(self, ip):
+        _proc = await asyncio.create_subprocess_exec(
+            "ping", "-c", "1", "-W", "1", ip,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        return await _proc.wait() == 0
+
+
+class NeighborTableSource(PresenceSource):
+    """ Passive source from the kernel neighbor table and an optional dnsmasq lease file """
+    # Neighbor states considered as a fresh sign of life
+    PRESENT_STATES = ["REACHABLE", "DELAY", "PROBE", "PERMANENT"]
+    ABSENT_STATES = ["FAILED", "INCOMPLETE"]
+
+    def __init__(self, detector, table_path, leases_path, freshness):
+        PresenceSource.__init__(self, detector)
+        self.table_path = table_path
+        self.leases_path = leases_path
+        self.freshness = freshness
+        self.last_seen = {}
+        # Neighbor table entries of the last poll
+        self.entries = {}
+        self.lease_expiry = {}
+        self.leases_mtime = None
+        # Netlink events through 'ip monitor' are only used for the live kernel table
+        self.use_events = table_path == "/proc/net/arp" and shutil.which("ip") is not None
+
+    @staticmethod
+    def parse_neighbor_table(text):
+        """ Parses /proc/net/arp formatted text. Returns {ip: (flags, hardware address)} """
+        _entries = {}
+        for _line in text.splitlines()[1:]:
+            _cols = _line.split()
+            if len(_cols) < 4:
+                continue
+            try:
+                _entries[_cols[0]] = (int(_cols[2], 16), _cols[3])
+            except ValueError:
+                continue
+        return _entries
+
+    @staticmethod
+    def parse_neighbor_event(line):
+        """ Parses an 'ip monitor neigh' line. Returns (ip, state) or None """
+        _cols = line.split()
+        if len(_cols) < 2:
+            return None
+        if _cols[0] == "Deleted":
+            return _cols[1], "FAILED"
+        if _cols[0] == "miss":
+            _cols = _cols[1:]
+        return _cols[0], _cols[-1]
+
+    @staticmethod
+    def parse_leases(text):
+        """ Parses a dnsmasq lease file. Returns {ip: expiry} """
+        _leases = {}
+        for _line in text.splitlines():
+            _cols = _line.split()
+            if len(_cols) < 3:
+                continue
+            try:
+                _leases[_cols[2]] = int(_cols[0])
+            except ValueError:
+                continue
+        return _leases
+
+    def signal(self, ip, present):
+        if present:
+            self.last_seen[ip] = time.monotonic()
+        else:
+            self.last_seen.pop(ip, None)
+        self.detector.notify_presence(ip, present)
+
+    def read_table(self):
+        try:
+            with open(self.table_path) as _f:
+                _entries = self.parse_neighbor_table(_f.read())
+        except IOError as ex:
+            debug.write("Could not read neighbor table {}: {}".format(
+                self.table_path, ex), 1, "DETECTOR")
+            return
+        for _ip, _entry in _entries.items():
+            if _entry[0] & 0x2:
+                # Complete entries stay in the table long after the device left (STALE state),
+                # only a new or changed entry is a sign of life
+                if self.entries.get(_ip) != _entry:
+                    self.last_seen[_ip] = time.monotonic()
+            elif _ip in self.last_seen:
+                self.signal(_ip, False)
+        self.entries = _entries
+
+    def read_leases(self):
+        if self.leases_path is None:
+            return
+        try:
+            _mtime = os.stat(self.leases_path).st_mtime
+            if _mtime == self.leases_mtime:
+                return
+            self.leases_mtime = _mtime
+            with open(self.leases_path) as _f:
+                _leases = self.parse_leases(_f.read())
+        except (IOError, OSError):
+            return
+        for _ip, _expiry in _leases.items():
+            # A renewed lease means the device just talked to the DHCP server
+            if self.lease_expiry.get(_ip, _expiry) < _expiry:
+                self.signal(_ip, True)
+            self.lease_expiry[_ip] = _expiry
+
+    async def run(self):
+        if self.use_events:
+            try:
+                _proc = await asyncio.create_subprocess_exec(
+                    "ip", "monitor", "neigh",
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            except OSError as ex:
+                debug.write("Could not monitor neighbor events ({}). Polling {} instead.".format(
+                    ex, self.table_path), 3, "DETECTOR")
+                self.use_events = False
+            else:
+                debug.write("Listening to neighbor table events", 0, "DETECTOR")
+                self.read_table()
+                _leases = asyncio.ensure_future(self._poll(self.read_leases))
+                try:
+                    while True:
+                        _line = await _proc.stdout.readline()
+                        if not _line:
+                            break
+                        _event = self.parse_neighbor_event(_line.decode(errors="ignore"))
+                        if _event is None:
+                            continue
+                        if _event[1] in self.PRESENT_STATES:
+                            self.signal(_event[0], True)
+                        elif _event[1] in self.ABSENT_STATES:
+                            self.signal(_event[0], False)
+                finally:
+                    _leases.cancel()
+                    if _proc.returncode is None:
+                        _proc.kill()
+                        await _proc.wait()
+                debug.write("Neighbor table events stopped. Polling {} instead.".format(
+                    self.table_path), 3, "DETECTOR")
+        await self._poll(self.read_table, self.read_leases)
+
+    async def _poll(self, *readers):
+        while True:
+            for _reader in readers:
+                _reader()
+            await asyncio.sleep(self.detector.ping_freq)
+
+    async def check(self, ip):
+        _seen = self.last_seen.get(ip)
+        if _seen is not None and time.monotonic() - _seen <= self.freshness:
+            return True
+        return None
+
+
+class DetectorTarget(object):
+    """ Presence state machine for a single tracked IP, with its own hysteresis """
+
+    def __init__(self, index, ip, connect_level, disconnect_level):
+        self.index = index
+        self.ip = ip
+        self.connect_level = max(1, connect_level)
+        self.disconnect_level = max(1, disconnect_level)
+        self.connected = False
+        self.initialized = False
+        self.hits = 0
+        self.misses = 0
+        self.last_seen = None
+
+    @property
+    def confirming(self):
+        """ True while a state change is suspected but not yet confirmed """
+        if self.connected:
+            return self.misses > 0
+        return self.hits > 0
+
+    def update(self, reachable):
+        """ Feeds a probe result. Returns the new connection state on a transition, None otherwise """
+        if reachable:
+            self.last_seen = datetime.datetime.now()
+        if not self.initialized:
+            # First probe sets the state without firing events
+            self.initialized = True
+            self.connected = reachable
+            return None
+        if reachable:
+            self.misses = 0
+            if not self.connected:
+                self.hits += 1
+                if self.hits >= self.connect_level:
+                    self.hits = 0
+                    self.connected = True
+                    return True
+        else:
+            self.hits = 0
+            if self.connected:
+                self.misses += 1
+                if self.misses >= self.disconnect_level:
+                    self.misses = 0
+                    self.connected = False
+                    return False
+        return None
+
+    def next_probe_delay(self, stable_delay, burst_delay):
+        """ Burst-probe while confirming a suspected change, otherwise probe slowly """
+        if not self.initialized or self.confirming:
+            return burst_delay
+        return stable_delay
+
+
 class detector(Thread):
+    CONFIG_SECTIONS = {"DETECTOR": None}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.stopevent = Event()
@@ -23,49 +262,157 @@ class detector(Thread):
         self.status = True
         self.delayed_start = False
         self.dm = dm
+        self.loop = None
+        self._wakeup = None
+        self._target_wakeups = {}
+        # Time of the last active probe of each target
+        self.active_probes = {}
         self.init_from_config()
 
     def run(self):
-        _is_running = True
         self.first_detect()
-        while not self.stopevent.is_set():
-            self.actual_time = datetime.datetime.now().time()
-            self.detect_devices()
-            self.stopevent.wait(self.config.get_value('PING_FREQ_SEC', int))
+        if not self.stopevent.is_set():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.loop.run_until_complete(self._run_engine())
+            finally:
+                self.loop.close()
         debug.write("Stopped.", 0, "DETECTOR")
         return
 
     def stop(self):
         debug.write("Stopping.", 0, "DETECTOR")
         self.stopevent.set()
+        if self.loop is not None and self._wakeup is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._wake_all)
+            except RuntimeError:
+                # Loop already closed
+                pass
 
     def first_detect(self):
         debug.write("Starting ping-based device detector", 0, "DETECTOR")
-        if self.TRACKED_IPS[0] == "":
+        if len(self.targets) == 0:
             debug.write("No IPs to track. Quitting module.", 1, "DETECTOR")
             self.stop()
             return
-        for _cnt, device in enumerate(self.TRACKED_IPS):
-            if device == "_":
-                continue
+        debug.write("Tracking {} with stable probes every {}s and burst probes every {}s using {}".format(
+            ", ".join(_target.ip for _target in self.targets), self.ping_freq, self.burst_freq,
+            ", ".join(type(_source).__name__ for _source in self.sources)), 0, "DETECTOR")
+
+    async def _run_engine(self):
+        self._wakeup = asyncio.Event()
+        self._target_wakeups = {_target.ip: asyncio.Event() for _target in self.targets}
+        if self.stopevent.is_set():
+            # stop() ran before the wakeup event existed and could not schedule _wake_all
+            self._wake_all()
+        _tasks = [asyncio.ensure_future(self._track_target(_target)) for _target in self.targets]
+        _tasks += [asyncio.ensure_future(_source.run()) for _source in self.sources]
+        _tasks.append(asyncio.ensure_future(self._track_events()))
+        await self._wakeup.wait()
+        for _task in _tasks:
+            _task.cancel()
+        await asyncio.gather(*_tasks, return_exceptions=True)
+
+    def _wake_all(self):
+        self._wakeup.set()
+        for _event in self._target_wakeups.values():
+            _event.set()
+
+    async def _sleep(self, delay, wakeup=None):
+        """ Interruptible sleep, returns True if the module is stopping """
+        if wakeup is None:
+            wakeup = self._wakeup
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        if self.stopevent.is_set():
+            return True
+        wakeup.clear()
+        return False
+
+    def notify_presence(self, ip, present):
+        """ Called by passive sources. An absence hint triggers an immediate probe of the target """
+        if not present and ip in self._target_wakeups:
+            self._target_wakeups[ip].set()
+
+    async def probe(self, ip):
+        """ Fuses the presence sources. Passive sources are asked first so a fresh
+            sign of life skips the active probes, at most for one freshness window """
+        _active = [_source for _source in self.sources if _source.active]
+        _now = time.monotonic()
+        for _source in self.sources:
+            if not _source.active and await _source.check(ip):
+                if not _active or _now - self.active_probes.get(ip, -_source.freshness) < _source.freshness:
+                    return True
+                break
+        if _active:
+            self.active_probes[ip] = _now
+        for _source in _active:
+            if await _source.check(ip):
+                return True
+        return False
+
+    async def _track_target(self, target):
+        """ Independent probing timeline of a single target """
+        _wakeup = self._target_wakeups[target.ip]
+        while not self.stopevent.is_set():
+            try:
+                _transition = target.update(await self.probe(target.ip))
+                self.device_status[target.index] = target.connected
+                if _transition is not None:
+                    self.on_transition(target, _transition)
+                elif target.confirming:
+                    debug.write("Device {} state unconfirmed (hits: {}, misses: {}). Burst probing.", 0, "DETECTOR",
+                                args=(target.ip, target.hits, target.misses))
+            except Exception as ex:
+                debug.write(
+                    "Got exception: {}-{}".format(type(ex).__name__, ex), 1, "DETECTOR")
+            if await self._sleep(target.next_probe_delay(self.ping_freq, self.burst_freq), _wakeup):
+                break
+
+    async def _track_events(self):
+        """ Evaluates the time-based events, independently from the probes """
+        while not await self._sleep(self.ping_freq):
+            if all(_target.initialized for _target in self.targets):
+                self.detect_devices()
+
+    def get_event_time(self):
+        _index = self.dm.has_module("timesched")
+        if _index is not False:
+            return self.dm.modules[_index].update_event_time()
+        return None
 
-            if int(os.system("ping -c 1 -W 1 {} >/dev/null".format(device))) == 0:
-                self.device_state_level[_cnt] = self.DEVICE_STATE_MAX
-                self.device_status[_cnt] = True
+    def on_transition(self, target, connected):
+        """ Emits a state transition of a target into the request pipeline """
+        self.actual_time = datetime.datetime.now().time()
+        event_time = self.get_event_time()
+        is_event_hour = event_time is not None and self.actual_time >= event_time
+        if connected:
+            debug.write("Device {} CONnected (with actual states: {})", 0, "DETECTOR",
+                        args=(target.ip, list(self.device_status)))
+            if is_event_hour:
+                self.run_state_request("ON_EVENT_HOUR_DEVICE_CONNECT_EVENT")
             else:
-                self.device_state_level[_cnt] = 0
-                self.device_status[_cnt] = False
-        debug.write("Got initial states {} and status {}".format(
-            self.device_state_level, self.status), 0, "DETECTOR")
+                self.run_state_request("ON_DEVICE_CONNECT_EVENT")
+        else:
+            debug.write("Device {} DISconnected (with actual states: {})", 0, "DETECTOR",
+                        args=(target.ip, list(self.device_status)))
+            if is_event_hour:
+                self.run_state_request("ON_EVENT_HOUR_DEVICE_DISCONNECT_EVENT")
+            else:
+                self.run_state_request("ON_DEVICE_DISCONNECT_EVENT")
+        self.detect_devices()
 
     def detect_devices(self):
+        """ Runs the global (all devices) events from the actual target states """
         try:
-            event_time = None
-            _index = self.dm.has_module("timesched")
-            if _index is not False:
-                event_time = self.dm.modules[_index].update_event_time()
+            self.actual_time = datetime.datetime.now().time()
+            event_time = self.get_event_time()
+            _any_connected = any(_target.connected for _target in self.targets)
 
-            if self.status and all(s == 0 for s in self.device_state_level):
+            if self.status and not _any_connected:
                 debug.write(
                     "All devices are disconnected, running ON_DISCONNECT.", 0, "DETECTOR")
                 if self.config.get_value('FALLBACK_AUTO_ON_DISCONNECT', bool):
@@ -77,60 +424,27 @@ class detector(Thread):
                 self.delayed_start = False
 
             if event_time is not None:
-                if self.actual_time == event_time and self.delayed_start:
-                    debug.write(
-                        "Event time reached and devices are connected.", 0, "DETECTOR")
-                    self.run_state_request("ON_EVENT_HOUR_EVENT")
-                    self.delayed_start = False
-                    self.status = True
+                if _any_connected and not self.delayed_start and self.actual_time < event_time:
+                    debug.write("Scheduling ON_EVENT_HOUR state change at {}".format(
+                        event_time), 0, "DETECTOR")
+                    self.delayed_start = True
+                    self.status = False
 
-                if self.DEVICE_STATE_MAX in self.device_state_level and not self.delayed_start:
-                    if datetime.datetime.now().time() < event_time:
-                        debug.write("Scheduling ON_EVENT_HOUR state change at {}".format(
-                            event_time), 0, "DETECTOR")
-                        self.delayed_start = True
-                        self.status = False
-
-                if self.DEVICE_STATE_MAX in self.device_state_level and not self.status and self.actual_time >= event_time:
-                    debug.write(
-                        "Devices connected between event time and detector off-time.", 0, "DETECTOR")
+                if _any_connected and not self.status and self.actual_time >= event_time:
+                    if self.delayed_start:
+                        debug.write(
+                            "Event time reached and devices are connected.", 0, "DETECTOR")
+                    else:
+                        debug.write(
+                            "Devices connected between event time and detector off-time.", 0, "DETECTOR")
                     self.run_state_request("ON_EVENT_HOUR_EVENT")
                     self.status = True
                     self.delayed_start = False
 
-                if all(s == 0 for s in self.device_state_level) and not self.status and self.delayed_start:
+                if not _any_connected and not self.status and self.delayed_start:
                     debug.write(
                         "Devices disconnected. Aborting scheduled event.", 0, "DETECTOR")
                     self.delayed_start = False
-
-            for _cnt, device in enumerate(self.TRACKED_IPS):
-                if device == "_":
-                    continue
-
-                if int(os.system("ping -c 1 -W 1 {} >/dev/null".format(device))) == 0:
-                    self.device_state_level[_cnt] = self.DEVICE_STATE_MAX
-                    if not self.device_status[_cnt]:
-                        self.device_status[_cnt] = True
-                        debug.write("Device {} CONnected (with actual state levels: {})".format(
-                            device, self.device_state_level), 0, "DETECTOR")
-                        if self.actual_time >= event_time:
-                            self.run_state_request(
-                                "ON_EVENT_HOUR_DEVICE_CONNECT_EVENT")
-                        else:
-                            self.run_state_request("ON_DEVICE_CONNECT_EVENT")
-                else:
-                    if self.device_state_level[_cnt] == 0 and self.device_status[_cnt]:
-                        self.device_status[_cnt] = False
-                        debug.write("Device {} DISconnected (with actual state levels: {})".format(
-                            device, self.device_state_level), 0, "DETECTOR")
-                        if self.actual_time >= event_time:
-                            self.run_state_request(
-                                "ON_EVENT_HOUR_DEVICE_DISCONNECT_EVENT")
-                        else:
-                            self.run_state_request(
-                                "ON_DEVICE_DISCONNECT_EVENT")
-                    elif self.device_state_level[_cnt] != 0:
-                        self.device_state_level[_cnt] -= 1
         except Exception as ex:
             debug.write(
                 "Got exception: {}-{}".format(type(ex).__name__, ex), 1)
@@ -150,11 +464,22 @@ class detector(Thread):
     def init_from_config(self):
         self.config = getConfigHandler().set_section("DETECTOR")
         self.TRACKED_IPS = self.config['TRACKED_IPS'].split(",")
-        self.device_state_level = [
-            0] * len(self.config['TRACKED_IPS'].split(","))
-        self.DEVICE_STATE_MAX = self.config.get_value('MAX_STATE_LEVEL', int)
+        self.ping_freq = self.config.get_value('PING_FREQ_SEC', int)
+        self.burst_freq = 2
+        if self.config.dev_has_option("BURST_PING_FREQ_SEC"):
+            self.burst_freq = self.config.get_value('BURST_PING_FREQ_SEC', int)
+        self.burst_freq = max(1, min(self.ping_freq, self.burst_freq))
+        _disconnect_levels = self.get_target_levels("MAX_STATE_LEVEL", 3)
+        _connect_levels = self.get_target_levels("CONNECT_STATE_LEVEL", 1)
         self.device_status = [
             False] * len(self.TRACKED_IPS)
+        self.targets = []
+        for _cnt, _ip in enumerate(self.TRACKED_IPS):
+            if _ip in ["", "_"]:
+                continue
+            self.targets.append(DetectorTarget(
+                _cnt, _ip, _connect_levels[_cnt], _disconnect_levels[_cnt]))
+        self.sources = self.get_sources()
         if self.config.dev_has_option("TRACKED_PICTURES"):
             if len(self.config["TRACKED_PICTURES"].split(',')) == len(self.config["TRACKED_IPS"].split(',')):
                 self.web = "detector.ejs"
@@ -162,6 +487,45 @@ class detector(Thread):
                 debug.write(
                     "You must provide enough TRACKED_PICTURES to match the TRACKED_IPS.", 1, "DETECTOR")
 
+    def get_sources(self):
+        _names = ["ping"]
+        if self.config.dev_has_option("PRESENCE_SOURCES") and self.config["PRESENCE_SOURCES"] != "":
+            _names = [_name.strip().lower() for _name in self.config["PRESENCE_SOURCES"].split(",")]
+        _sources = []
+        for _name in _names:
+            if _name == "ping":
+                _sources.append(PingSource(self))
+            elif _name == "neighbor":
+                _table = "/proc/net/arp"
+                if self.config.dev_has_option("NEIGHBOR_TABLE_PATH") and self.config["NEIGHBOR_TABLE_PATH"] != "":
+                    _table = self.config["NEIGHBOR_TABLE_PATH"]
+                _leases = None
+                if self.config.dev_has_option("DHCP_LEASES_PATH") and self.config["DHCP_LEASES_PATH"] != "":
+                    _leases = self.config["DHCP_LEASES_PATH"]
+                _freshness = self.ping_freq * 3
+                if self.config.dev_has_option("PASSIVE_FRESHNESS_SEC"):
+                    _freshness = self.config.get_value("PASSIVE_FRESHNESS_SEC", int)
+                _sources.append(NeighborTableSource(self, _table, _leases, _freshness))
+            else:
+                debug.write("Unknown presence source '{}'. Ignoring.".format(_name), 1, "DETECTOR")
+        if len(_sources) == 0:
+            debug.write("No valid PRESENCE_SOURCES. Falling back to ping.", 1, "DETECTOR")
+            _sources.append(PingSource(self))
+        return _sources
+
+    def get_target_levels(self, option, default):
+        """ Hysteresis levels, either a single value or one value per TRACKED_IPS entry """
+        if not self.config.dev_has_option(option) or self.config[option] == "":
+            return [default] * len(self.TRACKED_IPS)
+        _levels = [int(_level) for _level in self.config[option].split(",")]
+        if len(_levels) == 1:
+            return _levels * len(self.TRACKED_IPS)
+        if len(_levels) != len(self.TRACKED_IPS):
+            debug.write("{} must have a single value or as many values as TRACKED_IPS. Using {}.".format(
+                option, _levels[0]), 1, "DETECTOR")
+            return [_levels[0]] * len(self.TRACKED_IPS)
+        return _levels
+
     def get_web(self):
         web = ""
         pictures = self.config["TRACKED_PICTURES"].split(',')
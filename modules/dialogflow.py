@@ -2,42 +2,35 @@
 '''
     File name: dialogflow.py
     Author: Maxime Bergeron
-    Date last modified: 31/01/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The Google DIALOGFLOW receiver module for the homeserver
 '''
 
 import json
-import requests
-import ssl
 from core.common import *
 from core.devicemanager import StateRequestObject
+from core.httpserver import HomeRequestHandler, get_http_server
 from functools import partial
-from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
 
 
-class DFServer(BaseHTTPRequestHandler):
+class DFServer(HomeRequestHandler):
     def __init__(self, config, dm, *args, **kwargs):
         self.config = config
         self.dm = dm
         super().__init__(*args, **kwargs)
 
-    def _set_response(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'x-www-form-urlencoded')
-        self.end_headers()
-
     def do_GET(self):
-        self._set_response()
+        self.send_empty_response()
 
     def do_POST(self):
         """ Receives and handles POST request """
         debug.write('Getting request', 0, "DIALOGFLOW")
         data_string = self.rfile.read(int(self.headers['Content-Length']))
         request = json.loads(data_string.decode('UTF-8'))
-        self._set_response()
+        self.send_empty_response()
         action = request['queryResult']['parameters']['LightserverAction']
         groups = request['queryResult']['parameters']['LightserverGroups']
 
@@ -50,7 +43,11 @@ class DFServer(BaseHTTPRequestHandler):
 
         if self.config.get_value('AUTOMATIC_MODE', bool):
             req.set(auto_mode=True)
-        req.set(skip_time=True, group=' '.join(groups), history_origin="Dialogflow")
+        req.set(skip_time=True, history_origin="Dialogflow")
+        _resolver = self.dm.get_voice_resolver("DIALOGFLOW")
+        if not _resolver.apply(req, _resolver.resolve(' '.join(groups)), self.dm, "DIALOGFLOW"):
+            debug.write("No devices found for groups {}. Request aborted.".format(groups), 1, "DIALOGFLOW")
+            return
 
         debug.write('Running detected request: {}'.format(
             request), 0, "DIALOGFLOW")
@@ -58,25 +55,28 @@ class DFServer(BaseHTTPRequestHandler):
 
 
 class dialogflow(Thread):
+    CONFIG_SECTIONS = {"DIALOGFLOW": None, "SERVER": ("VOICE_SERVER_PORT",)}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.dm = dm
+        self.httpd = None
+        self.running = True
         self.init_from_config()
 
     def run(self):
-        self.running = True
         debug.write('Getting lightserver POST requests on port {}'
                     .format(self.port), 0, "DIALOGFLOW")
         DialogflowServerPartial = partial(DFServer, self.config, self.dm)
-        httpd = HTTPServer(('', self.port), DialogflowServerPartial)
-        httpd.socket = ssl.wrap_socket(httpd.socket,
-                                       keyfile=self.key,
-                                       certfile=self.cert, server_side=True)
         try:
-            while self.running:
-                httpd.handle_request()
+            self.httpd = get_http_server(self.port, DialogflowServerPartial, "DIALOGFLOW",
+                                         keyfile=self.key, certfile=self.cert)
+            if not self.running:
+                self.httpd.stop()
+            self.httpd.serve_forever()
         finally:
-            httpd.server_close()
+            if self.httpd is not None:
+                self.httpd.server_close()
             debug.write('Stopped.', 0, "DIALOGFLOW")
             return
 
@@ -89,8 +89,5 @@ class dialogflow(Thread):
     def stop(self):
         debug.write('Stopping.', 0, "DIALOGFLOW")
         self.running = False
-        # Needs a last call to shut down properly
-        try:
-            requests.get("http://localhost:{}/".format(self.port))
-        except requests.exceptions.ConnectionError:
-            pass
+        if self.httpd is not None:
+            self.httpd.stop()
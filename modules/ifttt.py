@@ -2,66 +2,181 @@
 '''
     File name: ifttt.py
     Author: Maxime Bergeron
-    Date last modified: 29/01/2021
+    Date last modified: 19/10/2026
     Python Version: 3.8
 
     The IFTTT receiver module for the homeserver
 '''
 
 import hashlib
-import ssl
+import hmac
 import urllib.parse
-import requests
-import unidecode
+from collections import deque
 from core.common import *
 from core.devicemanager import StateRequestObject
+from core.httpserver import HomeRequestHandler, get_http_server
+from core.statepoller import TokenBucket
 from functools import partial
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+from threading import Thread, Lock
 
+# IFTTT section options which are not actions
+IFTTT_OPTIONS = ("run_time", "automatic_mode", "salt", "protocol", "priority_groups", "global_group",
+                 "ifttt_https_certs_key", "ifttt_https_certs_cert", "replay_window_sec")
+# Failed verifications allowed per client address, then one per FAILURE_INTERVAL_SEC
+MAX_FAILURES = 5
+FAILURE_INTERVAL_SEC = 60
 
-class IFTTTServer(BaseHTTPRequestHandler):
-    def __init__(self, config, dm, *args, **kwargs):
+
+class ActionVerifier(object):
+    """ Verifies the IFTTT requests. The MAC of each configured action is computed once per config load. """
+    """ Without a replay window, action requests carry the SHA512 of SALT+action. With a replay window, """
+    """ all requests carry a timestamp, a nonce and the HMAC-SHA256 keyed with SALT of the action (or """
+    """ 'function group'), timestamp, nonce, postaction and delay separated by newlines, and a nonce is """
+    """ accepted once. Addresses failing too many verifications are refused for a while """
+
+    def __init__(self, salt, actions, replay_window=0):
+        self.replay_window = replay_window
+        self.key = salt.encode("UTF-8")
+        self.hmac = hmac.new(self.key, digestmod=hashlib.sha256)
+        # Action (lowercase, as in the config) -> preset, SHA512 of SALT+action and HMAC state after the action
+        self.actions = {}
+        for _action, _preset in actions.items():
+            self.actions[_action] = (_preset, self.get_hash(_action), self.get_mac(_action))
+        # Compared against for unknown actions, so they take as long as the known ones
+        self.unknown = hashlib.sha512(os.urandom(32)).hexdigest().encode()
+        self.lock = Lock()
+        self.nonces = set()
+        self.nonce_expiries = deque()
+        self.failures = {}
+        self.blocked = {}
+        self.last_prune = time.monotonic()
+
+    def get_hash(self, action):
+        return hashlib.sha512(self.key + action.encode("UTF-8")).hexdigest().encode()
+
+    def get_mac(self, subject):
+        _mac = self.hmac.copy()
+        _mac.update(subject.encode("UTF-8") + b"\n")
+        return _mac
+
+    def get_preset(self, action):
+        if action.lower() in self.actions:
+            return self.actions[action.lower()][0]
+        return None
+
+    def is_blocked(self, address):
+        with self.lock:
+            return self.blocked.get(address, 0) > time.monotonic()
+
+    def prune(self):
+        """ Forgets the expired blocks and the addresses whose failures were all forgiven """
+        _now = time.monotonic()
+        self.last_prune = _now
+        for _address in [_address for _address, _until in self.blocked.items() if _until <= _now]:
+            del self.blocked[_address]
+        for _address in [_address for _address, _bucket in self.failures.items()
+                         if _bucket.tokens + (_now - _bucket.last) * _bucket.rate >= _bucket.capacity]:
+            del self.failures[_address]
+
+    def fail(self, address, reason):
+        debug.write("Refused request from {}: {}".format(address, reason), 1, "IFTTT")
+        with self.lock:
+            if time.monotonic() - self.last_prune > FAILURE_INTERVAL_SEC:
+                self.prune()
+            if address not in self.failures:
+                self.failures[address] = TokenBucket(1 / FAILURE_INTERVAL_SEC, MAX_FAILURES)
+            _wait = self.failures[address].wait_time()
+            if _wait > 0:
+                self.blocked[address] = time.monotonic() + _wait
+                debug.write("Too many failed verifications from {}. Refusing its requests for {:.0f}s".format(
+                    address, _wait), 3, "IFTTT")
+        return False
+
+    def verify(self, address, postvars, subject):
+        """ Whether a request for subject (an action as received, or 'function group') is authentic """
+        _hash = postvars.get('hash', [''])[0].lower().encode("UTF-8")
+        # The hashes are precomputed for the config keys, which are lowercase
+        _known = subject in self.actions
+        if not self.replay_window:
+            if subject.lower() not in self.actions:
+                _expected = self.unknown
+            elif _known:
+                _expected = self.actions[subject][1]
+            else:
+                _expected = self.get_hash(subject)
+            if not hmac.compare_digest(_hash, _expected):
+                return self.fail(address, "hash verification failed for {}".format(subject))
+            return True
+        try:
+            _timestamp = int(postvars['timestamp'][0])
+            _nonce = postvars['nonce'][0]
+        except (KeyError, ValueError):
+            return self.fail(address, "missing timestamp or nonce")
+        if abs(time.time() - _timestamp) > self.replay_window:
+            return self.fail(address, "timestamp outside of the replay window")
+        _mac = self.actions[subject][2].copy() if _known else self.get_mac(subject)
+        _mac.update("{}\n{}\n{}\n{}".format(_timestamp, _nonce, postvars.get('postaction', [''])[0],
+                                              postvars.get('delay', [''])[0]).encode("UTF-8"))
+        if not hmac.compare_digest(_hash, _mac.hexdigest().encode()):
+            return self.fail(address, "HMAC verification failed for {}".format(subject))
+        with self.lock:
+            _now = time.monotonic()
+            while self.nonce_expiries and self.nonce_expiries[0][0] < _now:
+                self.nonces.discard(self.nonce_expiries.popleft()[1])
+            if _nonce in self.nonces:
+                _replayed = True
+            else:
+                _replayed = False
+                # Past the replay window, the timestamp alone refuses the request
+                self.nonces.add(_nonce)
+                self.nonce_expiries.append((_now + 2 * self.replay_window, _nonce))
+        if _replayed:
+            return self.fail(address, "replayed request")
+        return True
+
+
+class IFTTTServer(HomeRequestHandler):
+    def __init__(self, config, dm, verifier, *args, **kwargs):
         self.config = config
         self.dm = dm
-        self.priority_groups = []
-        if self.config.has_option("IFTTT", "PRIORITY_GROUPS"):
-            self.priority_groups = self.config["PRIORITY_GROUPS"].split(",")
-        self.global_group = None
-        if self.config.has_option("IFTTT", "GLOBAL_GROUP"):
-            self.global_group = self.config["GLOBAL_GROUP"]
+        self.verifier = verifier
         super().__init__(*args, **kwargs)
 
-    def _set_response(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'x-www-form-urlencoded')
-        self.end_headers()
-
     def do_GET(self):
-        self._set_response()
+        self.send_empty_response()
 
     def do_POST(self):
         """ Receives and handles POST request """
-        SALT = self.config["SALT"]
-        debug.write('Getting request', 0, "IFTTT")
+        _address = self.client_address[0]
         content_length = int(self.headers['Content-Length'])
         postvars = urllib.parse.parse_qs(self.rfile.read(
             content_length).decode('UTF-8'), keep_blank_values=1)
-        self._set_response()
-
-        if 'hash' in postvars:
-            _hash = postvars['hash'][0]
-            action = postvars['action'][0]
-            if _hash != hashlib.sha512(bytes(SALT.encode('utf-8') + action.encode('utf-8'))).hexdigest():
-                debug.write('Unauthorized action {}. Hash verification failed.'.format(
-                    action), 1, "IFTTT")
+        if self.verifier.is_blocked(_address):
+            self.send_empty_response(429)
+            return
+        debug.write('Getting request', 0, "IFTTT")
+        if 'action' in postvars:
+            _subject = postvars['action'][0]
+        else:
+            _subject = "{} {}".format(postvars.get('function', [''])[0], postvars.get('group', [''])[0])
+        # Without a replay window, the group requests are not signed
+        _verified = False
+        if 'action' in postvars or self.verifier.replay_window:
+            if not self.verifier.verify(_address, postvars, _subject):
+                self.send_empty_response(403)
+                return
+            _verified = True
+        self.send_empty_response()
 
-            if action in self.config:
+        if 'action' in postvars:
+            action = _subject.lower()
+            _preset = self.verifier.get_preset(action)
+            if _preset is not None:
                 debug.write('Running action : {}'.format(
-                    self.config[action]), 0, "IFTTT")
+                    _preset), 0, "IFTTT")
                 req = StateRequestObject()
                 req.initialize_dm(self.dm)
-                req.set(preset=self.config[action], history_origin="IFTTT")
+                req.set(preset=_preset, history_origin="IFTTT")
                 req()
             else:
                 debug.write('Unknown action: {}'.format(action), 1, "IFTTT")
@@ -82,66 +197,18 @@ class IFTTTServer(BaseHTTPRequestHandler):
                 req.set(skip_time=True)
                 req.set_colors([DEVICE_OFF] * len(self.dm))
 
-            requested_group = unidecode.unidecode(postvars['group'][0])
-            all_groups = [unidecode.unidecode(x) for x in self.dm.all_groups]
-            groups = []
-
-            # TODO add a proper pluralization ?
-            for group in all_groups:
-                groups.append(group.lower())
-                if group[-1:] == "s" and group[:-1] not in all_groups:
-                    groups.append(group[:-1].lower())
-                elif group + "s" not in all_groups:
-                    groups.append(group.lower() + "s")
-            if self.global_group is not None:
-                if self.global_group.lower() not in all_groups:
-                    groups.append(self.global_group.lower())
-                if self.global_group[-1:] == "s" and self.global_group[:-1].lower() not in all_groups:
-                    groups.append(self.global_group[:-1].lower())
-                elif self.global_group.lower() + "s" not in all_groups:
-                    groups.append(self.global_group.lower() + "s")
-
-            changed_groups = []
-            has_priority_group = False
-            has_global_group = False
-
-            for _group in groups:
-                if _group in requested_group.split(" "):
-                    if _group in self.priority_groups or _group + "s" in self.priority_groups or (_group[-1:] == "s" and _group[:-1] in self.priority_groups):
-                        has_priority_group = True
-                    if _group == self.global_group or _group + "s" in self.global_group or (_group[-1:] == "s" and _group[:-1] in self.global_group):
-                        has_global_group = True
-                        debug.write("Got global group. Running request on all devices.", 0, "IFTTT")
-                    if _group in all_groups:
-                        changed_groups.append(_group)
-                    elif _group + "s" in all_groups:
-                        changed_groups.append(_group + "s")
-                    elif (_group[-1:] == "s" and _group[:-1] in all_groups):
-                        changed_groups.append(_group[:-1])
-
-            if not has_global_group:
-                if len(changed_groups) != 0:
-                    req.set(group=changed_groups)
-                else:
-                    debug.write("No devices found for request {}. Request aborted.".format(
-                        requested_group), 1, "IFTTT")
-                    return
-                for _cnt, _dev in enumerate(self.dm):
-                    if _dev.mandatory_voice_group is not None and _dev.mandatory_voice_group not in changed_groups and req[_cnt] != DEVICE_SKIP:
-                        debug.write("Skipping device {} as it requires the mandatory group {}".format(
-                            _dev.name, _dev.mandatory_voice_group), 0, "IFTTT")
-                        req.set_color_for_devid(DEVICE_SKIP, _dev.devid)
-            else:
-                for _dev in self.dm:
-                    if _dev.ignore_global_group:
-                        debug.write("Skipping device {} as it ignores global group requests".format(
-                            _dev.name), 0, "IFTTT")
-                        req.set_color_for_devid(DEVICE_SKIP, _dev.devid)
+            requested_group = postvars['group'][0]
+            _resolver = self.dm.get_voice_resolver("IFTTT")
+            _resolution = _resolver.resolve(requested_group)
+            if not _resolver.apply(req, _resolution, self.dm, "IFTTT"):
+                debug.write("No devices found for request {}. Request aborted.".format(
+                    requested_group), 1, "IFTTT")
+                return
 
-            debug.write("Running function '{}' on group(s) {}".format(func, changed_groups), 0, "IFTTT")
+            debug.write("Running function '{}' on group(s) {}".format(func, _resolution.groups), 0, "IFTTT")
             if self.config.get_value('AUTOMATIC_MODE', bool):
                 req.set(auto_mode=True)
-            elif not has_priority_group:
+            elif not _resolution.priority:
                 debug.write(
                     "No priority groups called. Setting back to AUTO mode.", 0, "IFTTT")
                 req.set(reset_mode=True)
@@ -158,17 +225,19 @@ class IFTTTServer(BaseHTTPRequestHandler):
                 req()
 
         if 'postaction' in postvars:
-            post_action = postvars['postaction'][0]
+            post_action = postvars['postaction'][0].lower()
             delay = int(postvars['delay'][0]) * 60
 
-            if delay != 0:
+            if not _verified:
+                debug.write('Ignoring action {} of an unsigned request'.format(post_action), 1, "IFTTT")
+            elif delay != 0:
                 debug.write('Will run action {} in {} seconds'.format(
                     post_action, delay), 0, "IFTTT")
-                if post_action in self.config:
+                if self.verifier.get_preset(post_action) is not None:
                     req = StateRequestObject()
                     req.initialize_dm(self.dm)
                     req.set(
-                        delay=delay, preset=self.config[post_action], history_origin="IFTTT")
+                        delay=delay, preset=self.verifier.get_preset(post_action), history_origin="IFTTT")
                     if self.config.get_value('AUTOMATIC_MODE', bool):
                         req.set(auto_mode=True)
                     req()
@@ -181,26 +250,31 @@ class IFTTTServer(BaseHTTPRequestHandler):
 
 
 class ifttt(Thread):
+    CONFIG_SECTIONS = {"IFTTT": None, "SERVER": ("VOICE_SERVER_PORT",)}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.init_from_config()
         self.dm = dm
+        self.httpd = None
+        self.running = True
 
     def run(self):
-        self.running = True
         debug.write('Getting lightserver POST requests on port {} using {} protocol'
                     .format(self.port, self.protocol), 0, "IFTTT")
-        IFTTTServerPartial = partial(IFTTTServer, self.config, self.dm)
-        httpd = HTTPServer(('', self.port), IFTTTServerPartial)
-        if self.protocol == "https":
-            httpd.socket = ssl.wrap_socket(httpd.socket,
-                                           keyfile=self.key,
-                                           certfile=self.cert, server_side=True)
+        IFTTTServerPartial = partial(IFTTTServer, self.config, self.dm, self.verifier)
         try:
-            while self.running:
-                httpd.handle_request()
+            if self.protocol == "https":
+                self.httpd = get_http_server(self.port, IFTTTServerPartial, "IFTTT",
+                                             keyfile=self.key, certfile=self.cert)
+            else:
+                self.httpd = get_http_server(self.port, IFTTTServerPartial, "IFTTT")
+            if not self.running:
+                self.httpd.stop()
+            self.httpd.serve_forever()
         finally:
-            httpd.server_close()
+            if self.httpd is not None:
+                self.httpd.server_close()
             debug.write('Stopped.', 0, "IFTTT")
             return
 
@@ -212,12 +286,15 @@ class ifttt(Thread):
         if self.protocol == "https":
             self.key = get_path_from_config(self.config['IFTTT_HTTPS_CERTS_KEY'])
             self.cert = get_path_from_config(self.config['IFTTT_HTTPS_CERTS_CERT'])
+        _replay_window = 0
+        if self.config.dev_has_option("REPLAY_WINDOW_SEC"):
+            _replay_window = self.config.get_value("REPLAY_WINDOW_SEC", int)
+        _actions = {_action: _preset for _action, _preset in self.config.items("IFTTT")
+                    if _action not in IFTTT_OPTIONS}
+        self.verifier = ActionVerifier(self.config["SALT"], _actions, _replay_window)
 
     def stop(self):
         debug.write('Stopping.', 0, "IFTTT")
         self.running = False
-        # Needs a last call to shut down properly on python3.5
-        try:
-            requests.get("http://localhost:{}/".format(self.port))
-        except requests.exceptions.ConnectionError:
-            pass
+        if self.httpd is not None:
+            self.httpd.stop()
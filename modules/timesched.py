@@ -2,7 +2,7 @@
 '''
     File name: timesched.py
     Author: Maxime Bergeron
-    Date last modified: 22/06/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The time and scheduling management module for the homeserver
@@ -13,13 +13,18 @@ import re
 import subprocess
 from core.common import *
 from core.devicemanager import StateRequestObject
-from scripts.suntimes import get_sun
+from scripts.suntimes import get_sun_table
 from threading import Event, Thread
 
 
 class timesched(Thread):
+    CONFIG_SECTIONS = {"TIMESCHED": None, "SERVER": ("JOURNAL_DIR",)}
+
     def __init__(self, dm):
         Thread.__init__(self)
+        # The RUN_TIME of every module is read in fetch_modules
+        self.CONFIG_SECTIONS = dict(timesched.CONFIG_SECTIONS,
+                                    **{_mod.upper(): ("RUN_TIME",) for _mod in getModules() if _mod != "timesched"})
         self.stopevent = Event()
         self.dm = dm
         self.last_update = None
@@ -31,6 +36,7 @@ class timesched(Thread):
         self.tracked_devices_times = {}
         self.tracked_modules_times = {}
         self.always_skip_time = False
+        self.sun_table = None
         self.init_from_config()
 
     def run(self):
@@ -96,6 +102,11 @@ class timesched(Thread):
             self.event_localization_parser = self.config['EVENT_LOCALIZATION_PARSER']
         if self.config.dev_has_option("NEW_DAY_RESET_HOUR"):
             self.new_day = self.config['NEW_DAY_RESET_HOUR']
+        self.sun_table_path = get_path_from_config(
+            self.full_config['SERVER']['JOURNAL_DIR']) + "/suntimes.tbl"
+        self.sun_table = None
+        if self.event_localization is not None and self.event_localization_parser == "python":
+            self.load_sun_table()
         for _devid, _dev in enumerate(self.dm):
             if self.config.dev_has_option("DEVICE" + str(_devid)):
                 debug.write("Device {} has been configured to accept automatic requests between: '{}'".format(
@@ -103,6 +114,16 @@ class timesched(Thread):
                 self.tracked_devices_times[_devid] = self.config["DEVICE" +
                                                                  str(_devid)]
 
+    def load_sun_table(self, year=None):
+        """ Loads (or precomputes) the year-long sunrise/sunset table for the configured location """
+        self.sun_table = get_sun_table(self.event_localization, self.sun_table_path, year)
+        if self.sun_table is None:
+            debug.write("Location '{}' not found in the astral database. Sun times will fall back to defaults.".format(
+                self.event_localization), 1, "TIMESCHED")
+        else:
+            debug.write("Loaded sun times table for {} ({})".format(
+                self.sun_table.location, self.sun_table.year), 0, "TIMESCHED")
+
     def fetch_modules(self):
         for _mod in getModules():
             if self.full_config.has_section(_mod.upper()) and self.full_config.has_option(_mod.upper(), "RUN_TIME"):
@@ -115,10 +136,17 @@ class timesched(Thread):
                     self.tracked_modules_times[_mod + "_stop"] = _stopTime
                     debug.write("Module {} configured to run between {}-{}".format(
                         _mod, _startTime, _stopTime), 0, "TIMESCHED")
+                    _running = _mod in [_module.__class__.__name__ for _module in self.dm.modules]
                     if not self.verify_times(_startTime, _stopTime):
-                        debug.write("Stopping module '{}' (stopping time: {})".format(
-                            _mod, _stopTime), 0, "TIMESCHED")
-                        self.dm.shutdown_modules(remove_single_module=_mod)
+                        if _running:
+                            debug.write("Stopping module '{}' (stopping time: {})".format(
+                                _mod, _stopTime), 0, "TIMESCHED")
+                            self.dm.shutdown_modules(remove_single_module=_mod)
+                    elif not _running and _mod in self.full_config['SERVER']['MODULES'].split(","):
+                        # Stopped before a RUN_TIME change
+                        debug.write("Starting module '{}' (starting time: {})".format(
+                            _mod, _startTime), 0, "TIMESCHED")
+                        self.dm.get_modules_list(load_single_module=_mod)
 
     def check_event_time(self, request, skip_time=False):
         has_non_skipped_devices = False
@@ -202,8 +230,7 @@ class timesched(Thread):
         else:
             return now_time > starttime or now_time < stoptime
 
-    @staticmethod
-    def _update_sunset_time(localization, localization_parser):
+    def _update_sunset_time(self, localization, localization_parser):
         if localization_parser == "bash":
             p1 = subprocess.Popen('./scripts/sunset.sh %s' % str(localization), stdout=subprocess.PIPE,
                                   shell=True)
@@ -217,15 +244,14 @@ class timesched(Thread):
                     "Connection error to the sunset time server. Falling back to 18:00.", 1)
                 _time = datetime.datetime.strptime("18:00", '%H:%M').time()
         elif localization_parser == "python":
-            _time = get_sun(localization)["sunset"].time()
+            _time = self._get_sun_table_time("sunset")
             if _time is None:
                 debug.write(
                     "Failed to fetch sunset time for your city. Falling back to 18:00", 1)
                 _time = datetime.datetime.strptime("18:00", '%H:%M').time()
         return _time
 
-    @staticmethod
-    def _update_sunrise_time(localization, localization_parser):
+    def _update_sunrise_time(self, localization, localization_parser):
         if localization_parser == "bash":
             p1 = subprocess.Popen('./scripts/sunrise.sh %s' % str(localization), stdout=subprocess.PIPE,
                                   shell=True)
@@ -239,9 +265,18 @@ class timesched(Thread):
                     "Connection error to the sunset time server. Falling back to 06:00.", 1)
                 _time = datetime.datetime.strptime("06:00", '%H:%M').time()
         elif localization_parser == "python":
-            _time = get_sun(localization)["sunrise"].time()
+            _time = self._get_sun_table_time("sunrise")
             if _time is None:
                 debug.write(
-                    "Failed to fetch sunset time for your city. Falling back to 06:00", 1)
+                    "Failed to fetch sunrise time for your city. Falling back to 06:00", 1)
                 _time = datetime.datetime.strptime("06:00", '%H:%M').time()
         return _time
+
+    def _get_sun_table_time(self, event):
+        _today = datetime.date.today()
+        if self.sun_table is not None and self.sun_table.year != _today.year:
+            # New year, precompute the next table
+            self.load_sun_table(_today.year)
+        if self.sun_table is None:
+            return None
+        return self.sun_table.get(_today, event)
@@ -2,7 +2,7 @@
 '''
     File name: updater.py
     Author: Maxime Bergeron
-    Date last modified: 20/05/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The updater module for the homeserver
@@ -70,6 +70,8 @@ def run_upgrade(dm):
 
 
 class updater(Thread):
+    CONFIG_SECTIONS = {"UPDATER": None}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.stopevent = Event()
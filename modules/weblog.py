@@ -2,17 +2,176 @@
 '''
     File name: weblog.py
     Author: Maxime Bergeron
-    Date last modified: 31/10/2019
-    Python Version: 3.5
+    Date last modified: 19/10/2026
+    Python Version: 3.7
 
     A web debug log access tool module
 '''
 
+import html
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
 from core.common import *
-from threading import Thread
+from threading import Thread, Lock
+
+LOG_INDEX_MAGIC = b"HLOGIDX1"
+# Number of lines returned per page
+LOG_PAGE_LINES = 500
+# Minimum time between two sidecar index saves
+LOG_INDEX_SAVE_SEC = 60
+
+
+class LogIndex(object):
+    """ Line offsets index of a journal file, per debug level, with a sidecar file """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.lock = Lock()
+        self.last_save = 0
+        self.reset()
+        self.load()
+
+    def reset(self, inode=None):
+        self.inode = inode
+        self.size = 0
+        self.offsets = {"all": array('Q')}
+
+    def load(self):
+        try:
+            with open(self.index_path, "rb") as _f:
+                if _f.read(len(LOG_INDEX_MAGIC)) != LOG_INDEX_MAGIC:
+                    return
+                _inode, _size, _levels = struct.unpack("<QQI", _f.read(20))
+                _offsets = {}
+                for _ in range(_levels):
+                    _name = _f.read(struct.unpack("<B", _f.read(1))[0]).decode("UTF-8")
+                    _count = struct.unpack("<Q", _f.read(8))[0]
+                    _offsets[_name] = array('Q')
+                    _offsets[_name].fromfile(_f, _count)
+        except (IOError, EOFError, struct.error, UnicodeDecodeError):
+            return
+        self.inode = _inode
+        self.size = _size
+        self.offsets = _offsets
+        self.offsets.setdefault("all", array('Q'))
+
+    def save(self):
+        try:
+            with open(self.index_path + ".tmp", "wb") as _f:
+                _f.write(LOG_INDEX_MAGIC)
+                _f.write(struct.pack("<QQI", self.inode or 0, self.size, len(self.offsets)))
+                for _name, _offsets in self.offsets.items():
+                    _f.write(struct.pack("<B", len(_name)) + _name.encode("UTF-8"))
+                    _f.write(struct.pack("<Q", len(_offsets)))
+                    _offsets.tofile(_f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.last_save = time.monotonic()
+        except IOError as ex:
+            debug.write("Could not save log index {}: {}".format(
+                self.index_path, ex), 1, "WEBLOG")
+
+    @staticmethod
+    def get_level(line):
+        """ Level of a '(date) - [LEVEL] message' journal line """
+        _start = line.find(b" - [", 0, 40)
+        if _start == -1:
+            return None
+        _end = line.find(b"]", _start + 4, _start + 16)
+        if _end == -1:
+            return None
+        return line[_start + 4:_end].decode("UTF-8", errors="ignore").lower()
+
+    def update(self, mm, inode, size):
+        """ Indexes the complete lines appended since the last update """
+        if inode != self.inode or size < self.size:
+            # Rotated or truncated journal
+            self.reset(inode)
+        _pos = self.size
+        _all = self.offsets["all"]
+        while _pos < size:
+            _end = mm.find(b"\n", _pos, size)
+            if _end == -1:
+                # Partial line still being written
+                break
+            _all.append(_pos)
+            _level = self.get_level(mm[_pos:min(_end, _pos + 40)])
+            if _level is not None:
+                self.offsets.setdefault(_level, array('Q')).append(_pos)
+            _pos = _end + 1
+        if _pos != self.size:
+            self.size = _pos
+            if time.monotonic() - self.last_save > LOG_INDEX_SAVE_SEC:
+                self.save()
+
+    def _read(self, handler):
+        """ Runs handler(mm) on an up-to-date index of the journal, under the index lock """
+        with self.lock:
+            try:
+                with open(self.path, "rb") as _f:
+                    _stat = os.fstat(_f.fileno())
+                    if _stat.st_size == 0:
+                        self.reset(_stat.st_ino)
+                        return handler(None)
+                    with mmap.mmap(_f.fileno(), _stat.st_size, access=mmap.ACCESS_READ) as mm:
+                        self.update(mm, _stat.st_ino, _stat.st_size)
+                        return handler(mm)
+            except FileNotFoundError:
+                self.reset()
+                return handler(None)
+
+    def _lines(self, mm, offsets, start, end):
+        _lines = []
+        for _offset in offsets[start:end]:
+            _lines.append(mm[_offset:mm.find(b"\n", _offset) + 1].decode("UTF-8", errors="replace"))
+        return "".join(_lines)
+
+    def get_page(self, level="all", count=LOG_PAGE_LINES, before=None):
+        """ Newest count lines of a level, optionally before a line number of that level """
+        def _handler(mm):
+            _offsets = self.offsets.get(level, array('Q'))
+            _end = len(_offsets)
+            if before is not None:
+                _end = max(0, min(before, _end))
+            _start = max(0, _end - count)
+            _page = {"lines": "", "first": _start, "cursor": self.get_cursor()}
+            if mm is not None:
+                _page["lines"] = self._lines(mm, _offsets, _start, _end)
+            return _page
+        return self._read(_handler)
+
+    def get_tail(self, level="all", cursor=None, count=LOG_PAGE_LINES):
+        """ Lines of a level appended since a cursor. Falls back to the newest page on rotation """
+        try:
+            _inode, _position = [int(_val) for _val in cursor.split(":")]
+        except (AttributeError, ValueError):
+            _inode, _position = None, None
+
+        def _handler(mm):
+            if mm is None or _inode != self.inode or _position > self.size:
+                return None
+            _offsets = self.offsets.get(level, array('Q'))
+            _start = bisect_left(_offsets, _position)
+            _start = max(_start, len(_offsets) - count)
+            return {"lines": self._lines(mm, _offsets, _start, len(_offsets)),
+                    "cursor": self.get_cursor(), "reset": False}
+        _tail = self._read(_handler)
+        if _tail is None:
+            _tail = self.get_page(level, count)
+            _tail["reset"] = True
+        return _tail
+
+    def get_cursor(self):
+        return "{}:{}".format(self.inode or 0, self.size)
 
 
 class weblog(Thread):
+    CONFIG_SECTIONS = {"SERVER": ("JOURNAL_DIR",)}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.init_from_config()
@@ -27,10 +186,14 @@ class weblog(Thread):
     def stop(self):
         debug.write("Stopped.", 0, "WEBLOG")
         self.running = False
+        with self.log_index.lock:
+            self.log_index.save()
         pass
 
     def init_from_config(self):
         self.config = getConfigHandler()
+        self.log_index = LogIndex(get_path_from_config(
+            self.config['SERVER']['JOURNAL_DIR']) + "/home.0.log")
 
     def get_web(self, level="all"):
         web = """
@@ -45,13 +208,16 @@ class weblog(Thread):
 }
 </style>
         """
-        with open(get_path_from_config(self.config['SERVER']['JOURNAL_DIR']) + "/home.0.log", "r") as jfile:
-            _logfile = jfile.readlines()
-        _logstr = ""
-        for _line in _logfile:
-            if level == 'all' or "[" + level.upper() + "]" in _line:
-                _logstr += _line
+        _page = self.log_index.get_page(level)
+        _logstr = _page["lines"]
         if _logstr == "":
             _logstr = "- No logs found for this level -"
-        web += '<textarea id="debugarea">{}</textarea>'.format(_logstr)
+        web += '<textarea id="debugarea" data-level="{}" data-cursor="{}" data-first="{}">{}</textarea>'.format(
+            html.escape(level), _page["cursor"], _page["first"], html.escape(_logstr))
         return web
+
+    def get_tail(self, level="all", cursor=None):
+        return self.log_index.get_tail(level, cursor)
+
+    def get_page(self, level="all", before=None):
+        return self.log_index.get_page(level, before=before)
@@ -2,59 +2,110 @@
 '''
     File name: webserver.py
     Author: Maxime Bergeron
-    Date last modified: 29/12/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     The web server interface module for the homeserver
 '''
 
+import gzip
+import hashlib
 import json
 import os
 import re
-import requests
-import ssl
 import time
 import traceback
 import urllib.parse
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from core.common import *
 from core.devicemanager import StateRequestObject, ExecutionState
+from core.httpserver import HomeRequestHandler, get_http_server
+from email.utils import formatdate, parsedate_to_datetime
 from functools import partial
 from http.server import SimpleHTTPRequestHandler
-from html.parser import HTMLParser
 from io import BytesIO
-from shutil import copyfile
-from socketserver import ThreadingMixIn, TCPServer
-from threading import Thread
+from threading import Thread, Lock
 from web.texts import getTextHTML
 
+# <tl>text</tl> tags (html and xml files) and _(text) markers (html and js files)
+TAG_TRANSLATABLE = re.compile(r'<tl>((?s:.*?))</tl>')
+TRANSLATABLE = re.compile(r'<tl>((?s:.*?))</tl>|\_\((.*?)\)')
+MARKER_TRANSLATABLE = re.compile(r'\_\((.*?)\)')
+
+
+def translate_match(match):
+    _translatable = match.group(1)
+    if _translatable is None:
+        _translatable = match.group(2)
+    return getTextHTML(_translatable.replace("\\", ""))
+
+
+class RenderedPage(object):
+    """ A translated page with its pre-compressed variants and validators """
+
+    def __init__(self, mtime, body, content_type):
+        self.mtime = mtime
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.encoded = {"gzip": gzip.compress(body)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(body)
+
+    def get_encoding(self, accept_encoding):
+        """ Returns the best (encoding, content) for an Accept-Encoding header """
+        _accepted = [_enc.split(";")[0].strip() for _enc in accept_encoding.split(",")]
+        for _encoding in ["br", "gzip"]:
+            if _encoding in _accepted and _encoding in self.encoded:
+                return _encoding, self.encoded[_encoding]
+        return None, self.body
+
+    def is_not_modified(self, headers):
+        if headers.get("If-None-Match") is not None:
+            _tags = [_tag.strip().replace("W/", "") for _tag in headers["If-None-Match"].split(",")]
+            return self.etag in _tags or "*" in _tags
+        if headers.get("If-Modified-Since") is not None:
+            try:
+                return parsedate_to_datetime(headers["If-Modified-Since"]).timestamp() >= int(self.mtime)
+            except (TypeError, ValueError):
+                return False
+        return False
 
-class ThreadingSimpleServer(ThreadingMixIn, TCPServer):
-    pass
 
+class RenderCache(object):
+    """ Translated pages, per file, language and user suffix. Invalidated by file mtime """
 
-class HTMLGettextTranslator(HTMLParser):
     def __init__(self):
-        super().__init__()
-        self.has_tag = False
-        self.data = []
-
-    def handle_starttag(self, tag, attributes):
-        if tag != 'tl':
-            return
-        self.has_tag = True
-
-    def handle_endtag(self, tag):
-        if tag == 'tl':
-            self.has_tag = False
-
-    def handle_data(self, data):
-        if self.has_tag:
-            self.data.append(data)
-
-
-class WebServerHandler(SimpleHTTPRequestHandler):
-    def __init__(self, config, dm, *args, **kwargs):
-        self.config = config
+        self.lock = Lock()
+        self.pages = {}
+
+    def get(self, path, content_type, pattern, decoder="unicode_escape", suffix=""):
+        _mtime = os.stat(path).st_mtime
+        _key = (path, language.getLanguage(), suffix)
+        with self.lock:
+            _page = self.pages.get(_key)
+        if _page is not None and _page.mtime == _mtime:
+            return _page
+        with open(path, 'rb') as f:
+            _text = str(f.read().decode(decoder))
+        _text = pattern.sub(translate_match, _text) + suffix
+        _page = RenderedPage(_mtime, _text.encode('utf-8'), content_type)
+        with self.lock:
+            self.pages[_key] = _page
+        return _page
+
+
+render_cache = RenderCache()
+
+
+class WebServerHandler(HomeRequestHandler, SimpleHTTPRequestHandler):
+    def __init__(self, dm, *args, **kwargs):
+        # Current config snapshot, swapped by the config reloads
+        self.config = getConfigHandler()
         self.dm = dm
         self.dm_host = self.config['SERVER']['HOST']
         self.dm_port = self.config.get_value('PORT', int, parent="SERVER")
@@ -67,11 +118,6 @@ class WebServerHandler(SimpleHTTPRequestHandler):
     def translate_path(self, path):
         return SimpleHTTPRequestHandler.translate_path(self, './web' + path)
 
-    def _set_response(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'x-www-form-urlencoded')
-        self.end_headers()
-
     def do_GET(self):
         if self.config["WEBSERVER"]["SECURITY"] == "restrictive":
             if not self.allowed_ips:
@@ -82,67 +128,75 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                             self.allowed_ips.append(_ip)
                 except KeyError:
                     debug.write("Users need to be configured for 'restrictive' security.", 1, "WEBSERVER")
+                    self.send_error(403)
                     return
             if self.client_address[0] not in self.allowed_ips:
                 _path = os.path.join(
                     self.translate_path(self.path), "index.html")
                 _page = "<!doctype html><html><body><h1>You cannot access this page.</h1></body></html>"
-                self.send_response(200)
-                self.send_header("Content-type", super().guess_type(_path))
-                self.send_header("Content-length", len(_page))
-                self.end_headers()
-                self.wfile.write(_page.encode('utf-8'))
+                self.send_bytes(_page.encode('utf-8'), self.guess_type(_path))
+                return
 
         elif self.config["WEBSERVER"]["SECURITY"] != "permissive":
             debug.write("Unknown security level for webserver: {}".format(
                 self.config["WEBSERVER"]["SECURITY"]), 1)
+            self.send_error(403)
             return
         try:
             if ".html" in self.path or ".js" in self.path or self.path == "/":
                 _path = self.translate_path(self.path)
                 if self.path == "/":
                     _path = os.path.join(_path, "index.html")
-                with open(_path, 'rb') as f:
-                    _page = str(f.read().decode("unicode_escape"))
-                    tagmatch = []
-                    if ".html" in _path:
-                        _parser = HTMLGettextTranslator()
-                        _parser.feed(_page)
-                        tagmatch = _parser.data
-                        _parser.close()
-                    match = re.findall(r'\_\((.*?)\)', _page)
-                    for _translatable in tagmatch:
-                        _page = _page.replace(
-                            "<tl>" + _translatable + "</tl>", getTextHTML(_translatable.replace("\\", "")))
-                    for _translatable in match:
-                        _page = _page.replace(
-                            "_(" + _translatable + ")", getTextHTML(_translatable.replace("\\", "")))
-                    if self.path == "/":
-                        try:
-                            for _user in self.config["USERS"]:
-                                _ips = self.config["USERS"][_user].split(",")
-                                if self.client_address[0] in _ips:
-                                    debug.write("{} connected to the webserver".format(
-                                        _user.title()), 0, "WEBSERVER")
-                                    _page += '<script>setTimeout(function(){{$("#detector-user-name").html(" {}")}}, 500)</script>'.format(
-                                        _user.split(" ")[0].title())
-                                    for _ip in _ips:
-                                        _page += '<style>img[ip="{}"]{{box-shadow:0px 0px 5px 5px #B0C4DE; }}</style>'.format(
-                                            _ip)
-                        except KeyError:
-                            debug.write("User tracking support disabled.", 0, "WEBSERVER")
-                    self.send_response(200)
-                    self.send_header("Content-type", super().guess_type(_path))
-                    if self.path != "/":
-                        self.send_header("Content-length", len(_page))
-                    self.end_headers()
-                    self.wfile.write(_page.encode('utf-8'))
+                _suffix = ""
+                if self.path == "/":
+                    try:
+                        for _user in self.config["USERS"]:
+                            _ips = self.config["USERS"][_user].split(",")
+                            if self.client_address[0] in _ips:
+                                debug.write("{} connected to the webserver".format(
+                                    _user.title()), 0, "WEBSERVER")
+                                _suffix += '<script>setTimeout(function(){{$("#detector-user-name").html(" {}")}}, 500)</script>'.format(
+                                    _user.split(" ")[0].title())
+                                for _ip in _ips:
+                                    _suffix += '<style>img[ip="{}"]{{box-shadow:0px 0px 5px 5px #B0C4DE; }}</style>'.format(
+                                        _ip)
+                    except KeyError:
+                        debug.write("User tracking support disabled.", 0, "WEBSERVER")
+                if ".html" in _path:
+                    _pattern = TRANSLATABLE
+                else:
+                    _pattern = MARKER_TRANSLATABLE
+                self.send_page(render_cache.get(_path, self.guess_type(_path), _pattern, suffix=_suffix))
             else:
                 super().do_GET()
         except BrokenPipeError:
             pass
+        except FileNotFoundError:
+            self.send_error(404)
         except Exception as ex:
             debug.write("Got exception {} in GET request: {}".format(type(ex).__name__, ex), 1)
+            self.send_error(500)
+
+    def send_page(self, page):
+        """ Sends a cached page, compressed if possible, or a 304 if the client copy is fresh """
+        if page.is_not_modified(self.headers):
+            self.send_response(304)
+            self.send_header("ETag", page.etag)
+            self.send_header("Last-Modified", page.last_modified)
+            self.end_headers()
+            return
+        _encoding, _content = page.get_encoding(self.headers.get("Accept-Encoding", ""))
+        self.send_response(200)
+        self.send_header("Content-type", page.content_type)
+        if _encoding is not None:
+            self.send_header("Content-Encoding", _encoding)
+        self.send_header("Content-length", len(_content))
+        self.send_header("ETag", page.etag)
+        self.send_header("Last-Modified", page.last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(_content)
 
     def do_POST(self):
         try:
@@ -157,7 +211,6 @@ class WebServerHandler(SimpleHTTPRequestHandler):
             request = postvars[b'request'][0].decode(
                 'utf-8') in ["True", "true", True]
             reqtype = postvars[b'reqtype'][0].decode('utf-8')
-            self._set_response()
             response = BytesIO()
             if request:
                 if reqtype == "getstate":
@@ -289,26 +342,17 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                     section = str(postvars[b'section'][0].decode('utf-8'))
                     configdata = json.loads(urllib.parse.unquote(
                         postvars[b'configdata'][0].decode('utf-8')))
-                    has_changes = False
+                    edits = []
                     for entry in configdata:
                         if self.config[section.upper()][entry] != configdata[entry]:
                             debug.write("Changing configuration entry {} to {}".format(
                                 entry.upper(), configdata[entry]), 0, "WEBSERVER")
-                            self.config.set(section.upper(),
-                                            entry.upper(), configdata[entry])
-                            has_changes = True
-                    if has_changes:
-                        debug.write(
-                            "Changing local config file and creating backup 'home.old'", 0, "WEBSERVER")
-                        with open('home.ini', 'w') as configfile:
-                            copyfile('home.ini', 'home.old')
-                            self.config.write(configfile)
-                        self.dm.reload_configs()
-                        return
+                            edits.append((section.upper(), entry.upper(), configdata[entry]))
+                    if edits:
+                        self.dm.update_config(edits)
 
                 if reqtype == "reloadconfig":
                     self.dm.reload_configs()
-                    return
 
                 if reqtype == "getdebuglog":
                     debuglevel = postvars[b'debuglevel'][0].decode('utf-8')
@@ -323,6 +367,31 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                     else:
                         response.write(content.encode("UTF-8"))
 
+                if reqtype in ["getdebuglogtail", "getdebuglogpage"]:
+                    debuglevel = postvars[b'debuglevel'][0].decode('utf-8')
+                    content = None
+                    for _mod in self.dm.modules:
+                        if _mod.__class__.__name__ == "weblog":
+                            if reqtype == "getdebuglogtail":
+                                content = _mod.get_tail(debuglevel, postvars[b'cursor'][0].decode('utf-8'))
+                            else:
+                                content = _mod.get_page(debuglevel, int(postvars[b'before'][0].decode('utf-8')))
+                    if content is None:
+                        debug.write('Cannot find module weblog', 1, "WEBSERVER")
+                        response.write("0".encode("UTF-8"))
+                    else:
+                        response.write(json.dumps(content).encode("UTF-8"))
+
+                if reqtype == "getenergy":
+                    devid = None
+                    if b'devid' in postvars:
+                        devid = int(postvars[b'devid'][0].decode('utf-8'))
+                    response.write(json.dumps(self.dm.get_energy(devid)).encode("UTF-8"))
+
+                if reqtype == "gethistory":
+                    devid = int(postvars[b'devid'][0].decode('utf-8'))
+                    response.write(json.dumps(self.dm.get_device_history(devid)).encode("UTF-8"))
+
                 if reqtype == "reconnect":
                     devid = int(postvars[b'devid'][0].decode('utf-8'))
                     self.dm[devid].reconnect()
@@ -335,16 +404,8 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                     response.write("1".encode("UTF-8"))
 
                 if reqtype == "getconfigxml":
-                    with open("core/configurables.xml", "r") as _f:
-                        _parser = HTMLGettextTranslator()
-                        _page = _f.read()
-                        _parser.feed(_page)
-                        tagmatch = _parser.data
-                        _parser.close()
-                        for _translatable in tagmatch:
-                            _page = _page.replace(
-                                "<tl>" + _translatable + "</tl>", getTextHTML(_translatable.replace("\\", "")))
-                        response.write(_page.encode("UTF-8"))
+                    response.write(render_cache.get(
+                        "core/configurables.xml", "text/xml", TAG_TRANSLATABLE, decoder="utf-8").body)
 
                 if reqtype == "getpresets":
                     presets = {}
@@ -354,18 +415,15 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                     presets["preset"] = []
                     presets["results"] = []
                     presets["hidden"] = []
-                    for _preset in self.config["PRESETS"].items():
-                        req = StateRequestObject()
-                        req.initialize_dm(self.dm)
-                        if _preset[0] != "automatic_mode" and req.from_string(_preset[1]):
-                            presets["items"].append(_preset[0])
-                            presets["preset"].append(_preset[1].replace("True", "true").replace("False", "false"))
-                            presets["descriptions"].append(str(req))
-                            presets["results"].append(req.colors)
-                            if _preset[0] in self.hidden_presets:
-                                presets["hidden"].append("1")
-                            else:
-                                presets["hidden"].append("0")
+                    for _preset in self.dm.presets.items():
+                        presets["items"].append(_preset.name)
+                        presets["preset"].append(_preset.source.replace("True", "true").replace("False", "false"))
+                        presets["descriptions"].append(_preset.description)
+                        presets["results"].append(list(_preset.colors))
+                        if _preset.name in self.hidden_presets:
+                            presets["hidden"].append("1")
+                        else:
+                            presets["hidden"].append("0")
 
                     response.write(json.dumps(presets).encode("UTF-8"))
 
@@ -379,14 +437,8 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                     req = StateRequestObject()
                     req.initialize_dm(self.dm)
                     if req.from_string(preset):
-                        self.config.set("PRESETS", presetname.upper(), preset)
+                        self.dm.update_config([("PRESETS", presetname.upper(), preset)])
                         response.write("1".encode("UTF-8"))
-                        debug.write(
-                            "Changing local config file and creating backup 'home.old'", 0, "WEBSERVER")
-                        with open('home.ini', 'w') as configfile:
-                            copyfile('home.ini', 'home.old')
-                            self.config.write(configfile)
-                        self.dm.reload_configs()
                     else:
                         response.write("0".encode("UTF-8"))
 
@@ -414,41 +466,42 @@ class WebServerHandler(SimpleHTTPRequestHandler):
                         str(postvars[b'rooms'][0].decode("UTF-8"))))
                     debug.write("Changing room groups to {}".format(
                         rooms), 0, "WEBSERVER")
+                    self.dm.update_config([("WEBSERVER", "ROOM_GROUPS", rooms)])
                     response.write("1".encode("UTF-8"))
-                    self.config.set("WEBSERVER", "ROOM_GROUPS", rooms)
-                    with open('home.ini', 'w') as configfile:
-                        copyfile('home.ini', 'home.old')
-                        self.config.write(configfile)
-                    self.dm.reload_configs()
 
                 if reqtype == "setpresetview":
                     presetlist = urllib.parse.unquote(json.loads(
                         str(postvars[b'presetlist'][0].decode("UTF-8"))))
                     debug.write("Changing preset visibility to {}".format(
                         presetlist), 0, "WEBSERVER")
+                    self.dm.update_config([("WEBSERVER", "HIDDEN_PRESETS", presetlist)])
                     response.write("1".encode("UTF-8"))
-                    self.config.set("WEBSERVER", "HIDDEN_PRESETS", presetlist)
-                    with open('home.ini', 'w') as configfile:
-                        copyfile('home.ini', 'home.old')
-                        self.config.write(configfile)
-                    self.dm.reload_configs()
 
                 # ADD NECESSARY WEBSERVER REQUESTS HERE #
 
             else:
                 response.write("No request or unknown request".encode("UTF-8"))
-            self.wfile.write(response.getvalue())
+            self.send_bytes(response.getvalue())
 
+        except BrokenPipeError:
+            pass
         except Exception as ex:
             debug.write("Got exception in POST request: ({}) - {}, {}".format(
                 type(ex).__name__, ex, traceback.format_exc()), 1)
+            self.send_error(500)
 
 
 class webserver(Thread):
+    CONFIG_SECTIONS = {"WEBSERVER": None, "USERS": None, "SERVER": ("HOST", "PORT", "WEBSERVER_PORT")}
+    # Read by the request handlers on each request
+    LIVE_CONFIG = {"WEBSERVER": ("SECURITY", "ROOM_GROUPS", "HIDDEN_PRESETS"), "USERS": None}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.init_from_config()
         self.dm = dm
+        self.httpd = None
+        self.running = True
         debug.write("", 0)
         debug.write("****************************************************************", 0)
         debug.write("*** This legacy webserver module is deprecated and will not  ***", 0)
@@ -462,22 +515,21 @@ class webserver(Thread):
         debug.write("", 0)
 
     def run(self):
-        self.running = True
         debug.write("Starting control webserver on port {}".format(
             self.port), 0, "WEBSERVER")
-        TCPServer.allow_reuse_address = True
-        _handler = partial(WebServerHandler, self.config, self.dm)
-        # httpd = socketserver.TCPServer(("", self.port), _handler)
-        httpd = ThreadingSimpleServer(("", self.port), _handler)
-        if self.protocol == "https":
-            httpd.socket = ssl.wrap_socket(httpd.socket,
-                                           keyfile=self.key,
-                                           certfile=self.cert, server_side=True)
+        _handler = partial(WebServerHandler, self.dm)
         try:
-            while self.running:
-                httpd.handle_request()
+            if self.protocol == "https":
+                self.httpd = get_http_server(self.port, _handler, "WEBSERVER",
+                                             keyfile=self.key, certfile=self.cert)
+            else:
+                self.httpd = get_http_server(self.port, _handler, "WEBSERVER")
+            if not self.running:
+                self.httpd.stop()
+            self.httpd.serve_forever()
         finally:
-            httpd.server_close()
+            if self.httpd is not None:
+                self.httpd.server_close()
             debug.write("Stopped.", 0, "WEBSERVER")
             return
 
@@ -493,8 +545,5 @@ class webserver(Thread):
     def stop(self):
         debug.write("Stopping.", 0, "WEBSERVER")
         self.running = False
-        # Needs a last call to shut down properly on python3.5
-        try:
-            requests.get("http://localhost:{}/".format(self.port))
-        except requests.exceptions.ConnectionError:
-            pass
+        if self.httpd is not None:
+            self.httpd.stop()
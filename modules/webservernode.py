@@ -2,7 +2,7 @@
 '''
     File name: webservernode.py
     Author: Maxime Bergeron
-    Date last modified: 21/01/2021
+    Date last modified: 19/10/2026
     Python Version: 3.8
 
     The web server interface with nodeJS support module for the homeserver
@@ -17,18 +17,22 @@ import urllib3
 import urllib.parse
 from core.common import *
 from core.devicemanager import StateRequestObject, ExecutionState
-from shutil import copyfile
-from threading import Thread
-try:
-    from queue import Queue, Empty
-except ImportError:
-    from Queue import Queue, Empty
+from threading import Thread, Event, Lock
+
+# Time window (seconds) used to batch bursts of state changes into a single update
+UPDATE_BATCH_WINDOW = 0.1
 
 
 class webservernode(Thread):
+    CONFIG_SECTIONS = {"WEBSERVER": None, "SERVER": ("WEBSERVER_PORT",)}
+    LIVE_CONFIG = {"WEBSERVER": ("ROOM_GROUPS", "HIDDEN_PRESETS")}
+
     def __init__(self, dm):
         Thread.__init__(self)
         self.server_process = None
+        self.changed = Event()
+        self.changed_lock = Lock()
+        self.changed_devices = set()
         self.init_from_config()
         self.dm = dm
         _req_sess = requests.Session()
@@ -42,8 +46,6 @@ class webservernode(Thread):
         self.running = True
         debug.write("Starting control webserver-node on port {}".format(
             self.port), 0, "WEBSERVERNODE")
-        _lastStatus = {}
-        _lastStatus["state"] = "0"
         try:
             # TODO check for node.js install & packages
             _request = ""
@@ -58,62 +60,80 @@ class webservernode(Thread):
             time.sleep(5)
             self.server_process = subprocess.Popen(
                 _request, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            q = Queue()
-            t = Thread(target=webservernode.enqueue_output,
-                       args=(self.server_process.stdout, q))
+            t = Thread(target=webservernode.forward_output,
+                       args=(self.server_process.stdout,))
             t.daemon = True
             t.start()
+            while not self.dm.running and self.running:
+                # TODO Fix race condition between module load and DM state getter?
+                time.sleep(1)
+            self.dm.add_state_listener(self.on_state_change)
+            # Pushes the initial states once connected
+            self.on_state_change(None)
             while self.running:
-                while not self.dm.running:
-                    # TODO Fix race condition between module load and DM state getter?
-                    time.sleep(1)
-                actualStatus = self.dm(sync_only_states=True)
-                if actualStatus["state"] != _lastStatus["state"] and self.running:
-                    debug.write("Sending update to websocket",
-                                0, "WEBSERVERNODE")
-                    try:
-                        if not _req_sess_isconnected:
-                            time.sleep(2)
-                            self.sio.connect(
-                                '{}://localhost:{}'.format(self.protocol, self.port), transports="websocket")
-                            self.sio.on('query', self.query)
-                            _req_sess_isconnected = True
-                            time.sleep(2)
-                        self.sio.emit('set_hs_socket')
-                        self.sio.emit('update_state', json.dumps(actualStatus))
-                    except Exception as ex:
-                        debug.write(
-                            "Failed to connect to websocket. Retrying", 1, "WEBSERVERNODE")
-                        debug.write("Got error: {}".format(
-                            ex), 1, "WEBSERVERNODE")
-                        self.sio.disconnect()
-                        _req_sess_isconnected = False
+                self.changed.wait()
+                if not self.running:
+                    break
+                # Lets bursts of changes (group or preset requests) settle in a single update
+                time.sleep(UPDATE_BATCH_WINDOW)
+                self.changed.clear()
+                with self.changed_lock:
+                    _devices = self.changed_devices
+                    self.changed_devices = set()
+                try:
+                    if not _req_sess_isconnected:
                         time.sleep(2)
-                        continue
-                _lastStatus = actualStatus
-
-                while True:
-                    try:
-                        line = q.get_nowait()  # or q.get(timeout=.1)
-                    except Empty:
-                        break
-                    else:
-                        debug.write("(NODE.JS) {}".format(
-                            line.rstrip().decode("UTF-8")), 0, "WEBSERVERNODE")
-
-                time.sleep(1)
+                        self.sio.connect(
+                            '{}://localhost:{}'.format(self.protocol, self.port), transports="websocket")
+                        self.sio.on('query', self.query)
+                        _req_sess_isconnected = True
+                        time.sleep(2)
+                        self.sio.emit('set_hs_socket')
+                    debug.write("Sending update to websocket for devices {}".format(
+                        sorted(_devices)), 0, "WEBSERVERNODE")
+                    self.sio.emit('update_state', json.dumps(self.get_state_diff(_devices)))
+                except Exception as ex:
+                    debug.write(
+                        "Failed to connect to websocket. Retrying", 1, "WEBSERVERNODE")
+                    debug.write("Got error: {}".format(
+                        ex), 1, "WEBSERVERNODE")
+                    self.sio.disconnect()
+                    _req_sess_isconnected = False
+                    # Keeps the unsent changes for the next attempt
+                    with self.changed_lock:
+                        self.changed_devices |= _devices
+                    self.changed.set()
+                    time.sleep(2)
 
         except Exception as ex:
             debug.write("GOT ERROR {}".format(ex), 1, "WEBSERVERNODE")
 
         finally:
-            self.server_process.terminate()
-            self.server_process.wait()
+            self.dm.remove_state_listener(self.on_state_change)
+            if self.server_process is not None:
+                self.server_process.terminate()
+                self.server_process.wait()
             subprocess.Popen("/usr/bin/killall node", shell=True)
             self.sio.disconnect()
             debug.write("Stopped.", 0, "WEBSERVERNODE")
             return
 
+    def on_state_change(self, devid):
+        """ DeviceManager state listener. A None devid means all devices """
+        with self.changed_lock:
+            if devid is None:
+                self.changed_devices.update(range(len(self.dm)))
+            else:
+                self.changed_devices.add(devid)
+        self.changed.set()
+
+    def get_state_diff(self, devices):
+        """ Builds the per-device state update, with the (cheap) group states """
+        _diff = {}
+        for _devid in devices:
+            _diff[str(_devid)] = self.dm.get_web_state(_devid)
+        return {"diff": _diff, "groupstates": self.dm.get_group_states}
+
     def init_from_config(self):
         self.config = getConfigHandler()
         self.port = self.config.get_value(
@@ -130,10 +150,13 @@ class webservernode(Thread):
     def stop(self):
         debug.write("Stopping.", 0, "WEBSERVERNODE")
         self.running = False
+        self.changed.set()
 
     def query(self, reqquery):
         reqtype = reqquery["reqtype"]
         _response = False
+        # Current config snapshot, swapped by the config reloads
+        self.config = getConfigHandler()
 
         debug.write("Handling query {}".format(reqquery), 0, "WEBSERVERNODE")
 
@@ -263,21 +286,14 @@ class webservernode(Thread):
             section = str(reqquery['section'])
             configdata = json.loads(urllib.parse.unquote(
                 reqquery['configdata']))
-            has_changes = False
+            edits = []
             for entry in configdata:
                 if self.config[section.upper()][entry] != configdata[entry]:
                     debug.write("Changing configuration entry {} to {}".format(
                         entry.upper(), configdata[entry]), 0, "WEBSERVERNODE")
-                    self.config.set(section.upper(),
-                                    entry.upper(), configdata[entry])
-                    has_changes = True
-            if has_changes:
-                debug.write(
-                    "Changing local config file and creating backup 'home.old'", 0, "WEBSERVERNODE")
-                with open('home.ini', 'w') as configfile:
-                    copyfile('home.ini', 'home.old')
-                    self.config.write(configfile)
-                self.dm.reload_configs()
+                    edits.append((section.upper(), entry.upper(), configdata[entry]))
+            if edits:
+                self.dm.update_config(edits)
 
         elif reqtype == "reloadconfig":
             self.dm.reload_configs()
@@ -295,6 +311,31 @@ class webservernode(Thread):
             else:
                 _response = content
 
+        elif reqtype in ["getdebuglogtail", "getdebuglogpage"]:
+            debuglevel = reqquery['debuglevel']
+            content = None
+            for _mod in self.dm.modules:
+                if _mod.__class__.__name__ == "weblog":
+                    if reqtype == "getdebuglogtail":
+                        content = _mod.get_tail(debuglevel, reqquery['cursor'])
+                    else:
+                        content = _mod.get_page(debuglevel, int(reqquery['before']))
+            if content is None:
+                debug.write('Cannot find module weblog', 1, "WEBSERVERNODE")
+                _response = "0"
+            else:
+                _response = content
+
+        elif reqtype == "getenergy":
+            devid = None
+            if reqquery.get('devid') not in [None, ""]:
+                devid = int(reqquery['devid'])
+            _response = self.dm.get_energy(devid)
+
+        elif reqtype == "gethistory":
+            devid = int(reqquery['devid'])
+            _response = self.dm.get_device_history(devid)
+
         elif reqtype == "reconnect":
             devid = int(reqquery['devid'])
             self.dm[devid].reconnect()
@@ -314,19 +355,15 @@ class webservernode(Thread):
             presets["preset"] = []
             presets["results"] = []
             presets["hidden"] = []
-            for _preset in self.config["PRESETS"].items():
-                req = StateRequestObject()
-                req.initialize_dm(self.dm)
-                if _preset[0] != "automatic_mode" and req.from_string(_preset[1]):
-                    presets["items"].append(_preset[0])
-                    presets["preset"].append(_preset[1].replace(
-                        "True", "true").replace("False", "false"))
-                    presets["descriptions"].append(str(req))
-                    presets["results"].append(req.colors)
-                    if _preset[0] in self.hidden_presets:
-                        presets["hidden"].append("1")
-                    else:
-                        presets["hidden"].append("0")
+            for _preset in self.dm.presets.items():
+                presets["items"].append(_preset.name)
+                presets["preset"].append(_preset.source.replace("True", "true").replace("False", "false"))
+                presets["descriptions"].append(_preset.description)
+                presets["results"].append(list(_preset.colors))
+                if _preset.name in self.hidden_presets:
+                    presets["hidden"].append("1")
+                else:
+                    presets["hidden"].append("0")
 
             _response = presets
 
@@ -340,13 +377,7 @@ class webservernode(Thread):
             req = StateRequestObject()
             req.initialize_dm(self.dm)
             if req.from_string(preset):
-                self.config.set("PRESETS", presetname.upper(), preset)
-                debug.write(
-                    "Changing local config file and creating backup 'home.old'", 0, "WEBSERVERNODE")
-                with open('home.ini', 'w') as configfile:
-                    copyfile('home.ini', 'home.old')
-                    self.config.write(configfile)
-                self.dm.reload_configs()
+                self.dm.update_config([("PRESETS", presetname.upper(), preset)])
                 _response = "1"
             else:
                 _response = "0"
@@ -375,11 +406,7 @@ class webservernode(Thread):
                 str(reqquery['rooms'])))
             debug.write("Changing room groups to {}".format(
                 rooms), 0, "WEBSERVERNODE")
-            self.config.set("WEBSERVERNODE", "ROOM_GROUPS", rooms)
-            with open('home.ini', 'w') as configfile:
-                copyfile('home.ini', 'home.old')
-                self.config.write(configfile)
-            self.dm.reload_configs()
+            self.dm.update_config([("WEBSERVER", "ROOM_GROUPS", rooms)])
             _response = "1"
 
         elif reqtype == "setpresetview":
@@ -387,11 +414,7 @@ class webservernode(Thread):
                 str(reqquery['presetlist'])))
             debug.write("Changing preset visibility to {}".format(
                 presetlist), 0, "WEBSERVERNODE")
-            self.config.set("WEBSERVER", "HIDDEN_PRESETS", presetlist)
-            with open('home.ini', 'w') as configfile:
-                copyfile('home.ini', 'home.old')
-                self.config.write(configfile)
-            self.dm.reload_configs()
+            self.dm.update_config([("WEBSERVER", "HIDDEN_PRESETS", presetlist)])
             _response = "1"
 
         else:
@@ -401,7 +424,8 @@ class webservernode(Thread):
         return json.dumps(_response)
 
     @staticmethod
-    def enqueue_output(out, queue):
+    def forward_output(out):
         for line in iter(out.readline, b''):
-            queue.put(line)
+            debug.write("(NODE.JS) {}".format(
+                line.rstrip().decode("UTF-8", errors="replace")), 0, "WEBSERVERNODE")
         out.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_backup.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Backup scheduler benchmark on local-directory clients: generated client folders are backed up
+    with one rsync job at a time, then in parallel, and the copies are checked. Then measures the
+    disk used by hard-link snapshots against full copies. Requires rsync.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_backup [clients] [parallel jobs]
+'''
+
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+from modules.backup import BackupClient, BackupIndex, BackupJob, BackupScheduler
+
+FOLDERS_PER_CLIENT = 2
+FILES_PER_FOLDER = 20
+FILE_SIZE = 256 * 1024
+
+
+def make_folders(root, clients):
+    """ (client, folder) of random files """
+    _folders = []
+    for _client in range(clients):
+        for _folder in range(FOLDERS_PER_CLIENT):
+            _path = os.path.join(root, "client{}".format(_client), "folder{}".format(_folder))
+            os.makedirs(_path)
+            for _file in range(FILES_PER_FOLDER):
+                with open(os.path.join(_path, "file{}".format(_file)), "wb") as _f:
+                    _f.write(os.urandom(FILE_SIZE))
+            _folders.append((_client, _path))
+    return _folders
+
+
+def run(folders, destination, concurrency):
+    shutil.rmtree(destination, ignore_errors=True)
+    _clients = {}
+    for _client, _folder in folders:
+        _dest = os.path.join(destination, "client{}".format(_client))
+        os.makedirs(_dest, exist_ok=True)
+        _clients.setdefault(_client, []).append(BackupJob(_client, _folder, _dest, delete=True))
+    _clients = [BackupClient(_client, "client{}".format(_client), _jobs) for _client, _jobs in _clients.items()]
+    _start = time.perf_counter()
+    BackupScheduler(concurrency).run(_clients)
+    _duration = time.perf_counter() - _start
+    _jobs = [_job for _client in _clients for _job in _client.jobs]
+    _copied = all(not filecmp.dircmp(_job.folder, os.path.join(_job.destination, os.path.basename(_job.folder))).diff_files
+                  for _job in _jobs if _job.status == "done")
+    print("{} parallel jobs: {} folders in {:.2f}s, {} done, {} bytes reported, copies {}".format(
+        concurrency, len(_jobs), _duration, sum(_job.status == "done" for _job in _jobs),
+        sum(_job.bytes for _job in _jobs), "identical" if _copied else "DIFFERENT"))
+    for _job in _jobs:
+        if _job.status != "done":
+            print("  {}: {} {}".format(_job.folder, _job.status, _job.message))
+
+
+def get_disk_usage(path):
+    """ Bytes used under path, hard-linked files counted once """
+    _inodes = {}
+    for _dir, _, _files in os.walk(path):
+        for _file in _files:
+            _stat = os.lstat(os.path.join(_dir, _file))
+            _inodes[_stat.st_ino] = _stat.st_size
+    return sum(_inodes.values())
+
+
+def run_snapshots(folders, root, count):
+    """ count snapshots, one file per folder changed between two snapshots """
+    _destination = os.path.join(root, "snapshots")
+    _index = BackupIndex(os.path.join(root, "index.json"), os.path.join(root, "runs.log"))
+    _start = time.perf_counter()
+    for _run in range(count):
+        _jobs = []
+        for _client, _folder in folders:
+            _job = BackupJob(_client, _folder, os.path.join(_destination, "client{}".format(_client)))
+            _index.prepare(_job)
+            # Snapshot names have a one second resolution
+            _job.set_snapshot("{}-{}".format(_job.snapshot, _run), _job.link_dest)
+            _jobs.append(_job)
+        BackupScheduler(4, on_done=_index.record).run([BackupClient(0, "client", _jobs)])
+        for _, _folder in folders:
+            with open(os.path.join(_folder, "file0"), "wb") as _f:
+                _f.write(os.urandom(FILE_SIZE))
+    _duration = time.perf_counter() - _start
+    _full = sum(get_disk_usage(_folder) for _, _folder in folders) * count
+    print("{} snapshots of {} folders in {:.2f}s: {:.1f} MB on disk, {:.1f} MB as full copies. {} runs indexed".format(
+        count, len(folders), _duration, get_disk_usage(_destination) / 1000000, _full / 1000000,
+        sum(len(_index.get(_client, _folder)) for _client, _folder in folders)))
+
+
+if __name__ == "__main__":
+    _count = 3
+    _concurrency = 4
+    if len(sys.argv) > 1:
+        _count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        _concurrency = int(sys.argv[2])
+    _root = tempfile.mkdtemp()
+    try:
+        _folders = make_folders(os.path.join(_root, "clients"), _count)
+        run(_folders, os.path.join(_root, "backups"), 1)
+        run(_folders, os.path.join(_root, "backups"), _concurrency)
+        run_snapshots(_folders, _root, 3)
+    finally:
+        shutil.rmtree(_root)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_config.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Benchmark of the config access: number of configurables.xml and home.ini parses during the
+    devicemanager startup against the parses of the former behaviour (each getConfigHandler and
+    set_section call parsed both files), and section/typed value access times.
+    Runs on a dry-run devicemanager (no module loaded) built from home.ini.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_config [accesses]
+'''
+
+import sys
+import time
+import xml.etree.ElementTree as ET
+import core.common as common
+import core.confighandler as confighandler
+from core.common import *
+from core.confighandler import ConfigHandler
+from core.devicemanager import DeviceManager
+
+CALLS = {"getConfigHandler": 0, "set_section": 0}
+
+
+def count_calls():
+    """ Counts the config accesses which used to parse the config files """
+    _get_handler = common.getConfigHandler
+    _set_section = ConfigHandler.set_section
+
+    def _counted_get_handler(*args, **kwargs):
+        CALLS["getConfigHandler"] += 1
+        return _get_handler(*args, **kwargs)
+
+    def _counted_set_section(self, *args, **kwargs):
+        CALLS["set_section"] += 1
+        return _set_section(self, *args, **kwargs)
+    for _module in list(sys.modules.values()):
+        if getattr(_module, "getConfigHandler", None) is _get_handler:
+            _module.getConfigHandler = _counted_get_handler
+    ConfigHandler.set_section = _counted_set_section
+
+
+def parse_section(section):
+    """ The former set_section: both config files parsed for a new handler """
+    ET.parse(os.path.join(confighandler.CORE_DIR, 'configurables.xml'))
+    return ConfigHandler(section)
+
+
+def time_access(count, access):
+    _start = time.perf_counter()
+    for _ in range(count):
+        access()
+    return time.perf_counter() - _start
+
+
+if __name__ == "__main__":
+    _count = 1000
+    if len(sys.argv) > 1:
+        _count = int(sys.argv[1])
+    count_calls()
+    _parses = ConfigHandler.parse_count
+    _start = time.perf_counter()
+    dm = DeviceManager(dryrun=True, load_modules=False)
+    _startup = time.perf_counter() - _start
+    _parses = ConfigHandler.parse_count - _parses
+    _calls = dict(CALLS)
+    _former = 2 * (_calls["getConfigHandler"] + _calls["set_section"])
+    _console = common.DEBUG_LOCK
+    # Console output would dominate the measure
+    common.DEBUG_LOCK = True
+    _config = getConfigHandler()
+    _view = _config.set_section("SERVER")
+    _results = {
+        "Section, parsed per call": time_access(_count // 10, lambda: parse_section("SERVER")),
+        "Section, shared view": time_access(_count, lambda: _config.set_section("SERVER")),
+        "Typed value, converted per call": time_access(_count, lambda: _view._get_typed_value("PORT", int)),
+        "Typed value, cached": time_access(_count, lambda: _view.get_value("PORT", int))}
+    common.DEBUG_LOCK = _console
+    print("Startup of {} devices in {:.3f}s: {} getConfigHandler and {} set_section calls".format(
+        len(dm), _startup, _calls["getConfigHandler"], _calls["set_section"]))
+    print("Config file parses during startup: {} (former behaviour: {}, {} saved)".format(
+        _parses, _former, _former - _parses))
+    for _name, _time in _results.items():
+        _done = _count // 10 if _name == "Section, parsed per call" else _count
+        print("{:<32}: {} accesses in {:.3f}s ({:.1f}us per access)".format(
+            _name, _done, _time, _time * 1000000 / _done))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_logging.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Benchmark of the state change throughput with journaling enabled and disabled, then with
+    DEBUG_LEVEL set to warning, where the debug messages are dropped before being formatted.
+    Runs on a dry-run devicemanager (no module loaded) built from home.ini.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_logging [requests]
+'''
+
+import sys
+import time
+import core.common as common
+from core.common import *
+from core.devicemanager import DeviceManager, StateRequestObject
+
+
+def run_requests(dm, count):
+    """ Runs count alternating all-on/all-off requests through _set_lights """
+    _start = time.perf_counter()
+    for _cnt in range(count):
+        req = StateRequestObject()
+        req.initialize_dm(dm)
+        if _cnt % 2:
+            req.set_colors([DEVICE_OFF] * len(dm))
+        else:
+            req.set_colors([DEVICE_ON] * len(dm))
+        req.set(skip_time=True, history_origin="Benchmark")
+        dm.set_mode(req)
+        dm.queue.put(req)
+        dm._set_lights()
+        if dm.scheduled_disconnect is not None:
+            dm.scheduled_disconnect.cancel()
+    debug.flush(timeout=60)
+    return time.perf_counter() - _start
+
+
+if __name__ == "__main__":
+    _count = 500
+    if len(sys.argv) > 1:
+        _count = int(sys.argv[1])
+    dm = DeviceManager(dryrun=True, load_modules=False)
+    if len(dm) == 0:
+        print("No devices configured in home.ini. Quitting.")
+        sys.exit()
+    _console = common.DEBUG_LOCK
+    # Console output would dominate the measure
+    common.DEBUG_LOCK = True
+    _severity = debug.min_severity
+    _results = {}
+    for _name, _journaling, _level in [("Journaling disabled", False, "debug"), ("Journaling enabled ", True, "debug"),
+                                       ("Level warning      ", True, "warning")]:
+        debug.journaling_enabled = _journaling
+        debug.min_severity = debug.SEVERITY_NAMES[_level]
+        run_requests(dm, 10)
+        _results[_name] = run_requests(dm, _count)
+    # Cost of a dropped debug message, formatted by the caller or by the writer thread
+    _calls = 100000
+    _start = time.perf_counter()
+    for _cnt in range(_calls):
+        debug.write("Device '{}', change {} => {} (Automatic mode: {})".format(_cnt, DEVICE_ON, DEVICE_OFF, True), 0)
+    _eager = time.perf_counter() - _start
+    _start = time.perf_counter()
+    for _cnt in range(_calls):
+        debug.write("Device '{}', change {} => {} (Automatic mode: {})", 0, args=(_cnt, DEVICE_ON, DEVICE_OFF, True))
+    _deferred = time.perf_counter() - _start
+    debug.min_severity = _severity
+    common.DEBUG_LOCK = _console
+    for _name, _time in _results.items():
+        print("{}: {} requests on {} devices in {:.3f}s ({:.1f} requests/s)".format(
+            _name, _count, len(dm), _time, _count / _time))
+    print("Dropped debug message: {:.2f}us formatted by the caller, {:.2f}us with args".format(
+        _eager * 1000000 / _calls, _deferred * 1000000 / _calls))
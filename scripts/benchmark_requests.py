@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_requests.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Benchmark of the StateRequestObject throughput: construction (with the plugin registry and
+    with a plugins directory scan per request, the former behaviour), cloning, preset requests
+    (compiled, and evaluated from their string, the former behaviour) and build+dispatch.
+    Runs on a dry-run devicemanager (no module loaded) built from home.ini.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_requests [requests]
+'''
+
+import sys
+import time
+import core.common as common
+from core.common import *
+from core.devicemanager import DeviceManager, StateRequestObject
+
+
+def build_requests(dm, count, rescan=False):
+    """ Builds count requests the way the webserver and the TCP server do """
+    _types = [_dev.device_type.lower() for _dev in dm]
+    _start = time.perf_counter()
+    for _cnt in range(count):
+        if rescan:
+            plugins.reload()
+        req = StateRequestObject()
+        req.initialize_dm(dm)
+        req.set(skip_time=True, history_origin="Benchmark")
+        if _cnt % 2:
+            req.set(on=True)
+        else:
+            req.set(**{_types[0]: [DEVICE_OFF]})
+        req2 = StateRequestObject()
+        req2.initialize_dm(dm)
+        req2.from_request(req)
+    return time.perf_counter() - _start
+
+
+def clone_requests(dm, count):
+    req = StateRequestObject()
+    req.initialize_dm(dm)
+    req.set(on=True, skip_time=True, history_origin="Benchmark")
+    _start = time.perf_counter()
+    for _cnt in range(count):
+        req.clone()
+    return time.perf_counter() - _start
+
+
+def preset_requests(dm, count, compiled=True):
+    """ Builds count preset requests, from the compiled presets or evaluating the preset strings """
+    _names = [_preset.name for _preset in dm.presets.items()]
+    _start = time.perf_counter()
+    for _cnt in range(count):
+        req = StateRequestObject()
+        req.initialize_dm(dm)
+        if compiled:
+            req.set(preset=_names[_cnt % len(_names)])
+        else:
+            req.from_string(dm.config["PRESETS"][_names[_cnt % len(_names)]])
+    return time.perf_counter() - _start
+
+
+def dispatch_requests(dm, count):
+    """ Builds, validates and runs count requests through the dry-run devicemanager """
+    _start = time.perf_counter()
+    for _cnt in range(count):
+        req = StateRequestObject()
+        req.initialize_dm(dm)
+        req.set(skip_time=True, history_origin="Benchmark")
+        if _cnt % 2:
+            req.set_colors([DEVICE_OFF] * len(dm))
+        else:
+            req.set_colors([DEVICE_ON] * len(dm))
+        req.validate()
+        dm.set_mode(req)
+        dm.queue.put(req)
+        dm._set_lights()
+        if dm.scheduled_disconnect is not None:
+            dm.scheduled_disconnect.cancel()
+    return time.perf_counter() - _start
+
+
+if __name__ == "__main__":
+    _count = 5000
+    if len(sys.argv) > 1:
+        _count = int(sys.argv[1])
+    dm = DeviceManager(dryrun=True, load_modules=False)
+    if len(dm) == 0:
+        print("No devices configured in home.ini. Quitting.")
+        sys.exit()
+    _console = common.DEBUG_LOCK
+    # Console output would dominate the measure
+    common.DEBUG_LOCK = True
+    debug.journaling_enabled = False
+    _results = {}
+    for _rescan in [True, False]:
+        build_requests(dm, 10, _rescan)
+        _name = "Build, directory scan per request" if _rescan else "Build, plugin registry"
+        _results[_name] = build_requests(dm, _count, _rescan)
+    _results["Clone"] = clone_requests(dm, _count)
+    if len(dm.presets.items()) > 0:
+        _results["Preset, compiled"] = preset_requests(dm, _count)
+        _results["Preset, string evaluated"] = preset_requests(dm, _count, compiled=False)
+    dispatch_requests(dm, 10)
+    _results["Build and dispatch"] = dispatch_requests(dm, _count // 10)
+    debug.flush(timeout=60)
+    common.DEBUG_LOCK = _console
+    for _name, _time in _results.items():
+        _done = _count // 10 if _name == "Build and dispatch" else _count
+        print("{:<34}: {} requests in {:.3f}s ({:.0f} requests/s)".format(
+            _name, _done, _time, _done / _time))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_roomclassifier.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.8
+
+    Accuracy and latency benchmark of the WiFi-RTT room classifier on a synthetic house: rooms
+    and three RTT responders placed on a plane, with noisy RTT distances and RSSI readings.
+    Measures the numpy and the pure Python implementations, and the location samples ingestion:
+    former per-sample log append and model save against the sample store and background retrain.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_roomclassifier [samples per room]
+'''
+
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import core.common as common
+from dnn.roomclassifier import RoomClassifier, RoomLocator, FEATURES, np
+
+RESPONDERS = [(0.0, 0.0), (12.0, 0.0), (6.0, 9.0)]
+ROOMS = {"kitchen": (2.0, 2.0), "livingroom": (9.0, 2.5), "bedroom": (3.0, 7.5),
+         "office": (9.5, 7.0), "bathroom": (6.0, 5.0), "hallway": (6.0, 1.0)}
+# Room radius, RTT distance noise and RSSI noise
+ROOM_SIZE = 1.5
+RTT_NOISE_MM = 400
+RSSI_NOISE_DB = 4
+
+
+def get_sample(room, rand):
+    """ r1_mean, r1_rssi, r2_mean... for a random position in room """
+    _x = ROOMS[room][0] + rand.uniform(-ROOM_SIZE, ROOM_SIZE)
+    _y = ROOMS[room][1] + rand.uniform(-ROOM_SIZE, ROOM_SIZE)
+    _features = []
+    for _rx, _ry in RESPONDERS:
+        _distance = max(0.3, math.hypot(_x - _rx, _y - _ry))
+        _features.append(_distance * 1000 + rand.gauss(0, RTT_NOISE_MM))
+        _features.append(-40 - 20 * math.log10(_distance) + rand.gauss(0, RSSI_NOISE_DB))
+    return _features
+
+
+def get_dataset(count, seed):
+    _rand = random.Random(seed)
+    return [(_room, get_sample(_room, _rand)) for _room in ROOMS for _ in range(count)]
+
+
+def run(use_numpy, train, test):
+    _classifier = RoomClassifier(use_numpy=use_numpy)
+    _start = time.perf_counter()
+    for _room, _features in train:
+        _classifier.add_sample(_room, _features)
+    _train_time = time.perf_counter() - _start
+    # Standardization runs on the first prediction after new samples
+    _start = time.perf_counter()
+    _classifier.predict(test[0][1])
+    _rebuild_time = time.perf_counter() - _start
+    _latencies = []
+    _correct = 0
+    for _room, _features in test:
+        _start = time.perf_counter()
+        _predicted = _classifier.predict(_features)
+        _latencies.append(time.perf_counter() - _start)
+        _correct += _predicted == _room
+    _latencies.sort()
+    print("{:<12}: accuracy {:.1f}% on {} samples ({} training), training {:.1f}ms, first prediction {:.2f}ms, "
+          "prediction avg {:.3f}ms p99 {:.3f}ms".format(
+              "numpy" if use_numpy else "pure Python", 100 * _correct / len(test), len(test), len(train),
+              _train_time * 1000, _rebuild_time * 1000, 1000 * sum(_latencies) / len(_latencies),
+              1000 * _latencies[int(len(_latencies) * 0.99)]))
+
+
+def run_ingestion(train):
+    _folder = tempfile.mkdtemp()
+    _locations = [dict(zip(FEATURES, _features), room=_room) for _room, _features in train]
+    # Former sendloc: log line appended and model file rewritten for each sample
+    _classifier = RoomClassifier()
+    _start = time.perf_counter()
+    for _location in _locations:
+        _classifier.add_sample(_location["room"], _location)
+        with open(_folder + "/train.log", "a") as _f:
+            _f.write("{},{}\n".format(_location["room"], ",".join(str(_location[_feature]) for _feature in FEATURES)))
+        _classifier.save(_folder + "/former.json")
+    _former = time.perf_counter() - _start
+    _log_size = os.path.getsize(_folder + "/train.log")
+    shutil.rmtree(_folder)
+    _folder = tempfile.mkdtemp()
+    _locator = RoomLocator(_folder, retrain_samples=len(_locations) + 1, retrain_interval=0)
+    _console = common.DEBUG_LOCK
+    # Console output of the duplicates would dominate the measure
+    common.DEBUG_LOCK = True
+    _start = time.perf_counter()
+    for _location in _locations + _locations[:len(_locations) // 10]:
+        _locator.add_sample(_location)
+    _ingestion = time.perf_counter() - _start
+    _start = time.perf_counter()
+    _locator.retrain()
+    _retrain = time.perf_counter() - _start
+    common.DEBUG_LOCK = _console
+    print("Ingestion of {} samples: former {:.1f}ms ({:.3f}ms per sample), sample store {:.1f}ms ({:.3f}ms per sample, "
+          "{} duplicates dropped)".format(len(_locations), _former * 1000, _former * 1000 / len(_locations),
+                                          _ingestion * 1000, _ingestion * 1000 / len(_locations),
+                                          len(_locations) // 10))
+    print("Training data on disk: train.log {} bytes, samples.bin {} bytes. Background retrain and swap: {:.1f}ms".format(
+        _log_size, os.path.getsize(_locator.store.path), _retrain * 1000))
+    print("Holdout report: {}".format(json.dumps({_key: _locator.report[_key] for _key in
+                                                  ["samples", "accuracy", "training_samples"]})))
+    shutil.rmtree(_folder)
+
+
+if __name__ == "__main__":
+    _count = 100
+    if len(sys.argv) > 1:
+        _count = int(sys.argv[1])
+    _train = get_dataset(_count, 1)
+    _test = get_dataset(50, 2)
+    if np is not None:
+        run(True, _train, _test)
+    else:
+        print("numpy is not installed, measuring the pure Python classifier only")
+    run(False, _train, _test)
+    run_ingestion(_train)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+    File name: benchmark_voice.py
+    Author: Maxime Bergeron
+    Date last modified: 19/10/2026
+    Python Version: 3.7
+
+    Benchmark of the voice command group resolution: the former IFTTT candidates list, rebuilt and
+    scanned for each request, against the resolver index. Also checks that both find the same groups.
+    Usage, from the Homeserver folder: python3 -m scripts.benchmark_voice [groups] [requests]
+'''
+
+import random
+import sys
+import time
+import unidecode
+from core.voiceresolver import VoiceResolver
+
+WORDS = ["turn", "on", "the", "off", "please", "in", "and", "all", "of"]
+PRIORITY_GROUPS = ["lights", "television"]
+GLOBAL_GROUP = "home"
+
+
+def former_resolve(requested_group, device_groups, priority_groups, global_group):
+    """ The former IFTTTServer.do_POST group resolution """
+    requested_group = unidecode.unidecode(requested_group)
+    all_groups = [unidecode.unidecode(x) for x in device_groups]
+    groups = []
+    for group in all_groups:
+        groups.append(group.lower())
+        if group[-1:] == "s" and group[:-1] not in all_groups:
+            groups.append(group[:-1].lower())
+        elif group + "s" not in all_groups:
+            groups.append(group.lower() + "s")
+    if global_group is not None:
+        if global_group.lower() not in all_groups:
+            groups.append(global_group.lower())
+        if global_group[-1:] == "s" and global_group[:-1].lower() not in all_groups:
+            groups.append(global_group[:-1].lower())
+        elif global_group.lower() + "s" not in all_groups:
+            groups.append(global_group.lower() + "s")
+    changed_groups = []
+    has_priority_group = False
+    has_global_group = False
+    for _group in groups:
+        if _group in requested_group.split(" "):
+            if _group in priority_groups or _group + "s" in priority_groups or (_group[-1:] == "s" and _group[:-1] in priority_groups):
+                has_priority_group = True
+            if _group == global_group or _group + "s" in global_group or (_group[-1:] == "s" and _group[:-1] in global_group):
+                has_global_group = True
+            if _group in all_groups:
+                changed_groups.append(_group)
+            elif _group + "s" in all_groups:
+                changed_groups.append(_group + "s")
+            elif (_group[-1:] == "s" and _group[:-1] in all_groups):
+                changed_groups.append(_group[:-1])
+    return changed_groups, has_priority_group, has_global_group
+
+
+def get_requests(groups, count):
+    _rand = random.Random(1)
+    _requests = []
+    for _ in range(count):
+        _named = _rand.sample(groups + [GLOBAL_GROUP], 2)
+        # Plural or singular form of the group names
+        _named = [_name[:-1] if _name.endswith("s") and _rand.random() < 0.3 else _name for _name in _named]
+        _words = _rand.sample(WORDS, 3) + _named
+        _rand.shuffle(_words)
+        _requests.append(" ".join(_words))
+    return _requests
+
+
+def time_resolve(requests, resolve):
+    _start = time.perf_counter()
+    _results = [resolve(_request) for _request in requests]
+    return time.perf_counter() - _start, _results
+
+
+if __name__ == "__main__":
+    _group_count = 30
+    _count = 10000
+    if len(sys.argv) > 1:
+        _group_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        _count = int(sys.argv[2])
+    _groups = ["lights", "television", "kitchen", "bedroom", "office", "salle"] + \
+        ["room{}".format(_cnt) for _cnt in range(max(0, _group_count - 6))]
+    _requests = get_requests(_groups, _count)
+    _former, _former_results = time_resolve(
+        _requests, lambda _request: former_resolve(_request, _groups, PRIORITY_GROUPS, GLOBAL_GROUP))
+    _start = time.perf_counter()
+    _resolver = VoiceResolver(_groups, PRIORITY_GROUPS, GLOBAL_GROUP)
+    _build = time.perf_counter() - _start
+    _indexed, _results = time_resolve(_requests, _resolver.resolve)
+    _same = sum(sorted(_former_groups) == sorted(_result.groups) and _former_priority == _result.priority and
+                _former_global == _result.is_global
+                for (_former_groups, _former_priority, _former_global), _result in zip(_former_results, _results))
+    print("{} requests on {} groups".format(_count, len(_groups)))
+    print("Former candidates scan: {:.3f}s ({:.1f}us per request)".format(_former, _former * 1000000 / _count))
+    print("Resolver index        : {:.3f}s ({:.1f}us per request), built once in {:.2f}ms".format(
+        _indexed, _indexed * 1000000 / _count, _build * 1000))
+    print("Same groups and flags : {} of {} requests".format(_same, _count))
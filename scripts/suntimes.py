@@ -2,15 +2,25 @@
 '''
     File name: suntimes.py
     Author: Maxime Bergeron
-    Date last modified: 20/05/2020
+    Date last modified: 19/10/2026
     Python Version: 3.7
 
     Helper script to fetch sun times - useful for light controls
 '''
 
+import datetime
+import os
+import struct
+import sys
+from array import array
 from astral.geocoder import database, lookup
 from astral.sun import sun
 
+SUN_TABLE_MAGIC = b"HSUN"
+SUN_TABLE_VERSION = 1
+# Minute-of-day marker for days without a sunrise/sunset (polar days/nights)
+SUN_TABLE_MISSING = 0xFFFF
+
 
 def get_sun(location):
     try:
@@ -19,3 +29,94 @@ def get_sun(location):
         return None
 
     return sun(li.observer, tzinfo=li.timezone)
+
+
+class SunTable(object):
+    """ Year-long sunrise/sunset table, stored as two uint16 minute-of-day arrays """
+
+    def __init__(self, location, year, sunrise, sunset):
+        self.location = location
+        self.year = year
+        self.sunrise = sunrise
+        self.sunset = sunset
+
+    @classmethod
+    def build(cls, location, year):
+        """ Computes the table offline with astral. Returns None for unknown locations """
+        try:
+            li = lookup(location, database())
+        except KeyError:
+            return None
+        sunrise = array('H', [SUN_TABLE_MISSING] * 366)
+        sunset = array('H', [SUN_TABLE_MISSING] * 366)
+        _day = datetime.date(year, 1, 1)
+        while _day.year == year:
+            _index = _day.timetuple().tm_yday - 1
+            try:
+                _sun = sun(li.observer, date=_day, tzinfo=li.timezone)
+                sunrise[_index] = _sun["sunrise"].hour * 60 + _sun["sunrise"].minute
+                sunset[_index] = _sun["sunset"].hour * 60 + _sun["sunset"].minute
+            except ValueError:
+                # The sun never rises or never sets on that day
+                pass
+            _day += datetime.timedelta(days=1)
+        return cls(location, year, sunrise, sunset)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "rb") as _f:
+                if _f.read(4) != SUN_TABLE_MAGIC:
+                    return None
+                _version, _year, _loclen = struct.unpack("<BHH", _f.read(5))
+                if _version != SUN_TABLE_VERSION:
+                    return None
+                _location = _f.read(_loclen).decode("UTF-8")
+                sunrise = array('H')
+                sunset = array('H')
+                sunrise.fromfile(_f, 366)
+                sunset.fromfile(_f, 366)
+        except (IOError, EOFError, struct.error, UnicodeDecodeError):
+            return None
+        if sys.byteorder != "little":
+            sunrise.byteswap()
+            sunset.byteswap()
+        return cls(_location, _year, sunrise, sunset)
+
+    def save(self, path):
+        _location = self.location.encode("UTF-8")
+        sunrise = array('H', self.sunrise)
+        sunset = array('H', self.sunset)
+        if sys.byteorder != "little":
+            sunrise.byteswap()
+            sunset.byteswap()
+        with open(path + ".tmp", "wb") as _f:
+            _f.write(SUN_TABLE_MAGIC)
+            _f.write(struct.pack("<BHH", SUN_TABLE_VERSION, self.year, len(_location)))
+            _f.write(_location)
+            sunrise.tofile(_f)
+            sunset.tofile(_f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, day, event):
+        """ Returns the sunrise or sunset time for a given date, or None if the sun does not rise/set """
+        _minutes = getattr(self, event)[day.timetuple().tm_yday - 1]
+        if _minutes == SUN_TABLE_MISSING:
+            return None
+        return datetime.time(_minutes // 60, _minutes % 60)
+
+
+def get_sun_table(location, path, year=None):
+    """ Loads the sun table stored at path, rebuilding it if the location or year changed """
+    if year is None:
+        year = datetime.date.today().year
+    _table = SunTable.load(path)
+    if _table is not None and _table.location == location and _table.year == year:
+        return _table
+    _table = SunTable.build(location, year)
+    if _table is not None:
+        try:
+            _table.save(path)
+        except IOError:
+            pass
+    return _table
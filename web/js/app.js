@@ -421,6 +421,38 @@ function closeTooltips() {
     });
 }
 
+function getHistory(card) {
+    var cid = card.attr("cid")
+    $.ajax({
+        type: "POST",
+        url: ".",
+        dataType: "json",
+        data: {
+                request: "True",
+                reqtype: "gethistory",
+                devid: cid
+            },
+        success: function(data){
+            showHistory(card, data)
+        },
+        error: function(data){
+            console.log(data)
+        }
+    })
+}
+
+function showHistory(card, data) {
+    if (data.events.length == 0) {
+        card.find(".history-body").html("_(No recent changes)")
+        return
+    }
+    var ontime = data.ontime.map(function(day) {
+        var minutes = Math.round(day.on_seconds / 60)
+        return day.day + ' <i class="fas fa-power-off"></i> ' + Math.floor(minutes / 60) + "h" + String(minutes % 60).padStart(2, "0")
+    })
+    card.find(".history-body").html(data.events.join("<br>") + "<hr>" + ontime.join("<br>"))
+}
+
 function enableCardTabs() {
     $(".history-nav").on("click", function() {
         $(this).addClass("active")
@@ -428,6 +460,7 @@ function enableCardTabs() {
         $(this).parents(".dcard").find(".control-body").hide()
         $(this).parents(".dcard").find(".settings-body").hide()
         $(this).parents(".dcard").find(".history-body").show()
+        getHistory($(this).parents(".dcard"))
     });
     $(".control-nav").on("click", function() {
         $(this).addClass("active")
@@ -837,14 +870,8 @@ function computeCards() {
             slider.roundSlider("refreshTooltip")
 
             $(this).find(".failure-error").hide();
-            if (stateJSON.history[cid] != "") {
-                if (stateJSON.history[cid][stateJSON.history[cid].length-1].includes("[Failure]")) {
-                    $(this).find(".failure-error").show();
-                }
-                history = stateJSON.history[cid].join("<br>")
-                $(this).find(".history-body").html(stateJSON.history[cid].join("<br>"))
-            } else {
-                $(this).find(".history-body").html("_(No recent changes)")
+            if (stateJSON.failed[cid]) {
+                $(this).find(".failure-error").show();
             }
 
             var sliderVal = $(this).find(".slider").roundSlider("getValue")